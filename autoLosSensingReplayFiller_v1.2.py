@@ -2,7 +2,8 @@
 ##
 ## Web site for AutoBRM.
 ##  Source : Yamcs-server @ Yamcs-pdc-fsl TM item APM/FSL_VMU_Recorder_OpMode
-##  Destination : AutoBRM MySql database
+##  Destination : AutoBRM MySql database. A LOS window is kept in the pending_los table from its start, then inserted as a replay
+##                request gap_request_delay_in_hours after its end.
 ##
 ## ADI - Space Applications Services - Dec2020
 ##
@@ -12,11 +13,12 @@
 import threading
 import datetime
 import commands
-import urllib2
-import base64
-import json
 from time import sleep
 import sqlite3
+import variableCache
+import autobrmDatabase
+import yamcsSubscription
+import yamcsClient
 
 #Constants
 ##Local/PDC
@@ -25,49 +27,55 @@ parameterName = 'FSL_VMU_Recorder_OpMode'
 los_sensing_threshold_in_seconds = 10
 los_gap_request_margin_seconds = 10
 gap_request_delay_in_hours = 6
+yamcsServer = 'yamcs-pdc'; yamcsPort = 8090; yamcsInstance = 'fsl-ops'; yamcsUsername = '*******'; yamcsPassword = '********'
 
-#Database operations function
-def update_mysql(statement):
+#Format of the pending_los due datetimes, compared as strings
+dueDateFormat = '%Y-%m-%d %H:%M:%S.%f'
+
+#Returns the thread connection kept by autobrmDatabase, shared with AutoBRM when running inside it.
+def getConnection():
     #Local/PDC
-    cnx = sqlite3.connect(db_database, isolation_level=None) #AutoCommit is enabled
-    cnx.execute("PRAGMA foreign_keys = 1") #Foreign key constraints are enabled
+    return autobrmDatabase.getConnectionManager(db_database).getConnection()
+
+#Database operations function. Returns the id of the inserted row, if any.
+def update_mysql(statement, parameters = ()):
+    cnx = getConnection()
     cursor = cnx.cursor()
-    cursor.execute(statement)
+    cursor.execute(statement, parameters)
     lastrowid = cursor.lastrowid
     cursor.close()
-    cnx.commit()
-    cnx.close()
     return lastrowid
 
-#Returns a variable value from its name by reading it from the database variable table.    
+#Returns a variable value from its name, read from the cached database variable table (see variableCache).
 def getVariableValue(varName):
-    cnx = sqlite3.connect(db_database, isolation_level=None) #AutoCommit is enabled
-    cnx.execute("PRAGMA foreign_keys = 1") #Foreign key constraints are enabled
-    dbCur = cnx.cursor()
-    #get Record ID
-    queryStatement = 'SELECT value FROM variable WHERE name like "%s";' % varName
-    dbCur.execute(queryStatement)
-    queryResult = dbCur.fetchall()
-    #Existing?
-    if len(queryResult) > 0:
-        varValue = str(queryResult[0][0])
-        if str.isdigit(varValue): varValue = int(varValue)
-    else:
-        varValue = None
-        
-    dbCur.close()
-    cnx.close()
-    return varValue
+    return variableCache.getVariableCache(db_database).getValue(varName)
     
-#Read and return parameter current value from Yamcs
+#Subscription to the recorder mode, None while polling
+parameterSubscription = None
+
+#Starts the Yamcs WebSocket subscription to the recorder mode and returns it. getYamcsParameterValue then reads the last pushed value instead of polling.
+def startParameterSubscription(logger):
+    global parameterSubscription
+    parameterSubscription = yamcsSubscription.ParameterSubscription(yamcsServer, yamcsPort, yamcsInstance, [['APM', parameterName]], \
+    yamcsUsername, yamcsPassword, getYamcsClient().getParameterValues, logger)
+    parameterSubscription.start()
+    return parameterSubscription
+
+#Returns the Yamcs REST client (keep-alive connections, timeouts and retries, see yamcsClient)
+def getYamcsClient():
+    return yamcsClient.getYamcsClient(yamcsServer, yamcsPort, yamcsInstance, yamcsUsername, yamcsPassword)
+
+#Read and return parameter current value (Yamcs ParameterValue) from Yamcs
+def readYamcsParameterValue(parameterName):
+    return getYamcsClient().getParameterValue('APM', parameterName)
+
+#Return parameter current value: the last value pushed by the subscription if connected, read from Yamcs otherwise
 def getYamcsParameterValue(parameterName):
-    #Local/PDC
-    server = 'yamcs-pdc'; username = '*******'; password = '********'
-    request = urllib2.Request("http://%s:8090/api/processors/fsl-ops/realtime/parameters/APM/%s" % (server, parameterName))
-    base64string = base64.b64encode('%s:%s' % (username, password))
-    request.add_header("Authorization", "Basic %s" % base64string)
-    result = urllib2.urlopen(request).read()
-    resultJson = json.loads(result)
+    resultJson = None
+    if parameterSubscription is not None and parameterSubscription.isConnected:
+        resultJson = parameterSubscription.getValue(parameterName)
+    if resultJson is None:
+        resultJson = readYamcsParameterValue(parameterName)
     
     returnDict = {}
     returnDict['modeValue'] = resultJson['engValue']['stringValue']
@@ -76,49 +84,93 @@ def getYamcsParameterValue(parameterName):
     
     return (returnDict)
     
+#Returns a new LOS sensing state, kept from one check to the next. A LOS still open in pending_los (AutoBRM stopped during the LOS) is resumed.
+def newLosState():
+    losState = {'insideRelevantLOS': None, 'los_startdate': None, 'los_enddate': None, 'losID': None}
+    cursor = getConnection().cursor()
+    cursor.execute('SELECT id FROM pending_los WHERE enddate IS NULL ORDER BY id DESC LIMIT 1;')
+    openLos = cursor.fetchall()
+    cursor.close()
+    if len(openLos) > 0:
+        losState['insideRelevantLOS'] = True
+        losState['losID'] = openLos[0][0]
+    return losState
+
+#Inserts the replay requests of the LOS windows due and removes them from pending_los, within one transaction. Returns the number of replay requests inserted.
+def releaseDueLosWindows(groundDate):
+    cursor = getConnection().cursor()
+    cursor.execute('SELECT id, startdate, enddate FROM pending_los WHERE due_date <= ? ORDER BY due_date;', (groundDate.strftime(dueDateFormat),))
+    dueWindows = cursor.fetchall()
+    if len(dueWindows) == 0:
+        cursor.close()
+        return 0
+    releasedCount = 0
+    autobrmDatabase.beginImmediate(cursor, 'los')
+    try:
+        for losID, startdate, enddate in dueWindows:
+            #Released by another check meanwhile
+            cursor.execute('DELETE FROM pending_los WHERE id = ?;', (losID,))
+            if cursor.rowcount == 0:
+                continue
+            cursor.execute('INSERT INTO replay(timestamp,startdate,enddate,priority) VALUES (datetime("now"),?,?,0);', (startdate, enddate))
+            cursor.execute('INSERT INTO replay_job(timestamp,text,replay_id,replay_status_id) VALUES (datetime("now"),"Manual replay request inserted by the automatic LOS sensing script",?,1);', (cursor.lastrowid,))
+            releasedCount += 1
+        cursor.execute('COMMIT;')
+    except Exception:
+        cursor.execute('ROLLBACK;')
+        cursor.close()
+        raise
+    cursor.close()
+    return releasedCount
+
+#Checks the recorder mode once: detects the relevant LOS start and end, and inserts the LOS replay requests due. Run every 10 seconds, by main or by the AutoBRM scheduler.
+#The LOS windows are saved in pending_los as soon as they start, a restart doesn't lose them.
+def checkLos(losState):
+    if getVariableValue('auto_los_sensing_replay_filler').lower() == 'on':
+        groundDate = datetime.datetime.now()
+        #get PP
+        pp = getYamcsParameterValue(parameterName)
+        'modeValue: %s' % pp['modeValue']
+        'acqDate: %s' % pp['acqDate']
+        #'genDate: %s' % pp['genDate']
+        'groundDate: %s' % groundDate
+        #parse PP and search for LOS
+        if not losState['insideRelevantLOS']:
+            'not insideRelevantLOS'
+            if ((pp['modeValue'] == 'Playback') and ((groundDate - pp['acqDate']) >= datetime.timedelta(seconds=los_sensing_threshold_in_seconds))):
+                'in first if'
+                #The state changes once the LOS is saved, a failed write is done again on the next check
+                los_startdate = pp['acqDate'] - datetime.timedelta(seconds=los_gap_request_margin_seconds)
+                losState['losID'] = update_mysql('INSERT INTO pending_los(timestamp,startdate) VALUES (datetime("now"),?);', (str(los_startdate),))
+                losState['los_startdate'] = los_startdate
+                losState['insideRelevantLOS'] = True
+        else:
+            'insideRelevantLOS'
+            if ((groundDate - pp['acqDate']) < datetime.timedelta(seconds=los_sensing_threshold_in_seconds)):
+                'in second if'
+                los_enddate = pp['acqDate'] + datetime.timedelta(seconds=los_gap_request_margin_seconds)
+                #Close the pending LOS (+margins), due gap_request_delay_in_hours after its end
+                update_mysql('UPDATE pending_los SET enddate = ?, due_date = ? WHERE id = ?;', (str(los_enddate), \
+                (los_enddate + datetime.timedelta(hours=gap_request_delay_in_hours)).strftime(dueDateFormat), losState['losID']))
+                losState['los_enddate'] = los_enddate
+                losState['insideRelevantLOS'] = False
+                losState['losID'] = None
+        '...'
+        #Insert the LOS replay requests due to AutoBRM database
+        releaseDueLosWindows(groundDate)
+
 #Main
 def main(arg):
     #Variables
-    insideRelevantLOS = None
-    los_startdate = None
-    los_enddate = None
-    losList = []
+    losState = newLosState()
     
     #Main
     t = threading.currentThread()
     while getattr(t, "do_run", True):
         sleep(10)
-        if getVariableValue('auto_los_sensing_replay_filler').lower() == 'on':
-            groundDate = datetime.datetime.now()
-            #get PP
-            pp = getYamcsParameterValue(parameterName)
-            'modeValue: %s' % pp['modeValue']
-            'acqDate: %s' % pp['acqDate']
-            #'genDate: %s' % pp['genDate']
-            'groundDate: %s' % groundDate
-            #parse PP and search for LOS
-            if not insideRelevantLOS:
-                'not insideRelevantLOS'
-                if ((pp['modeValue'] == 'Playback') and ((groundDate - pp['acqDate']) >= datetime.timedelta(seconds=los_sensing_threshold_in_seconds))):
-                    'in first if'
-                    insideRelevantLOS = True
-                    los_startdate = pp['acqDate'] - datetime.timedelta(seconds=los_gap_request_margin_seconds)
-            else:
-                'insideRelevantLOS'
-                if ((groundDate - pp['acqDate']) < datetime.timedelta(seconds=los_sensing_threshold_in_seconds)):
-                    'in second if'
-                    insideRelevantLOS = False
-                    los_enddate = pp['acqDate'] + datetime.timedelta(seconds=los_gap_request_margin_seconds)
-                    #Add LOS (+margins) to list
-                    losList.append([{ 'startDate': los_startdate, 'endDate': los_enddate }])
-            '...'
-            #Process LOSgap list and perform DB Insert
-            iterationList = losList[:] #Copy list for iteration
-            for replayItem in iterationList:
-                if groundDate - replayItem[0]['endDate'] >= datetime.timedelta(hours=gap_request_delay_in_hours):
-                    #Insert previously generated LOS list to AutoBRM database
-                    lastrowid = update_mysql('INSERT INTO replay(timestamp,startdate,enddate,priority) VALUES (datetime("now"),"%s","%s",0);' % (replayItem[0]['startDate'], replayItem[0]['endDate']))
-                    _ = update_mysql('INSERT INTO replay_job(timestamp,text,replay_id,replay_status_id) VALUES (datetime("now"),"Manual replay request inserted by the automatic LOS sensing script",%s,1);' % lastrowid)
-                    #Remove LOS from the list
-                    losList.remove(replayItem)
-
+        #Database locked by a scan or the merge beyond the busy timeout (counted in autobrm_sqlite_lock_timeouts_total): checked again on the next cycle.
+        #The LOS windows are kept in pending_los until released, none is lost.
+        try:
+            checkLos(losState)
+        except sqlite3.OperationalError:
+            pass
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+##
+## Synthetic benchmark of the AutoBRM scan, parse, merge and dispatch stages.
+##  Source : Synthetic Meex 'list -e -k vmu' listings (channels, origins, gap density and corrupt packet runs chosen by the
+##           arguments), ingested into a throwaway SQLite database created with the AutoBRM schema migrations.
+##  Destination : One JSON line per scale point and stage (seconds, items, items/s), on standard output or in a file.
+##
+## Stages, timed separately for every scale point (number of gaps in the listing):
+##  generate : writing the synthetic listing
+##  parse    : sqchk.py sequence check of the listing (and sqchk.awk when its awk is installed, stage parse_awk,
+##             and sqchkVectorized.py when NumPy is installed, stage parse_vectorized)
+##  ingest   : scanForVmuHrdGaps, Meex replaced by a script printing the listing
+##  merge    : insertHrdGapItem2ReplayList, gap merge and replay packing
+##  dispatch : getQueuedReplayItems, selection of the next replay items to issue
+##  gap_items, gap_items_legacy : memory of the gap items a day scan keeps, sqchk records turned into gapRecords.GapItem objects (recordToGapItem), and
+##             into the former [itemType, hrd dictionary, vmu dictionary] items for reference (bytesPerItem, objectsPerItem)
+##
+## autobrmBenchmark.py --scale 1000 10000 100000 --output results.json
+## autobrmBenchmark.py --scale 1000 10000 --baseline results.json   (exits 1 if a stage got slower than the baseline)
+## autobrmBenchmark.py --scale 1000 10000 100000 --check-growth      (exits 1 if the merge time grows faster than n log n)
+##
+
+import os
+import sys
+import math
+import imp
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import sqlite3
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from distutils.spawn import find_executable
+import autobrmSchema
+import sqchk
+try:
+    import sqchkVectorized
+except ImportError:
+    sqchkVectorized = None
+
+#Start of the synthetic listings
+listingStartDate = datetime(2023, 1, 1)
+listingLineFormat = '%8d | 1 | %s | %8d | 0 | 0 | %s | %s | %s | %8d | %s | 0 | 0 | %s'
+#Status field of a corrupt packet, as Meex prints it
+badPacketStatus = 'invalid'
+
+#Writes a synthetic Meex 'list -e -k vmu' listing holding gapCount gaps. Packets go round robin over the channels and origins, every
+#channel keeping its own VMU sequence count and every channel and origin stream its own HRD sequence count. About one packet in packetsPerGap opens a gap (HRD
+#and VMU sequence count jump of 1 to maxGapPackets), one gap in badRunEvery is a run of badRunLength corrupt packets instead. Returns the number of listing lines.
+def generateListing(output, gapCount, channels, origins, packetsPerGap, packetIntervalMs, maxGapPackets = 20, badRunEvery = 10, badRunLength = 3, seed = 0, startDate = None):
+    randomGenerator = random.Random(seed)
+    packetTime = startDate or listingStartDate
+    streams = [[channel, origin] for channel in channels for origin in origins]
+    vmuSequenceCounts = dict([(channel, 0) for channel in channels])
+    hrdSequenceCounts = dict([((channel, origin), 0) for (channel, origin) in streams])
+    lineCount = 0
+    gaps = 0
+    while gaps < gapCount:
+        channel, origin = streams[lineCount % len(streams)]
+        status = 'ok'
+        hrdSequenceCounts[(channel, origin)] += 1
+        if randomGenerator.random() < 1.0 / packetsPerGap:
+            gaps += 1
+            if gaps % badRunEvery == 0:
+                status = badPacketStatus
+            else:
+                #Packets lost on the link: missing from both sequence counts
+                missingPackets = randomGenerator.randint(1, maxGapPackets)
+                hrdSequenceCounts[(channel, origin)] += missingPackets
+                vmuSequenceCounts[channel] += missingPackets
+        #A corrupt run: the packet and the next ones of the stream are corrupt
+        for runIndex in range(badRunLength if status == badPacketStatus else 1):
+            vmuSequenceCounts[channel] += 1
+            packetDate = packetTime.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+            output.write(listingLineFormat % (lineCount, packetDate, vmuSequenceCounts[channel], channel, origin, packetDate, hrdSequenceCounts[(channel, origin)], \
+            'UPI_%s_%s' % (channel.upper(), origin), status) + '\n')
+            lineCount += 1
+            packetTime += timedelta(milliseconds = packetIntervalMs)
+            if runIndex < badRunLength - 1 and status == badPacketStatus:
+                hrdSequenceCounts[(channel, origin)] += 1
+    return lineCount
+
+#Loads the AutoBRM main script as a module, logging warnings only.
+def loadAutobrm(autobrmFile):
+    autobrm = imp.load_source('autobrm', autobrmFile)
+    autobrm.logger = logging.getLogger('autobrm')
+    autobrm.logger.setLevel(logging.WARNING)
+    return autobrm
+
+#Creates the benchmark database: AutoBRM schema and the variables the timed stages read.
+#The Col-CC buffer is made long enough for the listing data not to expire: the dispatch stage times the selection of every replay item.
+def createDatabase(databaseFile, workDirectory, meexScript, bufferHours):
+    dbCon = sqlite3.connect(databaseFile, timeout=10, isolation_level=None)
+    autobrmSchema.upgradeDatabase(dbCon)
+    variables = [['meex_command_bin', meexScript], ['meex_data_path_basedir', os.path.join(workDirectory, 'archive') + '/'], ['scan_days_back', '1'], \
+    ['scan_parallelism', '1'], ['scan_incremental', 'off'], ['scan_gap_offset_check_minutes', '1'], ['bitstreamrequest_bitrate', '2000000'], \
+    ['replay_buffer_hours', str(bufferHours)]]
+    dbCon.executemany('INSERT INTO variable (name, value) VALUES (?, ?);', variables)
+    dbCon.close()
+
+#Former scan gap item of a sqchk record: [itemType, hrd dictionary, vmu dictionary], as recordToGapItem gave it before gapRecords. Reference of the gap_items stage.
+def legacyRecordToGapItem(record):
+    if isinstance(record, sqchk.GapRecord):
+        hrd = {'channel': record.channel.strip(), 'startdate': record.vmuStartdate.strip(), 'enddate': record.vmuEnddate.strip(), \
+        'last_sequence_count': record.vmuLastSequenceCount, 'next_sequence_count': record.vmuNextSequenceCount, 'difference': record.vmuDifference}
+        vmu = {'source': str(record.origin), 'startdate': record.hrdStartdate.strip(), 'enddate': record.hrdEnddate.strip(), \
+        'last_sequence_count': record.hrdLastSequenceCount, 'next_sequence_count': record.hrdNextSequenceCount, 'difference': record.hrdDifference, \
+        'phaseName': None, 'recordName': record.upi.strip()}
+        return ['G', hrd, vmu]
+    hrd = {'channel': record.channel.strip(), 'startdate': record.startdate.strip(), 'enddate': record.enddate.strip(), \
+    'last_sequence_count': record.firstSequenceCount, 'next_sequence_count': record.lastSequenceCount, 'difference': record.difference}
+    vmu = {'source': str(record.origin), 'difference': None}
+    return ['B', hrd, vmu]
+
+#Returns [bytes, objects] held by a value: lists, tuples and dictionaries with their contents, slotted objects with their fields, every object counted once (seen ids).
+def measureObjects(value, seenIDs):
+    if id(value) in seenIDs:
+        return [0, 0]
+    seenIDs.add(id(value))
+    byteCount = sys.getsizeof(value)
+    objectCount = 1
+    if isinstance(value, dict):
+        children = value.keys() + value.values()
+    elif isinstance(value, (list, tuple)):
+        children = value
+    else:
+        children = [getattr(value, field) for field in getattr(value, '__slots__', ())]
+    for child in children:
+        childBytes, childObjects = measureObjects(child, seenIDs)
+        byteCount += childBytes
+        objectCount += childObjects
+    return [byteCount, objectCount]
+
+#Times the conversion of the listing sqchk records into gap items and measures the items kept. Returns the stage result, with bytes and objects per item.
+def gapItemsResult(scale, stage, listingFile, lineCount, toGapItem):
+    with open(listingFile) as listing:
+        seconds, gapItems = timeCall(lambda: [toGapItem(record) for record in sqchk.checkLines(listing)])
+    byteCount, objectCount = measureObjects(gapItems, set())
+    result = stageResult(scale, stage, seconds, lineCount, 'lines', len(gapItems))
+    result['bytesPerItem'] = round(float(byteCount) / max(len(gapItems), 1), 1)
+    result['objectsPerItem'] = round(float(objectCount) / max(len(gapItems), 1), 2)
+    return result
+
+#Times a function call. Returns [seconds, result].
+def timeCall(function, *arguments):
+    startTime = time.time()
+    result = function(*arguments)
+    return [time.time() - startTime, result]
+
+#Returns the result line of a stage
+def stageResult(scale, stage, seconds, itemCount, itemName, rowCount = None):
+    return {'scale': scale, 'stage': stage, 'seconds': round(seconds, 4), 'items': itemCount, 'itemName': itemName, \
+    'itemsPerSecond': round(itemCount / max(seconds, 0.000001), 1), 'rows': rowCount}
+
+#Runs every stage for one scale point in its own work directory. Returns the stage results.
+def runScale(autobrmFile, scale, arguments):
+    workDirectory = tempfile.mkdtemp(prefix = 'autobrm-benchmark-')
+    try:
+        results = []
+        listingFile = os.path.join(workDirectory, 'listing.txt')
+        with open(listingFile, 'w') as listing:
+            seconds, lineCount = timeCall(generateListing, listing, scale, arguments.channels, arguments.origins, arguments.packets_per_gap, \
+            arguments.packet_interval_ms, arguments.max_gap_packets, arguments.bad_run_every, arguments.bad_run_length, arguments.seed)
+        results.append(stageResult(scale, 'generate', seconds, lineCount, 'lines'))
+
+        with open(listingFile) as listing:
+            seconds, recordCount = timeCall(lambda: sum([1 for record in sqchk.checkLines(listing)]))
+        results.append(stageResult(scale, 'parse', seconds, lineCount, 'lines', recordCount))
+        if sqchkVectorized is not None:
+            with open(listingFile) as listing:
+                seconds, recordCount = timeCall(lambda: sum([1 for record in sqchkVectorized.checkLines(listing)]))
+            results.append(stageResult(scale, 'parse_vectorized', seconds, lineCount, 'lines', recordCount))
+        if find_executable(arguments.awk) and os.path.exists(arguments.awk_script):
+            with open(os.devnull, 'w') as devnull:
+                seconds, returnCode = timeCall(lambda: subprocess.call([arguments.awk, '-f', arguments.awk_script, listingFile], stdout = devnull))
+            results.append(stageResult(scale, 'parse_awk', seconds, lineCount, 'lines'))
+
+        #Meex replaced by the listing, in the day folder the scan looks at
+        meexScript = os.path.join(workDirectory, 'meex')
+        with open(meexScript, 'w') as script:
+            script.write('#!/bin/sh\ncat %s\n' % listingFile)
+        os.chmod(meexScript, 0755)
+        databaseFile = os.path.join(workDirectory, 'autobrm.db')
+        createDatabase(databaseFile, workDirectory, meexScript, int((datetime.utcnow() - listingStartDate).total_seconds() / 3600) + 72)
+        autobrm = loadAutobrm(autobrmFile)
+        autobrm.dbDatabase = databaseFile
+        dbCon = autobrm.dbConnectToDatabase()
+        os.makedirs(autobrm.getFolderPath(dbCon, 1))
+
+        seconds, result = timeCall(autobrm.scanForVmuHrdGaps)
+        gapCount = autobrm.dbConnectToDatabase().execute('SELECT COUNT(*) FROM hrd_packet_gap;').fetchall()[0][0]
+        #The scan reads and checks the listing itself: the ingestion speed is in listing lines, the rows are the hrd_packet_gap rows written
+        results.append(stageResult(scale, 'ingest', seconds, lineCount, 'lines', gapCount))
+
+        seconds, result = timeCall(autobrm.insertHrdGapItem2ReplayList)
+        dbCon = autobrm.dbConnectToDatabase()
+        replayCount = dbCon.execute('SELECT COUNT(*) FROM replay;').fetchall()[0][0]
+        results.append(stageResult(scale, 'merge', seconds, gapCount, 'gaps', replayCount))
+
+        seconds, replayItems = timeCall(autobrm.getQueuedReplayItems, dbCon, autobrm.bitstreamRequestQueueLookahead)
+        results.append(stageResult(scale, 'dispatch', seconds, replayCount, 'replay items'))
+        autobrm.dbCloseConnection()
+
+        results.append(gapItemsResult(scale, 'gap_items', listingFile, lineCount, autobrm.recordToGapItem))
+        results.append(gapItemsResult(scale, 'gap_items_legacy', listingFile, lineCount, legacyRecordToGapItem))
+        return results
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors = True)
+
+#Returns the stages of the results slower than in the baseline by more than the tolerance (fraction), as [scale, stage, baseline seconds, seconds]
+def compareWithBaseline(results, baselineResults, tolerance):
+    baselineSeconds = dict([((result['scale'], result['stage']), result['seconds']) for result in baselineResults])
+    regressions = []
+    for result in results:
+        key = (result['scale'], result['stage'])
+        if key in baselineSeconds and result['seconds'] > baselineSeconds[key] * (1 + tolerance) and result['seconds'] - baselineSeconds[key] > 0.01:
+            regressions.append([result['scale'], result['stage'], baselineSeconds[key], result['seconds']])
+    return regressions
+
+#Returns the stages whose time grows faster than n log n from the smallest to the largest scale, by more than the given factor, as [stage, smallest scale, largest scale, time growth, n log n growth].
+#Scales below 2 and times below 10 ms at the smallest scale are too noisy to tell anything: the smallest time is taken as 10 ms at least.
+def checkGrowth(results, stages, factor):
+    slowStages = []
+    for stage in stages:
+        points = sorted([(result['scale'], result['seconds']) for result in results if result['stage'] == stage and result['scale'] > 1])
+        if len(points) < 2 or points[0][0] == points[-1][0]:
+            continue
+        (smallScale, smallSeconds), (largeScale, largeSeconds) = points[0], points[-1]
+        expectedGrowth = (largeScale * math.log(largeScale)) / (smallScale * math.log(smallScale))
+        growth = largeSeconds / max(smallSeconds, 0.01)
+        if growth > expectedGrowth * factor:
+            slowStages.append([stage, smallScale, largeScale, growth, expectedGrowth])
+    return slowStages
+
+def main(argv = None):
+    scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description = 'Times the AutoBRM scan, parse, merge and dispatch stages on synthetic Meex listings.')
+    parser.add_argument('--scale', type = int, nargs = '+', default = [1000, 10000, 100000], help = 'numbers of gaps in the listing')
+    parser.add_argument('--channels', nargs = '+', default = list(sqchk.channelNames), choices = sqchk.channelNames)
+    parser.add_argument('--origins', nargs = '+', default = ['33', '40', '51'], help = 'HRD origins (only 33-47, 51 and 90 are checked)')
+    parser.add_argument('--packets-per-gap', type = int, default = 50, help = 'mean number of packets between two gaps')
+    parser.add_argument('--packet-interval-ms', type = int, default = 5000, help = 'time between two packets of the listing')
+    parser.add_argument('--max-gap-packets', type = int, default = 20, help = 'largest number of packets missing in a gap')
+    parser.add_argument('--bad-run-every', type = int, default = 10, help = 'one gap in this many is a corrupt packet run')
+    parser.add_argument('--bad-run-length', type = int, default = 3, help = 'corrupt packets in a run')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--autobrm', default = os.path.join(scriptDirectory, 'autobrm_v1.5.2.py'), help = 'AutoBRM script to benchmark')
+    parser.add_argument('--awk', default = 'gawk', help = 'awk command for the sqchk.awk stage, skipped if not installed')
+    parser.add_argument('--awk-script', default = os.path.join(scriptDirectory, 'sqchk.awk'))
+    parser.add_argument('--output', help = 'results file (JSON lines), standard output if not given')
+    parser.add_argument('--baseline', help = 'results file of a previous run: exit 1 if a stage got slower')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'slowdown allowed against the baseline, as a fraction')
+    parser.add_argument('--check-growth', action = 'store_true', help = 'exit 1 if the merge time grows faster than n log n over the scales')
+    parser.add_argument('--growth-factor', type = float, default = 2.0, help = 'time growth allowed over the n log n growth, as a factor')
+    arguments = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    run = {'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'autobrm': os.path.basename(arguments.autobrm), 'python': platform.python_version(), \
+    'sqlite': sqlite3.sqlite_version, 'host': platform.node()}
+    results = []
+    for scale in arguments.scale:
+        for result in runScale(arguments.autobrm, scale, arguments):
+            result.update(run)
+            results.append(result)
+            sys.stderr.write('%8d gaps %-10s %9.3f s %12.1f %s/s%s\n' % (scale, result['stage'], result['seconds'], result['itemsPerSecond'], result['itemName'], \
+            ' %8.1f bytes/item %6.2f objects/item' % (result['bytesPerItem'], result['objectsPerItem']) if 'bytesPerItem' in result else ''))
+
+    output = open(arguments.output, 'w') if arguments.output else sys.stdout
+    for result in results:
+        output.write(json.dumps(result, sort_keys = True) + '\n')
+    if arguments.output:
+        output.close()
+
+    returnCode = 0
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline:
+            regressions = compareWithBaseline(results, [json.loads(line) for line in baseline if line.strip()], arguments.tolerance)
+        for scale, stage, baselineSeconds, seconds in regressions:
+            sys.stderr.write('SLOWER %s at %s gaps: %.3f s instead of %.3f s\n' % (stage, scale, seconds, baselineSeconds))
+        if regressions:
+            returnCode = 1
+    if arguments.check_growth:
+        for stage, smallScale, largeScale, growth, expectedGrowth in checkGrowth(results, ['merge'], arguments.growth_factor):
+            sys.stderr.write('GROWTH %s from %s to %s gaps: x%.1f instead of about x%.1f (n log n)\n' % (stage, smallScale, largeScale, growth, expectedGrowth))
+            returnCode = 1
+    return returnCode
+
+#main
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+##
+## SQLite connection manager for AutoBRM and autoLosSensingReplayFiller.
+##  Source : AutoBRM database file.
+##  Destination : One long-lived connection per thread, in WAL journal mode.
+##
+## WAL lets the 10 seconds main loop read while a scan thread writes, instead of failing with 'database is locked'.
+## Connections keep their prepared statements (see cachedStatements) as long as the thread lives.
+##
+
+import time
+import threading
+import sqlite3
+import autobrmMetrics
+import autobrmTrace
+
+#Connection tuning
+journalMode = 'WAL'
+synchronousMode = 'NORMAL' #Safe with WAL, only the last transactions may be lost on a power failure
+cacheSizeKiB = 16384
+busyTimeoutSeconds = 10
+cachedStatements = 256
+
+#Opens and tunes a new connection. AutoCommit is enabled and foreign key constraints are enabled, as for every AutoBRM connection.
+#Its statements are timed, the slow ones go to the trace log (see autobrmTrace).
+def openConnection(databaseFile, checkSameThread = True):
+    dbCon = sqlite3.connect(databaseFile, timeout=busyTimeoutSeconds, isolation_level=None, check_same_thread=checkSameThread, cached_statements=cachedStatements, factory=autobrmTrace.TracedConnection)
+    dbCon.execute("PRAGMA foreign_keys = 1")
+    dbCon.execute("PRAGMA journal_mode = %s" % journalMode) #Persistent, only the first connection actually switches the database
+    dbCon.execute("PRAGMA synchronous = %s" % synchronousMode)
+    dbCon.execute("PRAGMA cache_size = -%s" % cacheSizeKiB)
+    return dbCon
+
+autobrmMetrics.describeMetric('autobrm_sqlite_lock_wait_seconds', 'histogram', 'Time waited for the database write lock, per transaction')
+autobrmMetrics.describeMetric('autobrm_sqlite_lock_timeouts_total', 'counter', 'Write transactions which could not get the database lock within the busy timeout')
+
+#Starts a write transaction on a cursor, timing the wait for the database write lock (metric autobrm_sqlite_lock_wait_seconds).
+def beginImmediate(dbCur, transactionName):
+    startTime = time.time()
+    try:
+        dbCur.execute('BEGIN IMMEDIATE;')
+    except sqlite3.OperationalError:
+        autobrmMetrics.incrementCounter('autobrm_sqlite_lock_timeouts_total', labels = {'transaction': transactionName})
+        raise
+    finally:
+        autobrmMetrics.observeHistogram('autobrm_sqlite_lock_wait_seconds', time.time() - startTime, {'transaction': transactionName})
+
+#Keeps one connection per thread for a database file.
+class ConnectionManager(object):
+
+    def __init__(self, databaseFile):
+        self.databaseFile = databaseFile
+        self.local = threading.local()
+
+    #Returns the connection of the calling thread, opening it on first use
+    def getConnection(self):
+        dbCon = getattr(self.local, 'dbCon', None)
+        if dbCon is None:
+            dbCon = openConnection(self.databaseFile)
+            self.local.dbCon = dbCon
+        return dbCon
+
+    #Hands the connection back after a unit of work. It stays open, but no transaction is left pending on it.
+    def releaseConnection(self, dbCon):
+        try:
+            dbCon.execute('ROLLBACK')
+        except sqlite3.OperationalError:
+            #No transaction active, the normal case
+            pass
+        except sqlite3.Error:
+            #Unusable connection, the next getConnection opens a new one
+            self.closeConnection()
+
+    #Closes the connection of the calling thread
+    def closeConnection(self):
+        dbCon = getattr(self.local, 'dbCon', None)
+        self.local.dbCon = None
+        if dbCon is not None:
+            try:
+                dbCon.close()
+            except sqlite3.Error:
+                pass
+
+connectionManagers = {}
+connectionManagersLock = threading.Lock()
+
+#Returns the connection manager of a database file, shared by every user of the same file in the process.
+def getConnectionManager(databaseFile):
+    with connectionManagersLock:
+        if databaseFile not in connectionManagers:
+            connectionManagers[databaseFile] = ConnectionManager(databaseFile)
+        return connectionManagers[databaseFile]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+##
+## Metrics of the AutoBRM pipeline in the Prometheus text format.
+##  Source : Counters and histograms updated by the AutoBRM procedures, and collectors run at exposition time (queue depths, Yamcs latencies).
+##  Destination : HTTP endpoint on localhost (MetricsServer, GET /metrics) and/or a metrics file rewritten periodically (writeMetricsFile),
+##                to be read by Prometheus or the node exporter textfile collector.
+##
+## Metrics are process wide: the procedures update them with incrementCounter, observeHistogram and setGauge, whatever thread they run on.
+##
+
+import os
+import threading
+import BaseHTTPServer
+
+#Default histogram buckets, in seconds
+defaultBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600]
+
+#Metric descriptions: name -> [type, help, buckets]
+metricDescriptions = {}
+#Metric values: name -> {labels: value}, a histogram value being [bucket counts, count, sum]
+metricValues = {}
+#Functions called before each exposition, to update gauges read from elsewhere (database, Yamcs clients)
+collectors = []
+metricsLock = threading.Lock()
+
+#Declares a metric: type is 'counter', 'gauge' or 'histogram'
+def describeMetric(name, metricType, helpText, buckets = None):
+    with metricsLock:
+        metricDescriptions[name] = [metricType, helpText, buckets or defaultBuckets]
+        metricValues.setdefault(name, {})
+
+#Labels as a sorted tuple of (name, value) pairs, the key of the metric values
+def getLabelKey(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def incrementCounter(name, value = 1, labels = None):
+    with metricsLock:
+        values = metricValues.setdefault(name, {})
+        labelKey = getLabelKey(labels)
+        values[labelKey] = values.get(labelKey, 0) + value
+
+def setGauge(name, value, labels = None):
+    with metricsLock:
+        metricValues.setdefault(name, {})[getLabelKey(labels)] = value
+
+#Replaces every value of a gauge, so label sets which disappeared are not exposed any more
+def setGaugeValues(name, labeledValues):
+    with metricsLock:
+        metricValues[name] = dict([(getLabelKey(labels), value) for (labels, value) in labeledValues])
+
+#Sets a counter kept elsewhere (Yamcs client error counts for instance) to its current total
+def setCounter(name, value, labels = None):
+    setGauge(name, value, labels)
+
+#Sets a histogram kept elsewhere: cumulative counts of the described buckets, count and sum
+def setHistogram(name, bucketCounts, count, total, labels = None):
+    with metricsLock:
+        metricValues.setdefault(name, {})[getLabelKey(labels)] = [list(bucketCounts), count, total]
+
+def observeHistogram(name, value, labels = None):
+    with metricsLock:
+        buckets = metricDescriptions.get(name, [None, None, defaultBuckets])[2]
+        values = metricValues.setdefault(name, {})
+        labelKey = getLabelKey(labels)
+        if labelKey not in values:
+            values[labelKey] = [[0] * len(buckets), 0, 0.0]
+        histogram = values[labelKey]
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][index] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+#Registers a function called without arguments before each exposition
+def addCollector(collector):
+    with metricsLock:
+        collectors.append(collector)
+
+def formatLabels(labelKey, extraLabels = ()):
+    labelPairs = list(labelKey) + list(extraLabels)
+    if len(labelPairs) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (name, value) in labelPairs])
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+#Returns every metric in the Prometheus text exposition format
+def renderMetrics(logger = None):
+    for collector in list(collectors):
+        try:
+            collector()
+        except Exception, errorString:
+            if logger is not None:
+                logger.error('Metrics collector %s: %s' % (getattr(collector, '__name__', collector), errorString))
+    lines = []
+    with metricsLock:
+        for name in sorted(metricValues.keys()):
+            metricType, helpText, buckets = metricDescriptions.get(name, ['untyped', None, defaultBuckets])
+            if helpText:
+                lines.append('# HELP %s %s' % (name, helpText))
+            lines.append('# TYPE %s %s' % (name, metricType))
+            for labelKey, value in sorted(metricValues[name].items()):
+                if metricType == 'histogram':
+                    bucketCounts, count, total = value
+                    for bound, bucketCount in zip(buckets, bucketCounts):
+                        lines.append('%s_bucket%s %s' % (name, formatLabels(labelKey, [('le', formatValue(float(bound)))]), bucketCount))
+                    lines.append('%s_bucket%s %s' % (name, formatLabels(labelKey, [('le', '+Inf')]), count))
+                    lines.append('%s_sum%s %s' % (name, formatLabels(labelKey), formatValue(float(total))))
+                    lines.append('%s_count%s %s' % (name, formatLabels(labelKey), count))
+                else:
+                    lines.append('%s%s %s' % (name, formatLabels(labelKey), formatValue(value)))
+    return '\n'.join(lines) + '\n'
+
+#Writes the metrics to a file, replaced at once so a reader never sees it half written
+def writeMetricsFile(metricsFile, logger = None):
+    temporaryFile = '%s.%s.tmp' % (metricsFile, os.getpid())
+    with open(temporaryFile, 'w') as output:
+        output.write(renderMetrics(logger))
+    os.rename(temporaryFile, metricsFile)
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = renderMetrics(self.server.logger)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    #Scrapes are not logged
+    def log_message(self, format, *arguments):
+        pass
+
+#HTTP endpoint serving the metrics, on its own daemon thread.
+class MetricsServer(threading.Thread):
+
+    def __init__(self, port, logger, address = '127.0.0.1'):
+        threading.Thread.__init__(self, name = 'metricsServer')
+        self.daemon = True
+        self.httpServer = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+        self.httpServer.logger = logger
+
+    def run(self):
+        self.httpServer.serve_forever()
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+##
+## Event driven task scheduler for AutoBRM.
+##  Source : AutoBRM procedures (merge, dispatch, scan, watchdog, LOS sensing).
+##  Destination : One long-lived thread per procedure, run every interval or as soon as it is triggered.
+##
+## A task runs when its interval elapses or when another task triggers it (a scan completing triggers the merge,
+## a bitstream request completing triggers the dispatch). Triggers coming while the task runs are coalesced into one more run.
+## Tasks block on their own thread only, so a long Meex or ssh call doesn't delay the other tasks.
+##
+
+import threading
+
+#A procedure run periodically, or on trigger, on its own thread.
+class PeriodicTask(threading.Thread):
+
+    def __init__(self, name, function, interval, logger, isTriggerable = True):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.function = function
+        self.interval = interval
+        self.logger = logger
+        self.isTriggerable = isTriggerable
+        self.wakeEvent = threading.Event()
+        self.isStopped = False
+
+    #Runs the task as soon as possible. Ignored by tasks which must keep their period (watchdog counting cycles).
+    def trigger(self):
+        if self.isTriggerable:
+            self.wakeEvent.set()
+
+    def stop(self):
+        self.isStopped = True
+        self.wakeEvent.set()
+
+    def run(self):
+        while not self.isStopped:
+            try:
+                self.function()
+            except Exception, errorString:
+                self.logger.error('%s: %s' % (self.name, errorString))
+            self.wakeEvent.wait(self.interval)
+            self.wakeEvent.clear()
+
+#Set of named periodic tasks.
+class Scheduler(object):
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.tasks = {}
+
+    def addTask(self, name, function, interval, isTriggerable = True):
+        self.tasks[name] = PeriodicTask(name, function, interval, self.logger, isTriggerable)
+
+    def start(self):
+        for task in self.tasks.values():
+            task.start()
+
+    #Runs the named task as soon as possible
+    def trigger(self, name):
+        if name in self.tasks:
+            self.tasks[name].trigger()
+
+    def isRunning(self):
+        return any([task.isAlive() for task in self.tasks.values()])
+
+    #Stops the tasks, waiting up to timeout seconds for each one to finish its current run
+    def stop(self, timeout = 1):
+        for task in self.tasks.values():
+            task.stop()
+        for task in self.tasks.values():
+            if task.isAlive():
+                task.join(timeout)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+##
+## Schema and migrations of the AutoBRM database.
+##  Source : AutoBRM database file, at any former schema version (PRAGMA user_version, 0 for databases made by hand).
+##  Destination : AutoBRM database file at the latest schema version.
+##
+## Every migration only adds what is missing, so it can be applied to a database created before the migrations existed.
+## The hot queries list mirrors the statements AutoBRM issues in its loops; checkQueryPlans reports those falling back to a full table scan.
+##
+## Usage: autobrmSchema.py [--upgrade] [--check] database
+##
+
+import re
+import sys
+import argparse
+import sqlite3
+
+#Returns a migration step adding a column to a table, unless the table has it already: SQLite has no ADD COLUMN IF NOT EXISTS.
+def addMissingColumn(tableName, columnName, columnDefinition):
+    def addColumn(dbCur):
+        dbCur.execute('PRAGMA table_info(%s);' % tableName)
+        if columnName.lower() not in [str(row[1]).lower() for row in dbCur.fetchall()]:
+            dbCur.execute('ALTER TABLE %s ADD COLUMN %s %s;' % (tableName, columnName, columnDefinition))
+    return addColumn
+
+#Returns a migration step creating a table of the assumed base schema and running its seed statements, unless the table exists.
+#An existing table is kept as it is, it is only checked for the columns AutoBRM queries: a missing one fails the migration instead of the first query using it.
+def createMissingTable(tableName, columnDefinitions, seedStatements = ()):
+    def createTable(dbCur):
+        dbCur.execute('PRAGMA table_info(%s);' % tableName)
+        columnNames = [str(row[1]).lower() for row in dbCur.fetchall()]
+        if len(columnNames) == 0:
+            dbCur.execute('CREATE TABLE %s (%s);' % (tableName, ', '.join(columnDefinitions)))
+            for statement in seedStatements:
+                dbCur.execute(statement)
+        else:
+            missingColumns = [definition.split()[0] for definition in columnDefinitions if definition.split()[0].lower() not in columnNames]
+            if len(missingColumns) > 0:
+                raise sqlite3.OperationalError('table %s has no column %s' % (tableName, ', '.join(missingColumns)))
+    return createTable
+
+#Version 1 - Assumed base schema: the tables, columns and view the AutoBRM, LOS filler, benchmark and simulator queries use, nothing more.
+#The schema of the production database is not part of this repository. Its tables are kept as they are (see createMissingTable), and so is its next_replay_in_queue view.
+#The view created here, on a new database only, orders the replays by priority then id.
+baseSchemaStatements = [
+    createMissingTable('variable', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'name TEXT', 'value TEXT']),
+    #Replay workflow of a new database: the function name is the AutoBRM procedure run for a replay in that state
+    createMissingTable('replay_status', ['id INTEGER PRIMARY KEY', 'name TEXT', 'workflow INTEGER', 'function_name TEXT'], [
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (1, "NEW", 10, "processReplayBrmRT");',
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (2, "RT_REQUESTED", 20, NULL);',
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (3, "RT_DONE", 30, "processReplayBrmExtPB");',
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (4, "PB_REQUESTED", 40, NULL);',
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (5, "DONE", 50, NULL);',
+        'INSERT INTO replay_status (id, name, workflow, function_name) VALUES (6, "FAILED", 90, NULL);',
+    ]),
+    createMissingTable('replay', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'startdate DATETIME', 'enddate DATETIME', 'priority INTEGER DEFAULT 0']),
+    createMissingTable('replay_job', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'text TEXT', 'replay_id INTEGER', 'replay_status_id INTEGER']),
+    createMissingTable('hrd_packet_gap', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'last_sequence_count INTEGER', 'last_timestamp DATETIME', \
+    'next_sequence_count INTEGER', 'next_timestamp DATETIME', 'is_checked INTEGER DEFAULT 0', 'chanel TEXT']),
+    createMissingTable('gap_replay_list', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'replay_id INTEGER', 'hrd_packet_gap_id INTEGER']),
+    createMissingTable('vmu_record', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'phase TEXT', 'recordname TEXT', 'source INTEGER']),
+    createMissingTable('vmu_packet_gap', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'last_sequence_count INTEGER', 'last_timestamp DATETIME', \
+    'next_sequence_count INTEGER', 'next_timestamp DATETIME', 'is_checked INTEGER DEFAULT 0', 'vmu_record_id INTEGER', 'hrd_packet_gap_id INTEGER']),
+    createMissingTable('data_source', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'name TEXT']),
+    createMissingTable('vmu_packet_count', ['id INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp DATETIME', 'data_source_id INTEGER', 'vmu_record_id INTEGER', 'count INTEGER']),
+    'CREATE VIEW IF NOT EXISTS next_replay_in_queue AS SELECT rj.replay_id AS replayID, rs.name AS replayStatus, rs.function_name AS functionName FROM replay_job rj \
+    JOIN replay_status rs ON rs.id = rj.replay_status_id JOIN replay r ON r.id = rj.replay_id \
+    WHERE rj.id = (SELECT MAX(id) FROM replay_job WHERE replay_id = rj.replay_id) AND rs.function_name IS NOT NULL ORDER BY r.priority DESC, r.id ASC;',
+]
+
+#Version 2 - Tables formerly created on the fly: scan manifest (incremental scans, a fingerprint per day folder: file count, total size, latest modification time,
+#with the day status and its packet counts) and variable table change counter (variable cache)
+bookkeepingStatements = [
+    'CREATE TABLE IF NOT EXISTS scan_manifest (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, folder TEXT NOT NULL, scan_type TEXT NOT NULL, \
+    file_count INTEGER, total_size INTEGER, latest_mtime INTEGER, status TEXT, day_counts TEXT, UNIQUE (folder, scan_type));',
+    'CREATE TABLE IF NOT EXISTS variable_change (id INTEGER PRIMARY KEY CHECK (id = 1), counter INTEGER NOT NULL);',
+    'INSERT OR IGNORE INTO variable_change (id, counter) VALUES (1, 0);',
+    'CREATE TRIGGER IF NOT EXISTS variable_change_insert AFTER INSERT ON variable BEGIN UPDATE variable_change SET counter = counter + 1 WHERE id = 1; END;',
+    'CREATE TRIGGER IF NOT EXISTS variable_change_update AFTER UPDATE ON variable BEGIN UPDATE variable_change SET counter = counter + 1 WHERE id = 1; END;',
+    'CREATE TRIGGER IF NOT EXISTS variable_change_delete AFTER DELETE ON variable BEGIN UPDATE variable_change SET counter = counter + 1 WHERE id = 1; END;',
+]
+
+#Version 3 - Covering indexes of the hot queries. Text lookups compare with COLLATE NOCASE, as the former LIKE did.
+hotQueryIndexStatements = [
+    #Unchecked gaps per channel and containing gap lookups
+    'CREATE INDEX IF NOT EXISTS hrd_packet_gap_unchecked ON hrd_packet_gap (is_checked, chanel, last_sequence_count, next_sequence_count, last_timestamp, next_timestamp);',
+    #Latest job of a replay: replay_id = ? ORDER BY id DESC
+    'CREATE INDEX IF NOT EXISTS replay_job_replay ON replay_job (replay_id, id, replay_status_id);',
+    #Replay windows matched on their bounds
+    'CREATE INDEX IF NOT EXISTS replay_dates ON replay (startdate, enddate);',
+    'CREATE INDEX IF NOT EXISTS vmu_record_lookup ON vmu_record (phase COLLATE NOCASE, recordname COLLATE NOCASE, source);',
+    'CREATE INDEX IF NOT EXISTS data_source_name ON data_source (name COLLATE NOCASE);',
+    'CREATE INDEX IF NOT EXISTS variable_name ON variable (name COLLATE NOCASE);',
+    #Time of the last scan: MAX(timestamp)
+    'CREATE INDEX IF NOT EXISTS vmu_packet_gap_timestamp ON vmu_packet_gap (timestamp);',
+    'CREATE INDEX IF NOT EXISTS gap_replay_list_replay ON gap_replay_list (replay_id);',
+    'CREATE INDEX IF NOT EXISTS gap_replay_list_gap ON gap_replay_list (hrd_packet_gap_id);',
+]
+
+#Version 4 - Current replay status kept on the replay table, so the NEW replays are an index range instead of a latest job lookup per replay.
+#Triggers keep it in line with the latest replay_job entry, whoever writes the job (AutoBRM, LOS filler, web site). replay_job keeps the full history.
+currentReplayStatusStatements = [
+    addMissingColumn('replay', 'replay_status_id', 'INTEGER REFERENCES replay_status(id)'),
+    'UPDATE replay SET replay_status_id = (SELECT replay_status_id FROM replay_job WHERE replay_id = replay.id ORDER BY id DESC LIMIT 1);',
+    'CREATE TRIGGER IF NOT EXISTS replay_job_status_insert AFTER INSERT ON replay_job BEGIN \
+    UPDATE replay SET replay_status_id = (SELECT replay_status_id FROM replay_job WHERE replay_id = NEW.replay_id ORDER BY id DESC LIMIT 1) WHERE id = NEW.replay_id; END;',
+    'CREATE TRIGGER IF NOT EXISTS replay_job_status_update AFTER UPDATE OF replay_id, replay_status_id ON replay_job BEGIN \
+    UPDATE replay SET replay_status_id = (SELECT replay_status_id FROM replay_job WHERE replay_id = replay.id ORDER BY id DESC LIMIT 1) WHERE id IN (OLD.replay_id, NEW.replay_id); END;',
+    'CREATE TRIGGER IF NOT EXISTS replay_job_status_delete AFTER DELETE ON replay_job BEGIN \
+    UPDATE replay SET replay_status_id = (SELECT replay_status_id FROM replay_job WHERE replay_id = OLD.replay_id ORDER BY id DESC LIMIT 1) WHERE id = OLD.replay_id; END;',
+    'CREATE INDEX IF NOT EXISTS replay_current_status ON replay (replay_status_id, startdate, enddate);',
+    #Columns of latest_replay_status, read from the current status. The existing views are left as they are: next_replay_in_queue holds the dispatch order and filter of the site.
+    'CREATE VIEW IF NOT EXISTS current_replay_status AS SELECT r.id AS replayID, rs.name AS replayStatus, rs.function_name AS functionName FROM replay r \
+    JOIN replay_status rs ON rs.id = r.replay_status_id;',
+]
+
+#Version 5 - Final state of the NEW replay items packed into another one (see replayPacking), after every other state so no workflow step leads to it.
+replayPackingStatements = [
+    'INSERT INTO replay_status (name, workflow, function_name) SELECT "MERGED", (SELECT COALESCE(MAX(workflow), 0) FROM replay_status) + 10, NULL \
+    WHERE NOT EXISTS (SELECT 1 FROM replay_status WHERE name = "MERGED" COLLATE NOCASE);',
+]
+
+#Version 6 - Final state of the replay items given up by the deadline aware scheduler (see replayScheduler): their data left the Col-CC buffer before they could be replayed.
+replayExpiryStatements = [
+    'INSERT INTO replay_status (name, workflow, function_name) SELECT "EXPIRED", (SELECT COALESCE(MAX(workflow), 0) FROM replay_status) + 10, NULL \
+    WHERE NOT EXISTS (SELECT 1 FROM replay_status WHERE name = "EXPIRED" COLLATE NOCASE);',
+]
+
+#Version 7 - LOS windows detected by autoLosSensingReplayFiller, kept across restarts until their replay request is due: the end and due datetimes
+#are set when the LOS ends (open LOS window until then), the due datetime being gap_request_delay_in_hours after the end.
+pendingLosStatements = [
+    'CREATE TABLE IF NOT EXISTS pending_los (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, startdate DATETIME, enddate DATETIME, due_date DATETIME);',
+    'CREATE INDEX IF NOT EXISTS pending_los_due ON pending_los (due_date);',
+]
+
+#Migrations in version order: the database user_version is the number of migrations applied. A step is an SQL statement, or a function given the migration cursor.
+migrations = [
+    baseSchemaStatements,
+    bookkeepingStatements,
+    hotQueryIndexStatements,
+    currentReplayStatusStatements,
+    replayPackingStatements,
+    replayExpiryStatements,
+    pendingLosStatements,
+]
+
+#Queries AutoBRM issues in its loops, with sample parameters
+hotQueries = [
+    ['unchecked gap items', 'SELECT id, last_timestamp, next_timestamp, chanel FROM hrd_packet_gap WHERE is_checked = 0 ORDER BY id;', ()],
+    ['unchecked gaps of a channel', 'SELECT id, chanel, last_sequence_count, next_sequence_count, last_timestamp, next_timestamp FROM hrd_packet_gap WHERE is_checked = 0 ORDER BY id;', ()],
+    ['containing gap', 'SELECT id FROM hrd_packet_gap WHERE is_checked = 0 AND chanel = ? AND (last_sequence_count >= ? AND next_sequence_count <= ?) AND (last_timestamp >= ? AND next_timestamp <= ?);', ('lrsd', 1, 2, '2023-01-01 00:00:00', '2023-01-01 00:00:01')],
+    ['latest replay job', 'SELECT id, replay_status_id FROM replay_job WHERE replay_id = ? order by id desc limit 1;', (1,)],
+    ['NEW replay windows', 'SELECT id, startdate, enddate FROM replay WHERE replay_status_id IN (SELECT id FROM replay_status WHERE name = "NEW" COLLATE NOCASE) ORDER BY id;', ()],
+    ['NEW replay window match', 'SELECT id FROM replay WHERE startdate >= ? AND enddate <= ? AND replay_status_id IN (SELECT id FROM replay_status WHERE name = "NEW" COLLATE NOCASE);', ('2023-01-01 00:00:00', '2023-01-01 00:00:01')],
+    ['next replay in queue', 'SELECT replayID, replayStatus, functionName FROM next_replay_in_queue LIMIT 1;', ()],
+    ['queued replay windows', 'SELECT r.id, rs.name, rs.function_name, r.priority, strftime("%s",r.startdate), strftime("%s",r.enddate) FROM replay_status rs \
+    CROSS JOIN replay r ON r.replay_status_id = rs.id WHERE rs.function_name IS NOT NULL;', ()],
+    ['replay details', 'SELECT startdate, enddate FROM replay WHERE id = ?;', (1,)],
+    ['vmu record', 'SELECT id FROM vmu_record WHERE phase = ? COLLATE NOCASE AND recordname = ? COLLATE NOCASE AND source = ?;', ('phase', 'record', 33)],
+    ['data source', 'SELECT id FROM data_source WHERE name = ? COLLATE NOCASE;', ('source',)],
+    ['variable', 'SELECT id FROM variable WHERE name = ? COLLATE NOCASE;', ('scan_mode',)],
+    ['last scan time', 'SELECT MAX(timestamp) FROM vmu_packet_gap;', ()],
+    ['due LOS windows', 'SELECT id, startdate, enddate FROM pending_los WHERE due_date <= ? ORDER BY due_date;', ('2023-01-01 00:00:00.000000',)],
+]
+
+#Tables small enough by design to be scanned, and the aliases the hot queries and views give them (SQLite 3.36 and later only print the alias)
+smallTables = ['replay_status', 'rs', 'variable_change', 'scan_manifest']
+
+#Returns the database schema version.
+def getSchemaVersion(dbCon):
+    return dbCon.execute('PRAGMA user_version;').fetchall()[0][0]
+
+#Applies the missing migrations, each one within its own transaction. Returns the versions applied.
+def upgradeDatabase(dbCon):
+    appliedVersions = []
+    for version in range(getSchemaVersion(dbCon) + 1, len(migrations) + 1):
+        dbCur = dbCon.cursor()
+        dbCur.execute('BEGIN IMMEDIATE;')
+        try:
+            for statement in migrations[version - 1]:
+                if callable(statement):
+                    statement(dbCur)
+                else:
+                    dbCur.execute(statement)
+            dbCur.execute('PRAGMA user_version = %s;' % version)
+            dbCur.execute('COMMIT;')
+        except Exception:
+            dbCur.execute('ROLLBACK;')
+            dbCur.close()
+            raise
+        dbCur.close()
+        appliedVersions.append(version)
+    return appliedVersions
+
+fullScanPattern = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+
+#Returns the hot queries falling back to a full table scan: [name, plan detail] for each full scan step. Queries which can't be planned (missing table) are returned with the error.
+def checkQueryPlans(dbCon):
+    fullScans = []
+    for name, queryStatement, queryParameters in hotQueries:
+        try:
+            queryPlan = dbCon.execute('EXPLAIN QUERY PLAN %s' % queryStatement, queryParameters).fetchall()
+        except sqlite3.Error, errorString:
+            fullScans.append([name, str(errorString)])
+            continue
+        for row in queryPlan:
+            detail = str(row[-1])
+            fullScan = fullScanPattern.match(detail)
+            if fullScan is not None and not (set(fullScan.groups()) & set(smallTables)):
+                fullScans.append([name, detail])
+    return fullScans
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Creates or upgrades the AutoBRM database and checks the hot query plans.')
+    parser.add_argument('database', help = 'AutoBRM database file')
+    parser.add_argument('--upgrade', action = 'store_true', help = 'apply the missing migrations')
+    parser.add_argument('--check', action = 'store_true', help = 'fail if a hot query does a full table scan')
+    args = parser.parse_args(argv)
+
+    dbCon = sqlite3.connect(args.database, timeout=10, isolation_level=None) #AutoCommit is enabled
+    dbCon.execute("PRAGMA foreign_keys = 1") #Foreign key constraints are enabled
+    if args.upgrade:
+        for version in upgradeDatabase(dbCon):
+            print 'Applied migration %s' % version
+    print 'Schema version %s of %s' % (getSchemaVersion(dbCon), len(migrations))
+    returnCode = 0
+    if args.check:
+        fullScans = checkQueryPlans(dbCon)
+        for name, detail in fullScans:
+            print 'Query plan check failed for %s: %s' % (name, detail)
+        if len(fullScans) > 0:
+            returnCode = 1
+        else:
+            print 'No full table scan in %s hot queries' % len(hotQueries)
+    dbCon.close()
+    return returnCode
+
+if __name__ == '__main__':
+    sys.exit(main())
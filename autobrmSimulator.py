@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+##
+## Accelerated replay of the AutoBRM pipeline on a virtual clock, for capacity planning.
+##  Source : Recorded Meex 'list -e -k vmu' listings (one per day folder) or synthetic days (see autobrmBenchmark.generateListing),
+##           on a copy of an AutoBRM database snapshot or on a new database.
+##  Destination : Queue depth samples over the virtual time, then a summary (replay latencies, data lost to the Col-CC buffer),
+##                as JSON lines on standard output or in a file. The summary is also written on standard error.
+##
+## The stages are the AutoBRM ones, run in one thread on the virtual clock:
+##  scan     : each listing is checked and ingested (ingestGapItems) when its day folder would be scanned, its last packet time
+##             plus the scan delay, then merged and packed (insertHrdGapItem2ReplayList)
+##  dispatch : after every event the queue is walked as issueReplayFromReplayList does (getQueuedReplayItems: deadline order and
+##             expiry, or the next_replay_in_queue order with replay_scheduler set to fifo), within the per DaSS source and bitrate
+##             limits, and the replay items are claimed (claimReplayItem)
+##  request  : bitstreamClient is not run. A request lasts the request overhead plus the window length times the replay ratio
+##             (recorded bitrate over bitstream request bitrate), then moves its replay item on as processReplayBrm does
+## The scheduler reads the virtual clock instead of the database one (getDatabaseEpoch), and the clock jumps from event to event:
+## days of operations take seconds to minutes.
+## A replay item is DONE after its AOS archive and LOS archive requests. Its latency runs from the merge which created it.
+## The data lost is the window of the EXPIRED replay items, and the part of a window already out of the buffer when its request starts.
+##
+## autobrmSimulator.py --listing day1.txt day2.txt --database autobrm.db --outage-hours 48
+## autobrmSimulator.py --days 7 --gap-factor 3 --sample-minutes 30 --output simulation.json
+##
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import shutil
+import logging
+import sqlite3
+import argparse
+import calendar
+import tempfile
+from collections import deque
+from datetime import datetime, timedelta
+import autobrmSchema
+import autobrmBenchmark
+import sqchk
+
+#Events of the virtual clock, handled in this order when they fall on the same second
+scanEvent, requestEndEvent, outageEndEvent, sampleEvent = range(4)
+
+#Returns the seconds since epoch of a Meex listing datetime (2023-01-01 00:00:00.000)
+def getListingEpoch(value):
+    return calendar.timegm(datetime.strptime(value.strip()[:19], '%Y-%m-%d %H:%M:%S').timetuple())
+
+def formatEpoch(epoch):
+    return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+#Returns [first packet epoch, last packet epoch] of a listing, None if it has no packet line
+def getListingPeriod(listingFile):
+    firstEpoch = None
+    lastLines = deque(maxlen = 100)
+    with open(listingFile) as listing:
+        for line in listing:
+            if firstEpoch is None:
+                fields = sqchk.fieldSeparator.split(line.rstrip('\n'))
+                if len(fields) >= 11:
+                    firstEpoch = getListingEpoch(fields[2])
+            lastLines.append(line)
+    for line in reversed(lastLines):
+        fields = sqchk.fieldSeparator.split(line.rstrip('\n'))
+        if len(fields) >= 11:
+            return [firstEpoch, getListingEpoch(fields[2])]
+    return None
+
+#Writes the synthetic listings of dayCount days, the gap rate multiplied by gapFactor. Returns their files.
+def writeSyntheticDays(workDirectory, dayCount, gapFactor, arguments):
+    listingFiles = []
+    packetsPerDay = 86400 * 1000 / arguments.packet_interval_ms
+    packetsPerGap = max(int(arguments.packets_per_gap / gapFactor), 1)
+    for day in range(dayCount):
+        listingFile = os.path.join(workDirectory, 'listing_%03d.txt' % day)
+        with open(listingFile, 'w') as listing:
+            autobrmBenchmark.generateListing(listing, max(packetsPerDay / packetsPerGap, 1), arguments.channels, arguments.origins, packetsPerGap, \
+            arguments.packet_interval_ms, arguments.max_gap_packets, arguments.bad_run_every, arguments.bad_run_length, arguments.seed + day, \
+            autobrmBenchmark.listingStartDate + timedelta(days = day))
+        listingFiles.append(listingFile)
+    return listingFiles
+
+#Simulation state: virtual clock, event queue, running requests and the replay item figures.
+class Simulation(object):
+
+    def __init__(self, autobrm, startEpoch, outageEndEpoch, failureRate, seed):
+        self.autobrm = autobrm
+        self.now = startEpoch
+        self.startEpoch = startEpoch
+        self.outageEndEpoch = outageEndEpoch
+        self.failureRate = failureRate
+        self.randomGenerator = random.Random(seed)
+        self.events = []
+        self.eventCount = 0
+        #Running requests per replay item ID: DaSS source and bitrate
+        self.requests = {}
+        #Per replay item ID: virtual creation epoch, DONE epoch, seconds of its window lost
+        self.createdEpochs = {}
+        self.doneEpochs = {}
+        self.lostSeconds = {}
+        self.lastReplayID = 0
+        self.requestCount = 0
+        self.failedRequestCount = 0
+
+    def addEvent(self, epoch, eventType, payload = None):
+        self.eventCount += 1
+        heapq.heappush(self.events, (epoch, eventType, self.eventCount, payload))
+
+    #Pending events other than the samples
+    def hasWork(self):
+        return len([event for event in self.events if event[1] != sampleEvent]) > 0
+
+    #Ingests a day listing and merges its gaps, as the scan and merge tasks do
+    def scanListing(self, dbCon, listingFile):
+        autobrm = self.autobrm
+        with open(listingFile) as listing:
+            autobrm.ingestGapItems(dbCon, autobrm.iterSequenceCheckItems(listing, listingFile, autobrm.getSequenceCheckModule(dbCon)), listingFile)
+        autobrm.insertHrdGapItem2ReplayList()
+        for row in dbCon.execute('SELECT id FROM replay WHERE id > ? ORDER BY id;', (self.lastReplayID,)).fetchall():
+            self.createdEpochs[row[0]] = self.now
+            self.lastReplayID = row[0]
+
+    #Starts the requests the dispatch would start now. Same limits as issueReplayFromReplayList.
+    def dispatch(self, dbCon):
+        autobrm = self.autobrm
+        if self.now < self.outageEndEpoch:
+            return
+        bitrate = autobrm.getVariableValue(dbCon, 'bitstreamrequest_bitrate')
+        if not isinstance(bitrate, int): bitrate = 0
+        bitrateBudget = autobrm.getVariableValue(dbCon, 'bitstreamrequest_bitrate_budget')
+        if not isinstance(bitrateBudget, int): bitrateBudget = bitrate
+        usedBitrate = sum([request['bitrate'] for request in self.requests.values()])
+        sourceRequestCount = {}
+        for request in self.requests.values():
+            sourceRequestCount[request['source']] = sourceRequestCount.get(request['source'], 0) + 1
+        bufferSeconds = self.getBufferSeconds(dbCon)
+        replayRatio = autobrm.getReplayRatio(dbCon)
+        overheadSeconds = autobrm.getRequestOverheadSeconds(dbCon)
+
+        for replayItemID, replayItemState, replayItemFunctionName in autobrm.getQueuedReplayItems(dbCon, autobrm.bitstreamRequestQueueLookahead):
+            if usedBitrate + bitrate > bitrateBudget:
+                break
+            if replayItemID in self.requests or not hasattr(autobrm, replayItemFunctionName):
+                continue
+            source = autobrm.bitstreamRequestSources.get(replayItemFunctionName, replayItemFunctionName)
+            if sourceRequestCount.get(source, 0) >= autobrm.getBitstreamRequestLimit(dbCon, source):
+                continue
+            if not autobrm.claimReplayItem(dbCon, replayItemID, replayItemState):
+                continue
+            startEpoch, endEpoch = [int(value) for value in dbCon.execute('SELECT strftime("%s",startdate), strftime("%s",enddate) FROM replay WHERE id = ?;', \
+            (replayItemID,)).fetchall()[0]]
+            #Data of the window already out of the Col-CC buffer
+            lostSeconds = max(min(endEpoch, self.now - bufferSeconds) - startEpoch, 0)
+            if lostSeconds > 0:
+                self.lostSeconds[replayItemID] = max(self.lostSeconds.get(replayItemID, 0), lostSeconds)
+            self.requests[replayItemID] = {'source': source, 'bitrate': bitrate}
+            self.addEvent(self.now + overheadSeconds + max(endEpoch - startEpoch, 0) * replayRatio, requestEndEvent, replayItemID)
+            self.requestCount += 1
+            usedBitrate += bitrate
+            sourceRequestCount[source] = sourceRequestCount.get(source, 0) + 1
+
+    #Ends a request: next workflow state, or FAILED, as processReplayBrm does
+    def endRequest(self, dbCon, replayItemID):
+        request = self.requests.pop(replayItemID)
+        if self.randomGenerator.random() < self.failureRate:
+            self.failedRequestCount += 1
+            self.autobrm.setReplayItemState(dbCon, replayItemID, 'FAILED', 'Simulated bitstreamClient failure (%s)' % request['source'])
+            return
+        self.autobrm.incrementReplayItemState(dbCon, replayItemID)
+        if dbCon.execute('SELECT replayStatus FROM current_replay_status WHERE replayID = ?;', (replayItemID,)).fetchall()[0][0] == 'DONE':
+            self.doneEpochs[replayItemID] = self.now
+
+    def getBufferSeconds(self, dbCon):
+        bufferHours = self.autobrm.getVariableValue(dbCon, 'replay_buffer_hours')
+        return (bufferHours if isinstance(bufferHours, int) else self.autobrm.replayBufferHours) * 3600
+
+    #Returns the queue depth sample of the virtual time
+    def sample(self, dbCon):
+        stateCounts = dict(dbCon.execute('SELECT rs.name, COUNT(*) FROM replay r JOIN replay_status rs ON rs.id = r.replay_status_id GROUP BY rs.name;').fetchall())
+        queued = dbCon.execute('SELECT COUNT(*) FROM replay_status rs CROSS JOIN replay r ON r.replay_status_id = rs.id WHERE rs.function_name IS NOT NULL;').fetchall()[0][0]
+        return {'type': 'sample', 'time': formatEpoch(self.now), 'hours': round((self.now - self.startEpoch) / 3600.0, 3), 'queued': queued, \
+        'running': len(self.requests), 'states': stateCounts}
+
+    #Returns the summary of the simulation
+    def summary(self, dbCon, wallSeconds):
+        latencies = sorted([self.doneEpochs[replayItemID] - self.createdEpochs[replayItemID] for replayItemID in self.doneEpochs if replayItemID in self.createdEpochs])
+        expiredWindows = dbCon.execute('SELECT r.id, strftime("%s",r.enddate) - strftime("%s",r.startdate) FROM replay r JOIN replay_status rs ON rs.id = r.replay_status_id \
+        WHERE rs.name = "EXPIRED";').fetchall()
+        lostSeconds = dict(self.lostSeconds)
+        for replayItemID, windowSeconds in expiredWindows:
+            lostSeconds[replayItemID] = windowSeconds
+        virtualSeconds = self.now - self.startEpoch
+        return {'type': 'summary', 'start': formatEpoch(self.startEpoch), 'end': formatEpoch(self.now), 'virtualHours': round(virtualSeconds / 3600.0, 3), \
+        'wallSeconds': round(wallSeconds, 3), 'speedup': round(virtualSeconds / max(wallSeconds, 0.001), 1), 'replayItems': len(self.createdEpochs), \
+        'requests': self.requestCount, 'failedRequests': self.failedRequestCount, 'done': len(self.doneEpochs), 'expired': len(expiredWindows), \
+        'latencyHours': dict([(name, round(getPercentile(latencies, fraction) / 3600.0, 3)) for (name, fraction) in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]]), \
+        'lostReplayItems': len(lostSeconds), 'lostHours': round(sum(lostSeconds.values()) / 3600.0, 3)}
+
+#Returns the value at the fraction of sorted values, 0 if there are none
+def getPercentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+#Runs the simulation of the listings. Yields the samples, then the summary.
+def simulate(autobrm, listingFiles, arguments):
+    dbCon = autobrm.dbConnectToDatabase()
+    #Scan time of each listing: its last packet plus the scan delay
+    scans = []
+    for listingFile in listingFiles:
+        period = getListingPeriod(listingFile)
+        if period is None:
+            sys.stderr.write('%s: no packet line, skipped\n' % listingFile)
+            continue
+        scans.append([period[0], period[1] + arguments.scan_delay_minutes * 60, listingFile])
+    if len(scans) == 0:
+        return
+    startEpoch = min([firstEpoch for (firstEpoch, scanEpoch, listingFile) in scans])
+    simulation = Simulation(autobrm, startEpoch, startEpoch + int(arguments.outage_hours * 3600), arguments.failure_rate, arguments.seed)
+    for firstEpoch, scanEpoch, listingFile in scans:
+        simulation.addEvent(scanEpoch, scanEvent, listingFile)
+    if simulation.outageEndEpoch > startEpoch:
+        simulation.addEvent(simulation.outageEndEpoch, outageEndEvent)
+    simulation.addEvent(startEpoch, sampleEvent)
+    endEpoch = startEpoch + arguments.max_hours * 3600 if arguments.max_hours else None
+    #The scheduler reads the virtual clock
+    autobrm.getDatabaseEpoch = lambda dbCon: int(simulation.now)
+    wallStartTime = time.time()
+    sampleEpoch = None
+
+    while simulation.events:
+        epoch, eventType, eventCount, payload = heapq.heappop(simulation.events)
+        if endEpoch is not None and epoch > endEpoch:
+            break
+        simulation.now = epoch
+        if eventType == sampleEvent:
+            sampleEpoch = epoch
+            yield simulation.sample(dbCon)
+            #Samples go on while there is work left
+            if simulation.hasWork():
+                simulation.addEvent(epoch + arguments.sample_minutes * 60, sampleEvent)
+            continue
+        if eventType == scanEvent:
+            simulation.scanListing(dbCon, payload)
+        elif eventType == requestEndEvent:
+            simulation.endRequest(dbCon, payload)
+        simulation.dispatch(dbCon)
+
+    if sampleEpoch != simulation.now:
+        yield simulation.sample(dbCon)
+    yield simulation.summary(dbCon, time.time() - wallStartTime)
+
+#Creates the simulation database: a copy of the snapshot upgraded to the current schema, or a new one. The arguments given override its variables.
+def createDatabase(databaseFile, snapshotFile, arguments, sources):
+    if snapshotFile:
+        shutil.copyfile(snapshotFile, databaseFile)
+    dbCon = sqlite3.connect(databaseFile, timeout=10, isolation_level=None)
+    autobrmSchema.upgradeDatabase(dbCon)
+    variables = [['scan_incremental', 'off']]
+    if not snapshotFile:
+        variables.append(['bitstreamrequest_bitrate', '2000000'])
+    for name, value in [['bitstreamrequest_bitrate', arguments.bitrate], ['hrd_recorded_bitrate', arguments.recorded_bitrate], \
+    ['bitstreamrequest_bitrate_budget', arguments.bitrate_budget], ['replay_buffer_hours', arguments.buffer_hours], ['replay_scheduler', arguments.scheduler], \
+    ['replay_packing', arguments.packing], ['scan_gap_detector', arguments.gap_detector]]:
+        if value is not None:
+            variables.append([name, str(value)])
+    if arguments.concurrency is not None:
+        for source in sorted(set(sources)):
+            variables.append(['bitstreamrequest_concurrency_%s' % source.lower(), str(arguments.concurrency)])
+    for name, value in variables:
+        if dbCon.execute('SELECT id FROM variable WHERE name = ? COLLATE NOCASE;', (name,)).fetchall():
+            dbCon.execute('UPDATE variable SET value = ? WHERE name = ? COLLATE NOCASE;', (value, name))
+        else:
+            dbCon.execute('INSERT INTO variable (name, value) VALUES (?, ?);', (name, value))
+    dbCon.close()
+
+def main(argv = None):
+    scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description = 'Runs the AutoBRM scan, merge and dispatch on a virtual clock, bitstreamClient simulated.')
+    parser.add_argument('--listing', nargs = '+', help = 'recorded Meex "list -e -k vmu" listings, one per day folder')
+    parser.add_argument('--database', help = 'AutoBRM database snapshot, copied (the snapshot is not changed)')
+    parser.add_argument('--days', type = int, default = 3, help = 'synthetic days simulated when no listing is given')
+    parser.add_argument('--gap-factor', type = float, default = 1.0, help = 'gap rate of the synthetic days, as a multiple of --packets-per-gap')
+    parser.add_argument('--channels', nargs = '+', default = list(sqchk.channelNames), choices = sqchk.channelNames)
+    parser.add_argument('--origins', nargs = '+', default = ['33', '40', '51'], help = 'HRD origins of the synthetic days')
+    parser.add_argument('--packets-per-gap', type = int, default = 2000, help = 'mean number of packets between two gaps in the synthetic days')
+    parser.add_argument('--packet-interval-ms', type = int, default = 1000, help = 'time between two packets of the synthetic days')
+    parser.add_argument('--max-gap-packets', type = int, default = 20, help = 'largest number of packets missing in a synthetic gap')
+    parser.add_argument('--bad-run-every', type = int, default = 10, help = 'one synthetic gap in this many is a corrupt packet run')
+    parser.add_argument('--bad-run-length', type = int, default = 3, help = 'corrupt packets in a synthetic run')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--scan-delay-minutes', type = int, default = 60, help = 'time between the last packet of a day and its scan')
+    parser.add_argument('--outage-hours', type = float, default = 0, help = 'no bitstream request during the first hours of the simulation')
+    parser.add_argument('--failure-rate', type = float, default = 0, help = 'fraction of the bitstream requests which fail')
+    parser.add_argument('--bitrate', type = int, help = 'bitstream request bitrate (variable bitstreamrequest_bitrate)')
+    parser.add_argument('--recorded-bitrate', type = int, help = 'HRD recorded bitrate (variable hrd_recorded_bitrate)')
+    parser.add_argument('--bitrate-budget', type = int, help = 'bitrate of all the running requests (variable bitstreamrequest_bitrate_budget)')
+    parser.add_argument('--concurrency', type = int, help = 'requests at once per DaSS source (variables bitstreamrequest_concurrency_<source>)')
+    parser.add_argument('--buffer-hours', type = int, help = 'Col-CC buffer length (variable replay_buffer_hours)')
+    parser.add_argument('--scheduler', choices = ['deadline', 'fifo'], help = 'replay order (variable replay_scheduler)')
+    parser.add_argument('--packing', choices = ['on', 'off'], help = 'replay packing (variable replay_packing)')
+    parser.add_argument('--gap-detector', choices = ['sqchk', 'vectorized'], help = 'sequence checker (variable scan_gap_detector)')
+    parser.add_argument('--sample-minutes', type = int, default = 60, help = 'virtual time between two queue depth samples')
+    parser.add_argument('--max-hours', type = float, help = 'virtual hours simulated at most')
+    parser.add_argument('--autobrm', default = os.path.join(scriptDirectory, 'autobrm_v1.5.2.py'), help = 'AutoBRM script to simulate')
+    parser.add_argument('--output', help = 'results file (JSON lines), standard output if not given')
+    arguments = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    workDirectory = tempfile.mkdtemp(prefix = 'autobrm-simulator-')
+    try:
+        listingFiles = arguments.listing or writeSyntheticDays(workDirectory, arguments.days, arguments.gap_factor, arguments)
+        databaseFile = os.path.join(workDirectory, 'autobrm.db')
+        autobrm = autobrmBenchmark.loadAutobrm(arguments.autobrm)
+        #The expired replay items are in the summary, not one warning each
+        autobrm.logger.setLevel(logging.ERROR)
+        createDatabase(databaseFile, arguments.database, arguments, autobrm.bitstreamRequestSources.values())
+        autobrm.dbDatabase = databaseFile
+
+        output = open(arguments.output, 'w') if arguments.output else sys.stdout
+        summary = None
+        for result in simulate(autobrm, listingFiles, arguments):
+            output.write(json.dumps(result, sort_keys = True) + '\n')
+            if result['type'] == 'summary':
+                summary = result
+        if arguments.output:
+            output.close()
+        autobrm.dbCloseConnection()
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors = True)
+
+    if summary is None:
+        sys.stderr.write('Nothing to simulate\n')
+        return 1
+    sys.stderr.write('%(start)s to %(end)s: %(virtualHours).1f virtual hours in %(wallSeconds).1f s (x%(speedup).0f)\n' % summary)
+    sys.stderr.write('%(replayItems)s replay items, %(requests)s requests (%(failedRequests)s failed), %(done)s done, %(expired)s expired\n' % summary)
+    sys.stderr.write('latency hours: p50 %(p50).2f, p90 %(p90).2f, p99 %(p99).2f, max %(max).2f\n' % summary['latencyHours'])
+    sys.stderr.write('data lost: %(lostHours).2f hours of %(lostReplayItems)s replay items\n' % summary)
+    return 0
+
+#main
+if __name__ == '__main__':
+    sys.exit(main())
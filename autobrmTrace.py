@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+##
+## Stage tracing and on demand profiling for AutoBRM.
+##  Source : AutoBRM stages (merge, dispatch, scans, watchdog, LOS sensing) and every SQL statement run on an AutoBRM connection.
+##  Destination : Trace log (logger autobrm.trace) with the spans slower than the threshold, and cProfile dumps of one cycle.
+##
+## A span times a named piece of work on its thread. Spans nest: a slow span is logged with the path of the spans
+## around it (cycle/merge/sql), so a slow statement is reported with the stage which ran it and its text.
+## SQL statements are traced by the connection factory given to sqlite3.connect (TracedConnection): the time of a
+## statement is the execute call, which runs it up to its first row, plus the fetchall reading the rest.
+## A stage run by tracedStage is a root: when a profile is asked for (requestProfile, from the variable table or
+## SIGUSR1), its next run is done under cProfile and the statistics are dumped to profileDirectory.
+##
+
+import os
+import time
+import logging
+import sqlite3
+import cProfile
+import threading
+from datetime import datetime
+
+#Spans lasting longer than this many seconds are written to the trace log
+slowThresholdSeconds = 1.0
+#Characters of a statement and of its parameters kept in the trace log
+statementTextLength = 1000
+#Folder of the cProfile dumps
+profileDirectory = '/var/log'
+
+#Trace log, given its own file handler by AutoBRM. Its lines don't go to the main log.
+traceLogger = logging.getLogger('autobrm.trace')
+traceLogger.propagate = False
+
+#Names of the span stack of each thread
+localSpans = threading.local()
+#Names of the tracedStage roots, and the ones still to be profiled once. Changed by whole assignment or by
+#discard only, as requestProfile runs in a signal handler and can't wait for a lock.
+rootStageNames = set()
+pendingProfiles = set()
+
+def setSlowThreshold(seconds):
+    global slowThresholdSeconds
+    slowThresholdSeconds = seconds
+
+def getSpanStack():
+    spanStack = getattr(localSpans, 'spanStack', None)
+    if spanStack is None:
+        spanStack = localSpans.spanStack = []
+    return spanStack
+
+#Timed piece of work, used as a context manager. The detail (statement text) is only written when the span is slow.
+class Span(object):
+
+    def __init__(self, name, detail = None):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.spanStack = getSpanStack()
+        self.spanStack.append(self.name)
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, exceptionTraceback):
+        seconds = time.time() - self.startTime
+        if seconds >= slowThresholdSeconds:
+            message = '%s %.3f s' % ('/'.join(self.spanStack), seconds)
+            if exceptionType is not None:
+                message += ' (%s)' % exceptionType.__name__
+            detail = self.getDetail()
+            if detail:
+                message += ': %s' % detail
+            traceLogger.warning(message)
+        self.spanStack.pop()
+        return False
+
+    def getDetail(self):
+        return self.detail
+
+#Span of one SQL call. The statement text is only built when the span is slow, most statements take a few microseconds.
+class StatementSpan(Span):
+
+    def __init__(self, statement, parameters = None, callName = None):
+        Span.__init__(self, 'sql')
+        self.statement = statement
+        self.parameters = parameters
+        self.callName = callName
+
+    def getDetail(self):
+        detail = ' '.join((self.statement or '').split())[:statementTextLength]
+        if self.parameters:
+            detail += ' %s' % (repr(self.parameters)[:statementTextLength],)
+        if self.callName:
+            detail += ' (%s)' % self.callName
+        return detail
+
+def span(name, detail = None):
+    return Span(name, detail)
+
+#Asks for one profiled run of each stage root (of the given ones, if any)
+def requestProfile(stageNames = None):
+    global pendingProfiles
+    pendingProfiles = set(stageNames or rootStageNames)
+
+def isProfilePending():
+    return len(pendingProfiles) > 0
+
+#Runs the function under cProfile and dumps the statistics to profileDirectory
+def runProfiled(stageName, function, *arguments):
+    profileFile = os.path.join(profileDirectory, 'autobrm_profile_%s_%s.prof' % (stageName, datetime.now().strftime('%Y%m%d%H%M%S')))
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *arguments)
+    finally:
+        try:
+            profiler.dump_stats(profileFile)
+            traceLogger.warning('%s profile written to %s' % (stageName, profileFile))
+        except Exception, errorString:
+            traceLogger.error('%s profile: %s' % (stageName, errorString))
+
+#Returns the function run in a root span named after the stage, profiled once when a profile is pending.
+#Used for the main loop cycle, the scheduler tasks and the threads started by AutoBRM.
+def tracedStage(stageName, function):
+    rootStageNames.add(stageName)
+    def runStage(*arguments):
+        with Span(stageName):
+            #cProfile can't nest on a thread, a root run inside another span is not profiled
+            if stageName in pendingProfiles and len(getSpanStack()) == 1:
+                pendingProfiles.discard(stageName)
+                return runProfiled(stageName, function, *arguments)
+            return function(*arguments)
+    runStage.__name__ = getattr(function, '__name__', stageName)
+    return runStage
+
+#Cursor timing each statement in an 'sql' span
+class TracedCursor(sqlite3.Cursor):
+
+    def execute(self, statement, parameters = ()):
+        self.statement = statement
+        with StatementSpan(statement, parameters):
+            return sqlite3.Cursor.execute(self, statement, parameters)
+
+    def executemany(self, statement, parameterSequence):
+        self.statement = statement
+        with StatementSpan(statement, None, 'executemany'):
+            return sqlite3.Cursor.executemany(self, statement, parameterSequence)
+
+    def executescript(self, script):
+        self.statement = script
+        with StatementSpan(script, None, 'executescript'):
+            return sqlite3.Cursor.executescript(self, script)
+
+    def fetchall(self):
+        with StatementSpan(getattr(self, 'statement', None), None, 'fetchall'):
+            return sqlite3.Cursor.fetchall(self)
+
+#Connection whose cursors are traced, the execute shortcuts included
+class TracedConnection(sqlite3.Connection):
+
+    def cursor(self, factory = TracedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, statement, parameters = ()):
+        return self.cursor().execute(statement, parameters)
+
+    def executemany(self, statement, parameterSequence):
+        return self.cursor().executemany(statement, parameterSequence)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
@@ -11,33 +11,91 @@
 import signal, os
 import logging
 import commands
+import subprocess
 import threading
 import re
-import urllib2, base64, json
+import json
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from datetime import timedelta
 from time import sleep
 import autoLosSensingReplayFiller
+import gapMergeEngine
+import replayPacking
+import replayScheduler
+import sqchk
+#Vectorized sequence checker, needs NumPy
+try:
+    import sqchkVectorized
+except ImportError:
+    sqchkVectorized = None
+import gapRecords
+import variableCache
+import autobrmDatabase
+import autobrmSchema
+import remoteCommand
+import autobrmScheduler
+import yamcsSubscription
+import yamcsClient
+import autobrmMetrics
+import autobrmTrace
 import sqlite3
 
-#Establishes the database connection and returns the connector object.                            
+#Constants
+##Local/PDC
+dbDatabase = '/opt/autobrm/fsl_hrd.db'
+yamcsServer = 'yamcs-pdc-em.fsl'; yamcsPort = 8090; yamcsInstance = 'fsl-em-dev'; yamcsUsername = '********'; yamcsPassword = '********'
+#Default cost of one bitstream request in the replay packing, in seconds: bitstreamClient start and DaSS replay setup
+replayPackingOverheadSeconds = 30
+#Defaults of the deadline aware replay order: hours of data kept by the Col-CC AOS/LOS buffer, and seconds of slack one replay priority point is worth
+replayBufferHours = 72; replayPrioritySeconds = 3600
+#Seconds between two writes of the metrics file (variable metrics_file)
+metricsFileInterval = 60
+#Default of the variable trace_slow_ms: stages and SQL statements lasting longer are written to the trace log
+traceSlowMilliseconds = 1000
+
+#Metrics exposed by startMetrics (see autobrmMetrics)
+autobrmMetrics.describeMetric('autobrm_scan_day_seconds', 'histogram', 'Time to scan and save one day folder, per scan type')
+autobrmMetrics.describeMetric('autobrm_scan_days_total', 'counter', 'Day folders scanned, per scan type and result')
+autobrmMetrics.describeMetric('autobrm_meex_lines_total', 'counter', 'Meex output lines read')
+autobrmMetrics.describeMetric('autobrm_gap_rows_inserted_total', 'counter', 'Gap rows inserted, per table')
+autobrmMetrics.describeMetric('autobrm_merge_seconds', 'histogram', 'Duration of the gap merge passes, replay packing included, per merge engine')
+autobrmMetrics.describeMetric('autobrm_gaps_merged_total', 'counter', 'Gap items merged into replay items')
+autobrmMetrics.describeMetric('autobrm_replays_packed_total', 'counter', 'NEW replay items packed into another one (MERGED)')
+autobrmMetrics.describeMetric('autobrm_replays_expired_total', 'counter', 'Replay items given up as their data left the Col-CC buffer (EXPIRED)')
+autobrmMetrics.describeMetric('autobrm_replays_dispatched_total', 'counter', 'Bitstream requests started, per DaSS source')
+autobrmMetrics.describeMetric('autobrm_replays_failed_total', 'counter', 'Bitstream requests which failed, per DaSS source')
+autobrmMetrics.describeMetric('autobrm_bitstream_request_seconds', 'histogram', 'bitstreamClient run time, per DaSS source and result')
+autobrmMetrics.describeMetric('autobrm_bitstream_requests_running', 'gauge', 'Bitstream requests running, per DaSS source')
+autobrmMetrics.describeMetric('autobrm_unchecked_gaps', 'gauge', 'hrd_packet_gap items not merged yet')
+autobrmMetrics.describeMetric('autobrm_replay_items', 'gauge', 'Replay items per current state')
+autobrmMetrics.describeMetric('autobrm_yamcs_request_seconds', 'histogram', 'Yamcs REST call latency, per server and call', yamcsClient.latencyBuckets)
+autobrmMetrics.describeMetric('autobrm_yamcs_request_errors_total', 'counter', 'Yamcs REST calls which failed, per server and call')
+
+#Returns the calling thread database connection. Connections are kept open per thread and reused (see autobrmDatabase).
 def dbConnectToDatabase():
     try:
         #Local/PDC
-        dbCon = sqlite3.connect('/opt/autobrm/fsl_hrd.db', timeout=10, isolation_level=None) #AutoCommit is enabled
-        dbCon.execute("PRAGMA foreign_keys = 1") #Foreign key constraints are enabled
-        
-        return dbCon
+        return autobrmDatabase.getConnectionManager(dbDatabase).getConnection()
     except Exception, errorString:
         logger.error(errorString)
         return None
 
+#Hands a connection back once a unit of work is done. It stays open for the next one of the same thread.
+def dbReleaseConnection(dbCon):
+    autobrmDatabase.getConnectionManager(dbDatabase).releaseConnection(dbCon)
+
+#Closes the calling thread database connection. Used by the threads ending with their unit of work (scans, bitstream requests).
+def dbCloseConnection():
+    autobrmDatabase.getConnectionManager(dbDatabase).closeConnection()
+
 #Sets or creates a variable value on the database variable table.  
 def setVariableValue(dbCon, varName, varValue):
     dbCur = dbCon.cursor()
     #get Record ID
-    queryStatement = 'SELECT id FROM variable WHERE name like "%s";' % varName
-    dbCur.execute(queryStatement)
+    queryStatement = 'SELECT id FROM variable WHERE name = ? COLLATE NOCASE;'
+    dbCur.execute(queryStatement, (varName,))
     queryResult = dbCur.fetchall()
     #Existing?
     if len(queryResult) > 0:
@@ -51,48 +109,36 @@ def setVariableValue(dbCon, varName, varValue):
     logger.debug(dbStatement)
     dbCur.execute(dbStatement)
     dbCur.close()
+    #Visible to the next lookup without waiting for the change check
+    variableCache.getVariableCache(dbDatabase).invalidate()
 
-#Returns a variable value from its name by reading it from the database variable table.    
+#Returns a variable value from its name, read from the cached database variable table (see variableCache).
 def getVariableValue(dbCon, varName):
-    dbCur = dbCon.cursor()
-    #get Record ID
-    queryStatement = 'SELECT value FROM variable WHERE name like "%s";' % varName
-    logger.debug(queryStatement)
-    dbCur.execute(queryStatement)
-    queryResult = dbCur.fetchall()
-    #Existing?
-    if len(queryResult) > 0:
-        varValue = str(queryResult[0][0])
-        if str.isdigit(varValue): varValue = int(varValue)
-    else:
-        varValue = None
-        
-    dbCur.close()
-    return varValue
+    return variableCache.getVariableCache(dbDatabase).getValue(varName)
 
 #Binds a VMU_packet_gap item to a replay item on the database.    
 def linkHrdGapItem2ReplayItem(dbCon, resultReplayID, gapItemID):
     dbCur = dbCon.cursor()
-    insertStatement = 'INSERT INTO gap_replay_list(replay_id, hrd_packet_gap_id) \
-    VALUES(%s, %s);' % (resultReplayID, gapItemID)
-    logger.debug(insertStatement)
-    dbCur.execute(insertStatement)
+    insertStatement = 'INSERT INTO gap_replay_list(replay_id, hrd_packet_gap_id) VALUES(?, ?);'
+    insertParameters = (resultReplayID, gapItemID)
+    logger.debug('%s %s' % (insertStatement, insertParameters))
+    dbCur.execute(insertStatement, insertParameters)
     dbCur.close()
 
 #Sets the 'checked' flag on a HRD_packet_gap item after having processed it.
 def markHrdGapItemAsChecked(dbCon, gapItemID):
     dbCur = dbCon.cursor()
-    updateStatement = 'UPDATE hrd_packet_gap SET is_checked = 1 WHERE id = %s' % gapItemID
-    logger.debug(updateStatement)
-    dbCur.execute(updateStatement)
+    updateStatement = 'UPDATE hrd_packet_gap SET is_checked = 1 WHERE id = ?'
+    logger.debug('%s (%s,)' % (updateStatement, gapItemID))
+    dbCur.execute(updateStatement, (gapItemID,))
     dbCur.close()
 
 #Returns the next workflow state for the given workflow state.
 def getNextWorkflowStateID(dbCon, replayStateID):
     dbCur = dbCon.cursor()
-    queryStatement = 'SELECT id, NAME, workflow FROM replay_status WHERE workflow>(SELECT workflow FROM replay_status WHERE id = %s) ORDER BY workflow ASC LIMIT 1;' % replayStateID
-    logger.debug(queryStatement)
-    dbCur.execute(queryStatement)
+    queryStatement = 'SELECT id, NAME, workflow FROM replay_status WHERE workflow>(SELECT workflow FROM replay_status WHERE id = ?) ORDER BY workflow ASC LIMIT 1;'
+    logger.debug('%s (%s,)' % (queryStatement, replayStateID))
+    dbCur.execute(queryStatement, (replayStateID,))
     queryResult = dbCur.fetchall()
     dbCur.close()
     #Existing?
@@ -105,10 +151,9 @@ def getNextWorkflowStateID(dbCon, replayStateID):
 def getReplayItemStateID(dbCon, replayItemID):
     dbCur = dbCon.cursor()
     #is the replay_job created?  
-    queryStatement = 'SELECT id, replay_status_id FROM replay_job WHERE \
-    replay_id = %s order by id desc limit 1;' % replayItemID
-    logger.debug(queryStatement)
-    dbCur.execute(queryStatement)
+    queryStatement = 'SELECT id, replay_status_id FROM replay_job WHERE replay_id = ? order by id desc limit 1;'
+    logger.debug('%s (%s,)' % (queryStatement, replayItemID))
+    dbCur.execute(queryStatement, (replayItemID,))
     queryResult = dbCur.fetchall()
     dbCur.close()
     #Existing?
@@ -124,7 +169,7 @@ def setReplayItemState(dbCon, replayItemID, stateName, text = None):
     dbCur = dbCon.cursor()
     try:
         insertStatement = 'INSERT INTO replay_job(TIMESTAMP, replay_id, replay_status_id, text) \
-        VALUES (datetime("now"), %s, (SELECT id FROM replay_status WHERE NAME LIKE "%s"), %s);' % (replayItemID, stateName, "null" if not bool(text) else '"%s"' % re.escape(text[:100]))
+        VALUES (datetime("now"), %s, (SELECT id FROM replay_status WHERE NAME = "%s" COLLATE NOCASE), %s);' % (replayItemID, stateName, "null" if not bool(text) else '"%s"' % re.escape(text[:100]))
         logger.debug(insertStatement)
         dbCur.execute(insertStatement)
         dbCur.close()
@@ -196,10 +241,10 @@ def updateReplayItem(dbCon, updateModifiers):
 def queryReplayList(dbCon, queryModifier):
     dbCur = dbCon.cursor()
     #Compose the query statement iterating the updateModifiers dictionary that contains full where filter condition.
-    queryStatement = 'SELECT id FROM replay LEFT JOIN latest_replay_status lrs ON lrs.replayID = id WHERE '
+    queryStatement = 'SELECT id FROM replay WHERE '
     queryStatement = '%s%s' % (queryStatement, "".join(['%s "%s" AND ' % (key, value) for (key, value) in queryModifier['where'].items()]))
     queryStatement = queryStatement.rstrip(' AND ')
-    queryStatement = '%s%s' % (queryStatement, 'AND lrs.replayStatus LIKE "NEW";')
+    queryStatement = '%s%s' % (queryStatement, 'AND replay_status_id IN (SELECT id FROM replay_status WHERE name = "NEW" COLLATE NOCASE);')
     
     logger.debug(queryStatement)
     dbCur.execute(queryStatement)
@@ -213,7 +258,7 @@ def queryReplayListTimeDelta(dbCon, queryModifier):
     #Compose the query statement iterating the updateModifiers dictionary that contains the select fields.
     queryStatement = 'SELECT id, startdate, enddate, '
     queryStatement = '%s%s' % (queryStatement, "".join(['ABS((strftime("%s","{}")-strftime("%s","{}"))/60) AS delta'.format(key, value) for (key, value) in queryModifier['select'].items()]))
-    queryStatement = '%s%s' % (queryStatement, ' FROM replay LEFT JOIN latest_replay_status lrs ON lrs.replayID = id WHERE lrs.replayStatus LIKE "NEW"')
+    queryStatement = '%s%s' % (queryStatement, ' FROM replay WHERE replay_status_id IN (SELECT id FROM replay_status WHERE name = "NEW" COLLATE NOCASE)')
     queryStatement = '%s%s' % (queryStatement, ' GROUP BY id, startdate, enddate, delta')
     queryStatement = '%s%s' % (queryStatement, ' HAVING delta>=0 AND delta<=%s;' % getVariableValue(dbCon, 'scan_gap_offset_check_minutes'))
     
@@ -363,52 +408,196 @@ def insertHrdGapItem2ReplayList():
     #Make database connection
     dbCon = dbConnectToDatabase()
     if dbCon:
-        #Query for all unchecked gapItems on vmu_packet_gap
-        dbCur = dbCon.cursor()
-        queryStatement = 'SELECT hrdpaga.id, hrdpaga.last_timestamp, hrdpaga.next_timestamp, hrdpaga.chanel FROM hrd_packet_gap hrdpaga \
-        WHERE hrdpaga.is_checked = 0;'
-        dbCur.execute(queryStatement)
-        queryResults = dbCur.fetchall()
-        logger.debug(queryStatement)
-        #if results, we continue for insertion
-        for row in queryResults:
-            #Parse the relevant data obtained from the database
-            gapItemID = row[0]
-            gapItemStartDate = row[1]
-            gapItemEndDate = row[2]
-            gapItemChanel = row[3]
-            
-            #is VMU Phase, Recordname or Source relevant?
-            if isHrdChanelrelevant(dbCon, gapItemChanel):
-                #for each, decide the type of case and act acordingly
-                #See documentation for extended information on GapItem to ReplayItem cases
-                if isGapItemCaseD(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                elif isGapItemCaseE(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                elif isGapItemCaseC(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                elif isGapItemCaseF(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                elif isGapItemCaseB(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                elif isGapItemCaseG(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
-                    pass
-                #Case A, H, and other
-                else:
-                    GapItemCaseA(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel)
-                    
-        dbCon.close()
+        startTime = datetime.now()
+        #The query per case procedure is kept as fallback, the in-memory merge engine is the default
+        mergeEngine = 'sql' if getVariableValue(dbCon, 'gap_merge_engine') == 'sql' else 'memory'
+        if mergeEngine == 'sql':
+            mergedItemCount = mergeHrdGapItemsWithQueries(dbCon)
+        else:
+            mergedItemCount = mergeHrdGapItemsInMemory(dbCon)
+        #Batch pass before the dispatch: pack the NEW replay items into the cheapest set of requests
+        if mergedItemCount > 0 and str(getVariableValue(dbCon, 'replay_packing')).lower() != 'off':
+            packNewReplayItems(dbCon)
+        dbReleaseConnection(dbCon)
+        autobrmMetrics.observeHistogram('autobrm_merge_seconds', (datetime.now() - startTime).total_seconds(), {'engine': mergeEngine})
+        autobrmMetrics.incrementCounter('autobrm_gaps_merged_total', mergedItemCount)
+        #New or extended replay items to issue
+        if mergedItemCount > 0:
+            triggerTask('dispatch')
+
+#Merges the unchecked gap items querying the database for every match case. Returns the number of gap items merged.
+def mergeHrdGapItemsWithQueries(dbCon):
+    #Query for all unchecked gapItems on vmu_packet_gap
+    dbCur = dbCon.cursor()
+    queryStatement = 'SELECT hrdpaga.id, hrdpaga.last_timestamp, hrdpaga.next_timestamp, hrdpaga.chanel FROM hrd_packet_gap hrdpaga \
+    WHERE hrdpaga.is_checked = 0;'
+    dbCur.execute(queryStatement)
+    queryResults = dbCur.fetchall()
+    logger.debug(queryStatement)
+    #if results, we continue for insertion
+    for row in queryResults:
+        #Parse the relevant data obtained from the database
+        gapItemID = row[0]
+        gapItemStartDate = row[1]
+        gapItemEndDate = row[2]
+        gapItemChanel = row[3]
         
+        #is VMU Phase, Recordname or Source relevant?
+        if isHrdChanelrelevant(dbCon, gapItemChanel):
+            #for each, decide the type of case and act acordingly
+            #See documentation for extended information on GapItem to ReplayItem cases
+            if isGapItemCaseD(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            elif isGapItemCaseE(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            elif isGapItemCaseC(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            elif isGapItemCaseF(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            elif isGapItemCaseB(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            elif isGapItemCaseG(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel):
+                pass
+            #Case A, H, and other
+            else:
+                GapItemCaseA(dbCon, gapItemID, gapItemStartDate, gapItemEndDate, gapItemChanel)
+    dbCur.close()
+    return len(queryResults)
+
+#Returns the NEW replay items as in-memory replay windows for the merge engine.
+def queryNewReplayWindows(dbCon):
+    dbCur = dbCon.cursor()
+    queryStatement = 'SELECT id, startdate, enddate, strftime("%s",startdate), strftime("%s",enddate) FROM replay \
+    WHERE replay_status_id IN (SELECT id FROM replay_status WHERE name = "NEW" COLLATE NOCASE) ORDER BY id;'
+    logger.debug(queryStatement)
+    dbCur.execute(queryStatement)
+    windows = {}
+    for row in dbCur.fetchall():
+        if row[0] not in windows:
+            windows[row[0]] = gapMergeEngine.ReplayWindow((0, row[0]), row[0], row[1], row[2], None if row[3] is None else int(row[3]), None if row[4] is None else int(row[4]))
+    dbCur.close()
+    return windows.values()
+
+#Returns the unchecked gap items, with the padded datetimes computed by SQLite exactly as the case procedures write them.
+def queryUncheckedGapItems(dbCon):
+    dbCur = dbCon.cursor()
+    queryStatement = 'SELECT id, last_timestamp, next_timestamp, chanel, strftime("%s",last_timestamp), strftime("%s",next_timestamp), \
+    datetime(last_timestamp,"-1 seconds"), datetime(next_timestamp,"+1 seconds"), datetime(last_timestamp,"-5 seconds"), datetime(next_timestamp,"+5 seconds") \
+    FROM hrd_packet_gap WHERE is_checked = 0 ORDER BY id;'
+    logger.debug(queryStatement)
+    dbCur.execute(queryStatement)
+    gapItems = []
+    for row in dbCur.fetchall():
+        gapItems.append(gapMergeEngine.GapItem(row[0], row[3], row[1], row[2], None if row[4] is None else int(row[4]), None if row[5] is None else int(row[5]), \
+        row[6], row[7], row[8], row[9]))
+    dbCur.close()
+    return gapItems
+
+#Merges the unchecked gap items into the NEW replay items in memory (see gapMergeEngine) and writes the result back within a single transaction. Returns the number of gap items merged.
+def mergeHrdGapItemsInMemory(dbCon):
+    startTime = datetime.now()
+    toleranceMinutes = getVariableValue(dbCon, 'scan_gap_offset_check_minutes')
+    dbCur = dbCon.cursor()
+    #Lock the database for writing while reading, so nothing changes between the load and the write back
+    autobrmDatabase.beginImmediate(dbCur, 'merge')
+    try:
+        gapItems = [gapItem for gapItem in queryUncheckedGapItems(dbCon) if isHrdChanelrelevant(dbCon, gapItem.channel)]
+        if len(gapItems) > 0:
+            #New replay items only take part in the following matches if their initial state is NEW
+            dbCur.execute('SELECT NAME FROM replay_status ORDER BY workflow ASC LIMIT 1;')
+            queryResult = dbCur.fetchall()
+            newWindowsAreMergeable = len(queryResult) > 0 and str(queryResult[0][0]).upper() == 'NEW'
+            mergePlan = gapMergeEngine.mergeGapItems(gapItems, queryNewReplayWindows(dbCon), toleranceMinutes, newWindowsAreMergeable)
+            writeReplayMergePlan(dbCon, mergePlan)
+        dbCur.execute('COMMIT;')
+    except Exception:
+        dbCur.execute('ROLLBACK;')
+        dbCur.close()
+        raise
+    dbCur.close()
+
+    if len(gapItems) > 0:
+        logger.info('Merged %s gap items into %s replay items in %s (cases %s)' % (len(gapItems), len(mergePlan['windows']), datetime.now() - startTime, ', '.join(['%s:%s' % (case, count) for (case, count) in sorted(mergePlan['cases'].items()) if count > 0])))
+    return len(gapItems)
+
+#Writes a merge plan from the merge engine: creates the new replay items, updates the moved ones, links the gap items and marks them as checked.
+def writeReplayMergePlan(dbCon, mergePlan):
+    dbCur = dbCon.cursor()
+    for window in mergePlan['windows']:
+        if window.isNew:
+            #Create in creation order, so the ids are the ones the query per case procedure would give
+            insertStatement = 'INSERT INTO replay (TIMESTAMP, startdate, enddate) VALUES (datetime("now"), ?, ?);'
+            logger.debug('%s %s' % (insertStatement, (window.startdate, window.enddate)))
+            dbCur.execute(insertStatement, (window.startdate, window.enddate))
+            window.replayID = dbCur.lastrowid
+            #Set replay status to its initial state
+            incrementReplayItemState(dbCon, window.replayID)
+        elif window.isModified:
+            updateStatement = 'UPDATE replay SET startdate = ?, enddate = ? WHERE id = ?;'
+            logger.debug('%s %s' % (updateStatement, (window.startdate, window.enddate, window.replayID)))
+            dbCur.execute(updateStatement, (window.startdate, window.enddate, window.replayID))
+
+    dbCur.executemany('INSERT INTO gap_replay_list(replay_id, hrd_packet_gap_id) VALUES(?, ?);', [(window.replayID, gapItemID) for (window, gapItemID) in mergePlan['links']])
+    dbCur.executemany('UPDATE hrd_packet_gap SET is_checked = 1 WHERE id = ?;', [(gapItemID,) for (window, gapItemID) in mergePlan['links']])
+    dbCur.close()
+
+#Returns the replay ratio of the packing cost model: seconds of link time per replayed second, the recorded bitrate (variable hrd_recorded_bitrate) over the bitstream request bitrate.
+def getReplayRatio(dbCon):
+    bitrate = getVariableValue(dbCon, 'bitstreamrequest_bitrate')
+    recordedBitrate = getVariableValue(dbCon, 'hrd_recorded_bitrate')
+    if not isinstance(bitrate, int) or bitrate <= 0:
+        return 1.0
+    if not isinstance(recordedBitrate, int) or recordedBitrate <= 0:
+        recordedBitrate = bitrate
+    return float(recordedBitrate) / bitrate
+
+#Returns the fixed cost of one bitstream request in seconds of link time: variable replay_packing_overhead_seconds, default replayPackingOverheadSeconds.
+def getRequestOverheadSeconds(dbCon):
+    overheadSeconds = getVariableValue(dbCon, 'replay_packing_overhead_seconds')
+    return overheadSeconds if isinstance(overheadSeconds, int) else replayPackingOverheadSeconds
+
+#Packs the NEW replay items into the cheapest set of bitstream requests (see replayPacking): the kept item takes the extent of its request, the others are set as MERGED and their gap items linked to the kept one.
+#The cost of a request is its overhead (see getRequestOverheadSeconds) plus its replayed seconds at the bitstream request bitrate. Returns the estimated cost saved, in seconds.
+def packNewReplayItems(dbCon):
+    overheadSeconds = getRequestOverheadSeconds(dbCon)
+    replayRatio = getReplayRatio(dbCon)
+    dbCur = dbCon.cursor()
+    #The dispatch claims NEW items within its own write transaction: an item is either claimed before the packing, or packed before the claim
+    autobrmDatabase.beginImmediate(dbCur, 'packing')
+    try:
+        windows = queryNewReplayWindows(dbCon)
+        packingPlan = replayPacking.planReplayPacking(windows, overheadSeconds, replayRatio)
+        for keptWindow, mergedWindows in packingPlan['windows']:
+            updateStatement = 'UPDATE replay SET startdate = ?, enddate = ? WHERE id = ?;'
+            logger.debug('%s %s' % (updateStatement, (keptWindow.startdate, keptWindow.enddate, keptWindow.replayID)))
+            dbCur.execute(updateStatement, (keptWindow.startdate, keptWindow.enddate, keptWindow.replayID))
+            for window in mergedWindows:
+                dbCur.execute('UPDATE gap_replay_list SET replay_id = ? WHERE replay_id = ?;', (keptWindow.replayID, window.replayID))
+                setReplayItemState(dbCon, window.replayID, 'MERGED', 'Packed into replay %s' % keptWindow.replayID)
+        dbCur.execute('COMMIT;')
+    except Exception:
+        dbCur.execute('ROLLBACK;')
+        dbCur.close()
+        raise
+    dbCur.close()
+
+    costSaved = packingPlan['costBefore'] - packingPlan['costAfter']
+    mergedItemCount = sum([len(mergedWindows) for (keptWindow, mergedWindows) in packingPlan['windows']])
+    autobrmMetrics.incrementCounter('autobrm_replays_packed_total', mergedItemCount)
+    if mergedItemCount > 0:
+        logger.info('Packed %s NEW replay items into %s requests: estimated cost %.0f s instead of %.0f s, %.0f s saved' % \
+        (len(windows), len(windows) - mergedItemCount, packingPlan['costAfter'], packingPlan['costBefore'], costSaved))
+    return costSaved
 
 #Returns a vmu_record item database ID from an input vmu phase, record and source. If it doesn't exist it creates it on the database.    
 def getVmuRecordDataID(dbCon, phaseName, recordName, source):
     dbCur = dbCon.cursor()
     #get Record ID
+    queryParameters = [value for value in (phaseName, recordName, source) if value]
     queryStatement = 'SELECT vmure.id FROM vmu_record vmure \
-    WHERE vmure.phase %s and vmure.recordname %s and vmure.source %s' % ("like \"%s\"" % phaseName if phaseName else "is null", "like \"%s\"" % recordName if recordName else "is null", "= %s" % source if source else "is null")
-    dbCur.execute(queryStatement)
-    logger.debug(queryStatement)
+    WHERE vmure.phase %s and vmure.recordname %s and vmure.source %s' % ("= ? COLLATE NOCASE" if phaseName else "is null", "= ? COLLATE NOCASE" if recordName else "is null", "= ?" if source else "is null")
+    dbCur.execute(queryStatement, queryParameters)
+    logger.debug('%s %s' % (queryStatement, queryParameters))
     queryResult = dbCur.fetchall()
     #New combination of VMU phase, record and source?
     if len(queryResult) > 0:
@@ -419,7 +608,6 @@ def getVmuRecordDataID(dbCon, phaseName, recordName, source):
         insertStatement = 'insert into vmu_record(timestamp, phase, recordname, source) \
         values(datetime("now"), %s, %s, %s);' % ("\"%s\"" % phaseName[:20] if phaseName else "null", "\"%s\"" % recordName[:20] if recordName else "null", "%s" % source if source else "null")
         logger.debug(insertStatement)
-        print insertStatement
         dbCur.execute(insertStatement)
         vmu_record_id = dbCur.lastrowid
     
@@ -430,8 +618,8 @@ def getVmuRecordDataID(dbCon, phaseName, recordName, source):
 def getDataSource(dbCon, dataSourceName):
     dbCur = dbCon.cursor()
     #get Data Source ID
-    queryStatement = 'SELECT id FROM data_source WHERE name like "%s";' % (dataSourceName)
-    dbCur.execute(queryStatement)
+    queryStatement = 'SELECT id FROM data_source WHERE name = ? COLLATE NOCASE;'
+    dbCur.execute(queryStatement, (dataSourceName,))
     queryResult = dbCur.fetchall()
     #New source or existing one?
     if len(queryResult) > 0:
@@ -499,6 +687,30 @@ def insertVmuGapItem(dbCon, phaseName, recordName, source, startdate, last_seque
     dbCur.execute(insertStatement)
     dbCur.close()
     
+#Raised by streamCommandOutput when the command exits with a non-zero status.
+class CommandError(Exception):
+    def __init__(self, command, returnCode):
+        Exception.__init__(self, 'Command exited with status %s: %s' % (returnCode, command))
+        self.command = command
+        self.returnCode = returnCode
+
+#Runs a shell command and yields its output line by line as it is produced, instead of buffering all of it as commands.getstatusoutput does. Stderr is merged into the output the same way.
+#The exit status is checked once the output is fully read: a non-zero status raises CommandError.
+def streamCommandOutput(command):
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=-1, close_fds=True)
+    lineCount = 0
+    try:
+        for line in iter(process.stdout.readline, ''):
+            lineCount += 1
+            yield line.rstrip('\n')
+    finally:
+        #Closing the pipe early (consumer stopped) ends the command with a SIGPIPE
+        process.stdout.close()
+        returnCode = process.wait()
+        autobrmMetrics.incrementCounter('autobrm_meex_lines_total', lineCount)
+    if returnCode != 0:
+        raise CommandError(command, returnCode)
+
 #Returns the full data patch from the database. Normally /mainpool/FSL/Archive/Ops/HRDL/2/RealTime/    
 def getFolderPath(dbCon, daysBack):
     baseDir = getVariableValue(dbCon, 'meex_data_path_basedir')
@@ -508,107 +720,438 @@ def getFolderPath(dbCon, daysBack):
     
     return "%s%s%s%s" % (baseDir, yearNumber, "/", '%03d' % doyNumber)
      
+#Number of gap items written to the database per write transaction by ingestGapItems
+gapRowBatchSize = 1000
+
+#Returns the id the next row inserted into the table gets. Used to number rows inserted with executemany, within a write transaction.
+def getNextRowID(dbCon, tableName):
+    dbCur = dbCon.cursor()
+    dbCur.execute('SELECT MAX(id) FROM %s;' % tableName)
+    nextRowID = (dbCur.fetchall()[0][0] or 0) + 1
+    #AUTOINCREMENT tables never reuse ids of deleted rows
+    try:
+        dbCur.execute('SELECT seq FROM sqlite_sequence WHERE name = ?;', (tableName,))
+        queryResult = dbCur.fetchall()
+        if len(queryResult) > 0 and queryResult[0][0] >= nextRowID:
+            nextRowID = queryResult[0][0] + 1
+    except sqlite3.OperationalError:
+        pass
+    dbCur.close()
+    return nextRowID
+
+#Parses one sqchk.awk output line. Returns its gap item (see gapRecords), or None for lines which are not a gap item.
+def parseGapOutputLine(gapItem):
+    logger.debug(gapItem)
+    if '|' not in gapItem:
+        return None
+    #Split HRD and VMU part
+    hrdFields = gapItem.split('||')[0].split('|')
+    vmuFields = gapItem.split('||')[1].split('|')
+
+    #Determine sqchk.awk output entry item type: either 'G' or 'B'
+    ## 'G' for 'GAP' is a regular gap. Missing data between two received packets
+    ## 'B' for 'BAD' is a gap composed by one or more corrupt packets.
+    itemType = hrdFields[0].strip()
+    
+    #Parse HRD line: channel, startdate, enddate, last and next sequence counts, difference
+    try:
+        hrd = [hrdFields[1].strip(), hrdFields[2].strip(), hrdFields[3].strip(), int(hrdFields[4]), int(hrdFields[5]), int(hrdFields[6])]
+    except Exception, errorString:
+            logger.error(errorString)
+            hrd = [None] * 6
+    
+    #Parse the VMU line
+    if itemType == 'G':
+        #This is a regular Gap: source, startdate, enddate, last and next sequence counts, difference, phase and user VMU record name
+        try:
+            vmu = [vmuFields[0].strip(), vmuFields[1].strip(), vmuFields[2].strip(), int(vmuFields[3]), int(vmuFields[4]), int(vmuFields[5]), None, vmuFields[6].strip()]
+        except Exception, errorString:
+            logger.error(errorString)
+            vmu = [None] * 8
+            
+    elif itemType == 'B':
+        #This is a corrupt packet Gap
+        vmu = [vmuFields[0].strip()]
+    else:
+        vmu = []
+
+    return gapRecords.GapItem(itemType, *(hrd + vmu))
+
+#Inserts the pending hrd_packet_gap and vmu_packet_gap rows and empties the lists. Returns the updated row counters.
+def flushGapRows(dbCon, hrdRows, vmuRows, hrdRowCount, vmuRowCount):
+    dbCur = dbCon.cursor()
+    #HRD gaps first, the VMU gaps reference them
+    dbCur.executemany('INSERT INTO hrd_packet_gap (id, TIMESTAMP, last_sequence_count, last_timestamp, next_sequence_count, next_timestamp, is_checked, chanel) \
+    VALUES (?, datetime("now"), ?, ?, ?, ?, 0, ?);', hrdRows)
+    dbCur.executemany('INSERT INTO vmu_packet_gap (TIMESTAMP, last_sequence_count, last_timestamp, next_sequence_count, next_timestamp, is_checked, vmu_record_id, hrd_packet_gap_id) \
+    VALUES (datetime("now"), ?, ?, ?, ?, 0, ?, ?);', vmuRows)
+    dbCur.close()
+    hrdRowCount += len(hrdRows)
+    vmuRowCount += len(vmuRows)
+    del hrdRows[:]
+    del vmuRows[:]
+    return [hrdRowCount, vmuRowCount]
+
+#Yields the gap items parsed from sqchk.awk output lines.
+def iterGapOutputItems(gapLines):
+    for gapLine in gapLines:
+        try:
+            gapItem = parseGapOutputLine(gapLine)
+        except Exception, errorString:
+            logger.error(errorString)
+            gapItem = None
+        if gapItem is not None:
+            yield gapItem
+
+#Converts a sqchk record into the gap item parseGapOutputLine gives for its sqchk.awk output line.
+def recordToGapItem(record):
+    if isinstance(record, sqchk.GapRecord):
+        return gapRecords.GapItem('G', record.channel.strip(), record.vmuStartdate.strip(), record.vmuEnddate.strip(), record.vmuLastSequenceCount, \
+        record.vmuNextSequenceCount, record.vmuDifference, str(record.origin), record.hrdStartdate.strip(), record.hrdEnddate.strip(), \
+        record.hrdLastSequenceCount, record.hrdNextSequenceCount, record.hrdDifference, None, record.upi.strip())
+    return gapRecords.GapItem('B', record.channel.strip(), record.startdate.strip(), record.enddate.strip(), record.firstSequenceCount, \
+    record.lastSequenceCount, record.difference, str(record.origin))
+
+#Returns the sequence checker module of the scans: sqchkVectorized if the variable scan_gap_detector is set to vectorized and NumPy is there, sqchk otherwise.
+def getSequenceCheckModule(dbCon):
+    if getVariableValue(dbCon, 'scan_gap_detector') == 'vectorized':
+        if sqchkVectorized is not None:
+            return sqchkVectorized
+        logger.warning('scan_gap_detector is vectorized but NumPy is not installed, the sqchk sequence checker is used')
+    return sqchk
+
+#Yields the gap items found by the sequence checker (sqchk or sqchkVectorized) in Meex listing lines.
+def iterSequenceCheckItems(listingLines, dataPath = None, checkModule = sqchk):
+    checker = checkModule.SequenceChecker()
+    for record in checkModule.checkLines(listingLines, checker):
+        yield recordToGapItem(record)
+    logger.info('%s: %s' % (dataPath, ', '.join([line.strip() for line in checker.summary().split('\n') if line.strip()])))
+
+#Saves parsed gap items (see gapRecords) into the hrd_packet_gap, vmu_packet_gap and vmu_record tables. Existing unchecked hrd_packet_gap items containing a new gap are reused as one by one insertion did (see insertHrdGapItem).
+#The items can be any iterable, a Meex stream is read to its end before anything is written: the write lock is not held while Meex runs, and a command failure writes nothing of the day.
+#The rows are then written by batches of gapRowBatchSize items, one short write transaction each (see ingestGapItemBatch).
+def ingestGapItems(dbCon, gapItems, dataPath = None):
+    startTime = datetime.now()
+    pendingItems = []
+    itemCount = 0
+    for gapItem in gapItems:
+        itemCount += 1
+        try:
+            itemType = gapItem.itemType
+            #if no VMU gap sequence count skip is observed (hrd header sequence counts are not contiguous), then contonue to input the gap/corrupt range into the replay queue table
+            if not (((gapItem.difference >=  gapItem.vmuDifference) and itemType == 'G') or (itemType == 'B')):
+                continue
+            if ((gapItem.difference > 0 and itemType == 'G') or (itemType == 'B')) and (gapItem.lastSequenceCount is None or gapItem.nextSequenceCount is None):
+                raise ValueError('no HRD sequence counts')
+            if itemType == 'G' and (gapItem.vmuLastSequenceCount is None or gapItem.vmuNextSequenceCount is None):
+                raise ValueError('no VMU sequence counts')
+            pendingItems.append(gapItem)
+        except Exception, errorString:
+            logger.error('Skipping gap item %s: %s' % (gapItem, errorString))
+
+    hrdRowCount = 0
+    vmuRowCount = 0
+    ingestState = {'uncheckedHrdGaps': None, 'nextHrdGapID': None, 'vmuRecordIDs': {}}
+    for batchStart in range(0, len(pendingItems), gapRowBatchSize):
+        batchRowCounts = ingestGapItemBatch(dbCon, pendingItems[batchStart:batchStart + gapRowBatchSize], ingestState)
+        hrdRowCount += batchRowCounts[0]
+        vmuRowCount += batchRowCounts[1]
+
+    autobrmMetrics.incrementCounter('autobrm_gap_rows_inserted_total', hrdRowCount, {'table': 'hrd_packet_gap'})
+    autobrmMetrics.incrementCounter('autobrm_gap_rows_inserted_total', vmuRowCount, {'table': 'vmu_packet_gap'})
+    elapsedSeconds = max((datetime.now() - startTime).total_seconds(), 0.001)
+    rowCount = hrdRowCount + vmuRowCount
+    logger.info('Ingested %s gap items of %s: %s hrd_packet_gap and %s vmu_packet_gap rows in %.2f s (%.0f rows/s)' % (itemCount, dataPath, hrdRowCount, vmuRowCount, elapsedSeconds, rowCount / elapsedSeconds))
+    return rowCount
+
+#Writes checked gap items within one write transaction. Returns the hrd_packet_gap and vmu_packet_gap row counts.
+#ingestState keeps across the batches of a day the unchecked HRD gaps index, the id the next hrd_packet_gap row got after the last batch and the vmu_record ids.
+def ingestGapItemBatch(dbCon, gapItems, ingestState):
+    dbCur = dbCon.cursor()
+    autobrmDatabase.beginImmediate(dbCur, 'ingest')
+    try:
+        #Unchecked HRD gaps, to look for containing gaps in memory: all of them for the first batch, then the ones other scans added since the last batch
+        if ingestState['uncheckedHrdGaps'] is None:
+            dbCur.execute('SELECT id, chanel, last_sequence_count, next_sequence_count, last_timestamp, next_timestamp FROM hrd_packet_gap WHERE is_checked = 0 ORDER BY id;')
+            ingestState['uncheckedHrdGaps'] = gapRecords.HrdGapIndex(dbCur.fetchall())
+        else:
+            dbCur.execute('SELECT id, chanel, last_sequence_count, next_sequence_count, last_timestamp, next_timestamp FROM hrd_packet_gap WHERE is_checked = 0 AND id >= ? ORDER BY id;', \
+            (ingestState['nextHrdGapID'],))
+            for row in dbCur.fetchall():
+                ingestState['uncheckedHrdGaps'].add(row)
+        uncheckedHrdGaps = ingestState['uncheckedHrdGaps']
+        vmuRecordIDs = ingestState['vmuRecordIDs']
+        nextHrdGapID = getNextRowID(dbCon, 'hrd_packet_gap')
+        firstHrdGapID = nextHrdGapID
+        uncheckedHrdGapIDs = set()
+        hrdRows = []
+        vmuRows = []
+
+        for gapItem in gapItems:
+            itemType = gapItem.itemType
+            #Save the data in the hrd_packet_gap table
+            if (gapItem.difference > 0 and itemType == 'G') or (itemType == 'B'):
+                ## If there is an HRD gap (VMU gaps doesn't always correspond to an HRD gap: i.e. Packet skipped when sent out by VMU) OR it is a gap involving corruption (bad)
+                #### Get ID if gap contained in existing gap, otherwise Insert and get ID of the inserted entry.
+                hrdItemID = findUncheckedContainingGap(dbCur, uncheckedHrdGaps, uncheckedHrdGapIDs, firstHrdGapID, gapItem)
+                if hrdItemID is None:
+                    hrdItemID = nextHrdGapID
+                    nextHrdGapID += 1
+                    uncheckedHrdGaps.add((hrdItemID, gapItem.channel, gapItem.lastSequenceCount, gapItem.nextSequenceCount, gapItem.startdate, gapItem.enddate))
+                    hrdRows.append((hrdItemID, gapItem.lastSequenceCount, gapItem.startdate, gapItem.nextSequenceCount, gapItem.enddate, gapItem.channel))
+            else:
+                hrdItemID = None
+
+            #Save the data in the vmu_packet_gap table & And link to HRD item (if any)
+            if itemType == 'G':
+                ## Only if it a regular gap. A corrupt gap (bad) contains useless (corrupt) data.
+                vmuRecordKey = (gapItem.phaseName, gapItem.recordName, gapItem.source)
+                if vmuRecordKey not in vmuRecordIDs:
+                    vmuRecordIDs[vmuRecordKey] = getVmuRecordDataID(dbCon, gapItem.phaseName, gapItem.recordName, gapItem.source)
+                vmuRows.append((gapItem.vmuLastSequenceCount, gapItem.vmuStartdate, gapItem.vmuNextSequenceCount, gapItem.vmuEnddate, vmuRecordIDs[vmuRecordKey], hrdItemID))
+
+        rowCounts = flushGapRows(dbCon, hrdRows, vmuRows, 0, 0)
+        dbCur.execute('COMMIT;')
+    except Exception:
+        dbCur.execute('ROLLBACK;')
+        dbCur.close()
+        raise
+    dbCur.close()
+    ingestState['nextHrdGapID'] = nextHrdGapID
+    return rowCounts
+
+#Returns the id of the unchecked HRD gap containing a gap item, None if there is none. The merge may have checked an indexed gap since an earlier batch read it:
+#a gap found is looked up by id (once per batch, uncheckedHrdGapIDs) and dropped from the index if checked. The gaps of the batch (from firstHrdGapID) are new, so unchecked.
+def findUncheckedContainingGap(dbCur, uncheckedHrdGaps, uncheckedHrdGapIDs, firstHrdGapID, gapItem):
+    while True:
+        hrdItemID = uncheckedHrdGaps.findContaining(gapItem.channel, gapItem.lastSequenceCount, gapItem.nextSequenceCount, gapItem.startdate, gapItem.enddate)
+        if hrdItemID is None or hrdItemID >= firstHrdGapID or hrdItemID in uncheckedHrdGapIDs:
+            return hrdItemID
+        dbCur.execute('SELECT is_checked FROM hrd_packet_gap WHERE id = ?;', (hrdItemID,))
+        queryResult = dbCur.fetchall()
+        if len(queryResult) > 0 and queryResult[0][0] == 0:
+            uncheckedHrdGapIDs.add(hrdItemID)
+            return hrdItemID
+        uncheckedHrdGaps.remove(hrdItemID)
+
+#Returns the day folders to scan, oldest first.
+def getScanFolderPaths(dbCon):
+    daysBack = getVariableValue(dbCon, 'scan_days_back')
+    #Iterate backwards starting from today
+    return [getFolderPath(dbCon, dayNumber) for dayNumber in range(daysBack,0,-1)]
+
+#Reads the whole result of a day function. Runs on the scan pool threads.
+def readDayResult(dayFunction, dataPath):
+    try:
+        return [True, list(dayFunction(dataPath))]
+    except Exception, errorString:
+        return [False, errorString]
+
+#Yields back a day result read by readDayResult, raising the day error (if any) on the consumer side.
+def iterDayResult(dayResult):
+    isSuccess, result = dayResult
+    if not isSuccess:
+        raise result
+    for item in result:
+        yield item
+
+#Applies dayFunction to the day folders and yields (dataPath, items) pairs in day order. dayFunction returns the iterable of items parsed from a folder.
+#With a parallelism above 1 the folders are read by a pool of threads, several days at a time. The caller stays the only database writer: it consumes the days one after the other, as they are read.
+def mapDayFolders(dataPaths, dayFunction, parallelism):
+    if not parallelism or parallelism < 2 or len(dataPaths) < 2:
+        for dataPath in dataPaths:
+            yield dataPath, dayFunction(dataPath)
+        return
+
+    logger.info('Scanning %s day folders with %s parallel Meex runs' % (len(dataPaths), min(parallelism, len(dataPaths))))
+    pool = ThreadPool(min(parallelism, len(dataPaths)))
+    try:
+        for dataPath, dayResult in izip(dataPaths, pool.imap(lambda dataPath: readDayResult(dayFunction, dataPath), dataPaths)):
+            yield dataPath, iterDayResult(dayResult)
+    finally:
+        pool.close()
+        pool.join()
+
+#Returns the fingerprint of a day folder: number of files, total size and latest modification time.
+def getFolderFingerprint(dataPath):
+    fileCount = 0
+    totalSize = 0
+    latestMtime = 0
+    for dirPath, dirNames, fileNames in os.walk(dataPath):
+        for fileName in fileNames:
+            try:
+                fileStat = os.stat(os.path.join(dirPath, fileName))
+            except OSError:
+                continue
+            fileCount += 1
+            totalSize += fileStat.st_size
+            latestMtime = max(latestMtime, int(fileStat.st_mtime))
+    return [fileCount, totalSize, latestMtime]
+
+#Returns the manifest entries of a scan type for the given folders: {folder: [fingerprint, status, dayCounts]}. Entries of folders out of the scan range are removed.
+def getScanManifest(dbCon, scanType, dataPaths):
+    dbCur = dbCon.cursor()
+    dbCur.execute('DELETE FROM scan_manifest WHERE scan_type = ? AND folder NOT IN (%s);' % ', '.join(['?'] * len(dataPaths)), [scanType] + list(dataPaths))
+    dbCur.execute('SELECT folder, file_count, total_size, latest_mtime, status, day_counts FROM scan_manifest WHERE scan_type = ?;', (scanType,))
+    manifest = {}
+    for row in dbCur.fetchall():
+        try:
+            manifest[row[0]] = [[row[1], row[2], row[3]], row[4], json.loads(row[5]) if row[5] else []]
+        except (TypeError, ValueError), errorString:
+            logger.error('Ignoring scan manifest of %s: %s' % (row[0], errorString))
+    dbCur.close()
+    return manifest
+
+#Saves the manifest entry of a successfully scanned day folder: its fingerprint, status and packet counts (see addDayCounts), the only part of a day result given again. Days left unchanged are left as they are.
+def updateScanManifest(dbCon, dayScan):
+    if not dayScan['isChanged'] or dayScan['fingerprint'] is None:
+        return
+    fileCount, totalSize, latestMtime = dayScan['fingerprint']
+    dbCur = dbCon.cursor()
+    dbCur.execute('INSERT OR REPLACE INTO scan_manifest (timestamp, folder, scan_type, file_count, total_size, latest_mtime, status, day_counts) VALUES (datetime("now"), ?, ?, ?, ?, ?, ?, ?);', \
+    (dayScan['dataPath'], dayScan['scanType'], fileCount, totalSize, latestMtime, 'ok', json.dumps(dayScan['counts'])))
+    dbCur.close()
+
+#Returns the day dictionary of mapChangedDayFolders. Without fingerprint (incremental scanning disabled) the day is not saved in the manifest.
+def newDayScan(scanType, dataPath, fingerprint = None, isChanged = True, counts = None):
+    return {'scanType': scanType, 'dataPath': dataPath, 'fingerprint': fingerprint, 'isChanged': isChanged, 'counts': counts or []}
+
+#Same as mapDayFolders, skipping the Meex run of folders whose fingerprint (file count, total size, latest modification time) didn't change since their last successful scan.
+#Yields (dataPath, items, dayScan) triples. Changed days stream their items from dayFunction. Unchanged days give no item: their gaps are in the database already, and their packet counts
+#are in dayScan['counts']. Once a day is successfully processed, set its counts in dayScan['counts'] and pass dayScan to updateScanManifest. Incremental scanning is disabled by setting the variable scan_incremental to off.
+def mapChangedDayFolders(dbCon, scanType, dayFunction):
+    dataPaths = getScanFolderPaths(dbCon)
+    parallelism = getVariableValue(dbCon, 'scan_parallelism')
+    if str(getVariableValue(dbCon, 'scan_incremental')).lower() == 'off':
+        for dataPath, items in mapDayFolders(dataPaths, dayFunction, parallelism):
+            yield dataPath, items, newDayScan(scanType, dataPath)
+        return
+
+    manifest = getScanManifest(dbCon, scanType, dataPaths)
+    dayScans = {}
+    for dataPath in dataPaths:
+        fingerprint = getFolderFingerprint(dataPath)
+        if dataPath in manifest and manifest[dataPath][0] == fingerprint and manifest[dataPath][1] == 'ok':
+            dayScans[dataPath] = newDayScan(scanType, dataPath, fingerprint, False, manifest[dataPath][2])
+        else:
+            dayScans[dataPath] = newDayScan(scanType, dataPath, fingerprint)
+    changedDataPaths = [dataPath for dataPath in dataPaths if dayScans[dataPath]['isChanged']]
+    logger.info('%s scan: %s of %s day folders changed since their last scan' % (scanType, len(changedDataPaths), len(dataPaths)))
+
+    changedDays = mapDayFolders(changedDataPaths, dayFunction, parallelism)
+    for dataPath in dataPaths:
+        if dayScans[dataPath]['isChanged']:
+            changedDataPath, items = next(changedDays)
+            yield changedDataPath, items, dayScans[dataPath]
+        else:
+            logger.info('Day folder %s unchanged since its last scan, skipping its %s scan' % (dataPath, scanType))
+            yield dataPath, iter([]), dayScans[dataPath]
+    changedDays.close()
+
+#Counts a day folder scan in the metrics. With parallel scans the time is the one the day took to be read and saved once its turn came.
+def observeDayScan(scanType, dayStartTime, result):
+    autobrmMetrics.observeHistogram('autobrm_scan_day_seconds', (datetime.now() - dayStartTime).total_seconds(), {'scan': scanType})
+    autobrmMetrics.incrementCounter('autobrm_scan_days_total', labels = {'scan': scanType, 'result': result})
+
 #Procedure to scan the archive for gaps using the Meex software. It determines how many days in the past it needs to look and starts launching Meex list processes. The output is used to create vmu_packet_gap items, hrd_packet_gap items, and its link in the database. 
 def scanForVmuHrdGaps():
     logger.info("Start scanning the archive for VMU/HRD gaps.")
     #Make the database connection
     dbCon = dbConnectToDatabase()
     if dbCon:
-        daysBack = getVariableValue(dbCon, 'scan_days_back')
         meexCommandBin = getVariableValue(dbCon, 'meex_command_bin')
-        #Iterate backwards starting from today
-        for dayNumber in range(daysBack,0,-1):
-            dataPath = getFolderPath(dbCon, dayNumber)
-            #Compose scan command
-            scanCommand = 'ionice -c3 %s list -e -k vmu %s | /opt/autobrm/bin/sqchk.awk |grep -vE "IMG|SCC"' % (meexCommandBin, dataPath)
-            logger.debug(scanCommand)
+        scanStartTime = datetime.now()
+        scanRowCount = 0
+        #Compose scan command. The sequence check is done in-process by the sqchk module (sqchkVectorized if the variable scan_gap_detector is set to vectorized), unless scan_gap_detector is set to awk.
+        if getVariableValue(dbCon, 'scan_gap_detector') == 'awk':
+            scanCommand = 'ionice -c3 %s list -e -k vmu %s | /opt/autobrm/bin/sqchk.awk |grep -vE "IMG|SCC"'
+            def scanDayFolder(dataPath):
+                logger.debug(scanCommand % (meexCommandBin, dataPath))
+                return iterGapOutputItems(streamCommandOutput(scanCommand % (meexCommandBin, dataPath)))
+        else:
+            scanCommand = 'ionice -c3 %s list -e -k vmu %s'
+            checkModule = getSequenceCheckModule(dbCon)
+            def scanDayFolder(dataPath):
+                logger.debug(scanCommand % (meexCommandBin, dataPath))
+                return iterSequenceCheckItems(streamCommandOutput(scanCommand % (meexCommandBin, dataPath)), dataPath, checkModule)
+
+        for dataPath, gapItems, dayScan in mapChangedDayFolders(dbCon, 'gap', scanDayFolder):
+            dayStartTime = datetime.now()
+            if not dayScan['isChanged']:
+                continue
             try:
-                #Execute command
-                gapOutput = commands.getstatusoutput(scanCommand)       
-                if gapOutput[0] == 0:
-                    #Parse results
-                    gaps = gapOutput[1].split('\n')
-                    for gapItem in gaps:
-                        logger.debug(gapItem)
-                        if '|' in gapItem:
-                            #Split HRD and VMU part
-                            hrd = {}
-                            vmu = {}
-                            hrd_string = gapItem.split('||')[0]
-                            vmu_string = gapItem.split('||')[1]
-
-                            #Determine sqchk.awk output entry item type: either 'G' or 'B'
-                            ## 'G' for 'GAP' is a regular gap. Missing data between two received packets
-                            ## 'B' for 'BAD' is a gap composed by one or more corrupt packets.
-                            itemType = hrd_string.split('|')[0].strip()
-                            
-                            #Parse HRD line
-                            try:
-                                hrd['channel'] = hrd_string.split('|')[1].strip()
-                                hrd['startdate'] = hrd_string.split('|')[2].strip()
-                                hrd['last_sequence_count'] = hrd_string.split('|')[4].strip()
-                                hrd['enddate'] = hrd_string.split('|')[3].strip()
-                                hrd['next_sequence_count'] = hrd_string.split('|')[5].strip()
-                                hrd['difference'] = int(hrd_string.split('|')[6].strip())
-                            except Exception, errorString:
-                                    logger.error(errorString)
-                                    hrd['channel'] = None
-                                    hrd['startdate'] = None
-                                    hrd['last_sequence_count'] = None
-                                    hrd['enddate'] = None
-                                    hrd['next_sequence_count'] = None
-                                    hrd['difference'] = None
-                            
-                            #Parse the VMU line
-                            if itemType == 'G':
-                                #This is a regular Gap
-                                try:
-                                    vmu['source'] = vmu_string.split('|')[0].strip()
-                                    vmu['startdate'] = vmu_string.split('|')[1].strip()
-                                    vmu['last_sequence_count'] = vmu_string.split('|')[3].strip()
-                                    vmu['enddate'] = vmu_string.split('|')[2].strip()
-                                    vmu['next_sequence_count'] = vmu_string.split('|')[4].strip()
-                                    vmu['difference'] = int(vmu_string.split('|')[5].strip())
-                                    #Parse user VMU record name
-                                    upi_string = vmu_string.split('|')[6].strip()
-                                    vmu['phaseName'] = None
-                                    vmu['recordName'] = upi_string
-                                    
-                                except Exception, errorString:
-                                    logger.error(errorString)
-                                    vmu['source'] = None
-                                    vmu['phaseName'] = None
-                                    vmu['recordName'] = None
-                                    vmu['difference'] = None
-                                    
-                            elif itemType == 'B':
-                                #This is a corrupt packet Gap
-                                vmu['source'] = vmu_string.split('|')[0].strip()
-                                vmu['difference'] = None
-
-                            #Save the data
-                            #if no VMU gap sequence count skip is observed (hrd header sequence counts are not contiguous), then contonue to input the gap/corrupt range into the replay queue table
-                            if ((hrd['difference'] >=  vmu['difference']) and itemType == 'G') or (itemType == 'B'):
-                                #Save the data in the hrd_packet_gap table
-                                if (hrd['difference'] > 0 and itemType == 'G') or (itemType == 'B'):
-                                    ## If there is an HRD gap (VMU gaps doesn't always correspond to an HRD gap: i.e. Packet skipped when sent out by VMU) OR it is a gap involving corruption (bad)
-                                    #### Query and get ID if gap contained in existing gap, otherwise Insert and get ID of the inserted entry.
-                                    hrdItemID = insertHrdGapItem(dbCon, hrd['channel'], hrd['startdate'], hrd['last_sequence_count'], hrd['enddate'], hrd['next_sequence_count'])
-                                else:
-                                    hrdItemID = None
-
-                                #Save the data in the vmu_packet_gap table & And link to HRD item (if any)
-                                if itemType == 'G':
-                                    ## Only if it a regular gap. A corrupt gap (bad) contains useless (corrupt) data.
-                                    insertVmuGapItem(dbCon, vmu['phaseName'], vmu['recordName'], vmu['source'], vmu['startdate'], vmu['last_sequence_count'], vmu['enddate'], vmu['next_sequence_count'], hrdItemID)
-                                
+                #Execute command, parse the results as they come and save them by short batches once the day is read. A command failure writes nothing of the day.
+                scanRowCount += ingestGapItems(dbCon, gapItems, dataPath)
+                updateScanManifest(dbCon, dayScan)
+                observeDayScan('gap', dayStartTime, 'ok')
                         
             except Exception, errorString:
-                logger.error(scanCommand)
+                logger.error(scanCommand % (meexCommandBin, dataPath))
                 logger.error(errorString)
-                        
-        dbCon.close()
+                observeDayScan('gap', dayStartTime, 'error')
+
+        scanSeconds = max((datetime.now() - scanStartTime).total_seconds(), 0.001)
+        logger.info('Scan for VMU/HRD gaps finished: %s rows saved in %.1f s (%.0f rows/s)' % (scanRowCount, scanSeconds, scanRowCount / scanSeconds))
+        dbCloseConnection()
+    #New gaps to merge
+    triggerTask('merge')
      
+#Parses one Meex count output line. Returns the phase, record name, source and packet count, or None for lines which are not a count item.
+def parseCountOutputLine(countItem):
+    if '|' not in countItem:
+        return None
+    packetCount = None
+    try:
+        date = countItem.split('|')[0].strip()
+        source = countItem.split('|')[1].split('/')[0].strip()
+        #Parse user VMU record name
+        upi_string = countItem.split('|')[1].split('/')[2].strip()
+        phaseName = None
+        recordName = upi_string
+        
+        if re.match("^[0-9_]*$", countItem.split('|')[2].strip()) and re.match("^[0-9_]*$", countItem.split('|')[3].strip()):
+            #Is Numeric count data
+            packetCount = int(countItem.split('|')[2].strip())
+            
+    except Exception, errorString:
+        logger.error(errorString)
+        date = None
+        source = None
+        phaseName = None
+        recordName = None
+        packetCount = None
+
+    return [phaseName, recordName, source, packetCount]
+
+#Yields the count items parsed from Meex count output lines.
+def iterCountOutputItems(countLines):
+    for countItem in countLines:
+        countData = parseCountOutputLine(countItem)
+        if countData is not None:
+            yield countData
+
+#Adds the count items of a day (phase, record name, source, packet count) to the cumulative per vmu_record dictionary. Nothing is added if reading the items fails.
+#Returns the day totals as count items, one per phase, record name and source, the form kept in the scan manifest.
+def addDayCounts(dbCon, countItems, totalFiles):
+    dayCounts = {}
+    dayKeys = []
+    for phaseName, recordName, source, packetCount in countItems:
+        #if data: Save in a cumulative dictionary
+        if source is not None and phaseName is not None and recordName is not None and packetCount is not None:
+            if (phaseName, recordName, source) in dayCounts:
+                dayCounts[(phaseName, recordName, source)] += packetCount
+            else:
+                dayCounts[(phaseName, recordName, source)] = packetCount
+                dayKeys.append((phaseName, recordName, source))
+
+    for phaseName, recordName, source in dayKeys:
+        vmuRecordID = getVmuRecordDataID(dbCon, phaseName, recordName, source)
+        if vmuRecordID in totalFiles:
+            totalFiles.update({vmuRecordID: totalFiles[vmuRecordID] + dayCounts[(phaseName, recordName, source)]})
+        else:
+            totalFiles.update({vmuRecordID: dayCounts[(phaseName, recordName, source)]})
+    return [[phaseName, recordName, source, dayCounts[(phaseName, recordName, source)]] for (phaseName, recordName, source) in dayKeys]
+
 #Procedure to scan the archive in order to obtain the amount of packets per VMU phase, recordname and source. It determines how many days in the past it needs to look and starts launching Meex count processes. The output is used to create tiestamped vmu_packet_count items in the database.
 def scanForVmuNumberOfFiles():
     logger.info("Start scanning the archive for packet counts.")
@@ -618,62 +1161,94 @@ def scanForVmuNumberOfFiles():
         #Some initialization
         dataSourceName = 'hrdp meex'
         totalFiles = {}
-        #Hoy many days back do we have to scan?
-        daysBack = getVariableValue(dbCon, 'scan_days_back')
         meexCommandBin = getVariableValue(dbCon, 'meex_command_bin')
+        scanCommand = 'ionice -c3 %s count -k hrd %s | egrep -av "(SCC/SCC|IMG/IMG)"'
+        def scanDayFolder(dataPath):
+            logger.debug(scanCommand % (meexCommandBin, dataPath))
+            return iterCountOutputItems(streamCommandOutput(scanCommand % (meexCommandBin, dataPath)))
 
-        #Iterate backwards over the days starting today
-        for dayNumber in range(daysBack,0,-1):
-            dataPath = getFolderPath(dbCon, dayNumber)
-            scanCommand = 'ionice -c3 %s count -k hrd %s | egrep -av "(SCC/SCC|IMG/IMG)"' % (meexCommandBin, dataPath)
-            logger.debug(scanCommand)
+        #Hoy many days back do we have to scan? Iterate backwards over the days starting today
+        for dataPath, countItems, dayScan in mapChangedDayFolders(dbCon, 'count', scanDayFolder):
+            dayStartTime = datetime.now()
             try:
-                #Execute command
-                countOutput = commands.getstatusoutput(scanCommand)
-                if countOutput[0] == 0:
-                    #Parse output
-                    counts = countOutput[1].split('\n')
-                    #Populate the list
-                    for countItem in counts:
-                        if '|' in countItem:
-                            try:
-                                date = countItem.split('|')[0].strip()
-                                source = countItem.split('|')[1].split('/')[0].strip()
-                                #Parse user VMU record name
-                                upi_string = countItem.split('|')[1].split('/')[2].strip()
-                                phaseName = None
-                                recordName = upi_string
-                                
-                                if re.match("^[0-9_]*$", countItem.split('|')[2].strip()) and re.match("^[0-9_]*$", countItem.split('|')[3].strip()):
-                                    #Is Numeric count data
-                                    packetCount = int(countItem.split('|')[2].strip())
-                                    
-                            except Exception, errorString:
-                                logger.error(errorString)
-                                date = None
-                                source = None
-                                phaseName = None
-                                recordName = None
-                                packetCount = None
-                            
-                            #if data: Save in a cumulative dictionary
-                            if source is not None and phaseName is not None and recordName is not None and packetCount is not None:
-                                vmuRecordID = getVmuRecordDataID(dbCon, phaseName, recordName, source)
-                                if vmuRecordID in totalFiles:
-                                    totalFiles.update({vmuRecordID: totalFiles[vmuRecordID] + packetCount})
-                                else:
-                                    totalFiles.update({vmuRecordID: packetCount})
+                #Parse the output as it comes. The day counts are only kept if the command succeeds. An unchanged day gives its counts of the last scan.
+                dayScan['counts'] = addDayCounts(dbCon, countItems if dayScan['isChanged'] else dayScan['counts'], totalFiles)
+                updateScanManifest(dbCon, dayScan)
+                observeDayScan('count', dayStartTime, 'ok')
                                 
             except Exception, errorString:
                 logger.error(errorString)
+                observeDayScan('count', dayStartTime, 'error')
             
         #Save the data from the cumulative dictionary into the vmu_packet_count table           
         if len(totalFiles) > 0:
             for recordID, count in totalFiles.iteritems():
                 insertVmuPacketCount(dbCon, dataSourceName, recordID, count)
         
-        dbCon.close()
+        dbCloseConnection()
             
+#Yields the entries of a single Meex listing read: ('gap', gap item) entries as the sequence checker finds them, then one ('count', count item) entry per origin and user VMU record counted in the listing.
+def iterArchiveScanEntries(listingLines, dataPath = None, checkModule = sqchk):
+    checker = checkModule.SequenceChecker()
+    counter = sqchk.PacketCounter()
+    for record in checkModule.checkAndCountLines(listingLines, checker, counter):
+        yield ['gap', recordToGapItem(record)]
+    for (source, recordName), packetCount in counter.counts.iteritems():
+        yield ['count', [None, recordName, source, packetCount]]
+    logger.info('%s: %s' % (dataPath, ', '.join([line.strip() for line in checker.summary().split('\n') if line.strip()])))
+
+#Procedure scanning the archive for gaps and packet counts at once: one Meex listing per day folder feeds both the sequence checker and the packet counter, instead of separate 'list' and 'count' runs reading the archive twice.
+#Produces the same hrd_packet_gap, vmu_packet_gap and vmu_packet_count items as scanForVmuHrdGaps and scanForVmuNumberOfFiles. Enabled by setting the variable scan_mode to combined.
+def scanArchive():
+    logger.info("Start scanning the archive for VMU/HRD gaps and packet counts.")
+    #Make the database connection
+    dbCon = dbConnectToDatabase()
+    if dbCon:
+        dataSourceName = 'hrdp meex'
+        totalFiles = {}
+        meexCommandBin = getVariableValue(dbCon, 'meex_command_bin')
+        scanStartTime = datetime.now()
+        scanRowCount = 0
+        scanCommand = 'ionice -c3 %s list -e -k vmu %s'
+        checkModule = getSequenceCheckModule(dbCon)
+        def scanDayFolder(dataPath):
+            logger.debug(scanCommand % (meexCommandBin, dataPath))
+            return iterArchiveScanEntries(streamCommandOutput(scanCommand % (meexCommandBin, dataPath)), dataPath, checkModule)
+
+        for dataPath, scanEntries, dayScan in mapChangedDayFolders(dbCon, 'archive', scanDayFolder):
+            dayStartTime = datetime.now()
+            countItems = []
+            def iterGapEntries(scanEntries):
+                for entryType, entry in scanEntries:
+                    if entryType == 'gap':
+                        yield entry
+                    else:
+                        countItems.append(entry)
+            try:
+                #Read the gaps as they come and save them by short batches once the day is read, the counts come last. A command failure writes nothing of the day and drops its counts.
+                #An unchanged day has no gap to save and gives its counts of the last scan.
+                if dayScan['isChanged']:
+                    scanRowCount += ingestGapItems(dbCon, iterGapEntries(scanEntries), dataPath)
+                dayScan['counts'] = addDayCounts(dbCon, countItems if dayScan['isChanged'] else dayScan['counts'], totalFiles)
+                updateScanManifest(dbCon, dayScan)
+                observeDayScan('archive', dayStartTime, 'ok')
+
+            except Exception, errorString:
+                logger.error(scanCommand % (meexCommandBin, dataPath))
+                logger.error(errorString)
+                observeDayScan('archive', dayStartTime, 'error')
+
+        #Save the data from the cumulative dictionary into the vmu_packet_count table
+        if len(totalFiles) > 0:
+            for recordID, count in totalFiles.iteritems():
+                insertVmuPacketCount(dbCon, dataSourceName, recordID, count)
+
+        scanSeconds = max((datetime.now() - scanStartTime).total_seconds(), 0.001)
+        logger.info('Archive scan finished: %s rows saved in %.1f s (%.0f rows/s)' % (scanRowCount, scanSeconds, scanRowCount / scanSeconds))
+        dbCloseConnection()
+    #New gaps to merge
+    triggerTask('merge')
+
 #Determines when it is Ok to start scanning the archive with Meex again. In order not to stress the archive unnecessary, a scan time offset is defined in the database.            
 def isTime2Scan():
     dbCon = dbConnectToDatabase()
@@ -685,13 +1260,20 @@ def isTime2Scan():
     dbCur.execute(queryStatement)
     queryResult = dbCur.fetchall()
     dbCur.close()
-    dbCon.close()
+    dbReleaseConnection(dbCon)
     #Is there data? OR Is the data old enough?
     if queryResult[0][0] is None or queryResult[0][0] > scanFrequencyMinutes:
         return True
     else:
         return False
 
+#Returns the archive scan mode: 'combined' for a single Meex read per day folder (see scanArchive), anything else for the separate gap and count scans.
+def getScanMode():
+    dbCon = dbConnectToDatabase()
+    scanMode = getVariableValue(dbCon, 'scan_mode')
+    dbReleaseConnection(dbCon)
+    return scanMode
+
 #Returns the next replay item to be processed by the tool. The database view queried has the sorting order.
 def getNextReplayItem(dbCon):
     dbCur = dbCon.cursor()
@@ -718,9 +1300,9 @@ def getNextReplayItem(dbCon):
 #Returns the replay item start and end datetimes, from the replay id input argument.
 def getReplayItemDetails(dbCon, replayItemID):
     dbCur = dbCon.cursor()
-    queryStatement = 'SELECT strftime("%%Y.%%j.%%H.%%M.%%S",startdate) as startdate, strftime("%%Y.%%j.%%H.%%M.%%S",enddate) as enddate FROM replay WHERE id = %s;' % replayItemID
-    logger.debug(queryStatement)
-    dbCur.execute(queryStatement)
+    queryStatement = 'SELECT strftime("%Y.%j.%H.%M.%S",startdate) as startdate, strftime("%Y.%j.%H.%M.%S",enddate) as enddate FROM replay WHERE id = ?;'
+    logger.debug('%s (%s,)' % (queryStatement, replayItemID))
+    dbCur.execute(queryStatement, (replayItemID,))
     queryResult = dbCur.fetchall()
     dbCur.close()
     #Get relevant data
@@ -733,7 +1315,7 @@ def issueBitstreamRequest(dbCon, source_user, source_ip, brm_instance, startDate
     bitstreamBin = getVariableValue(dbCon, 'bitstreamrequest_bin')
     bitstreamFile = getVariableValue(dbCon, 'bitstreamrequest_profile_file')
     #Compose the command witt the parameters
-    brmCommand = 'ssh -q %s@%s \'java -jar %s \
+    brmCommand = 'java -jar %s \
     -file %s \
     -I %s \
     -startTime %s \
@@ -742,10 +1324,10 @@ def issueBitstreamRequest(dbCon, source_user, source_ip, brm_instance, startDate
     -deliveryuri %s://%s:%s \
     -missionMode %s \
     -source %s \
-    -dm %s\'' % (source_user, source_ip, bitstreamBin, bitstreamFile, brm_instance, startDate, endDate, bitrate, brm_delivery_host_protocol, brm_delivery_host_ip, brm_delivery_host_port, brm_delivery_host_mission_mode, source, dataMode)
-    logger.info(brmCommand)
-    #Launch the command
-    commandOutputCode, commandOutputString = commands.getstatusoutput(brmCommand)
+    -dm %s' % (bitstreamBin, bitstreamFile, brm_instance, startDate, endDate, bitrate, brm_delivery_host_protocol, brm_delivery_host_ip, brm_delivery_host_port, brm_delivery_host_mission_mode, source, dataMode)
+    logger.info('%s@%s: %s' % (source_user, source_ip, brmCommand))
+    #Launch the command through the persistent SSH session of the host
+    commandOutputCode, commandOutputString = remoteCommand.getSshRunner(source_user, source_ip).run(brmCommand)
     #Parse the output
     commandExitCode = commandOutputCode >> 8
     commandSignalNum = commandOutputCode % 256
@@ -754,11 +1336,6 @@ def issueBitstreamRequest(dbCon, source_user, source_ip, brm_instance, startDate
 
 #Collects the necesary replay item parameters neede to launch a bitstream request. Input is a replay item ID and DaSS source and data mode against where to place the bitstream request.
 def processReplayBrm(replayItemID, source, dataMode):
-    global globalCaduCounter
-
-    #Reset CADU counter
-    globalCaduCounter['ocurrences'] = 0
-
     #Make database connection
     dbCon = dbConnectToDatabase()
     if dbCon:
@@ -775,12 +1352,14 @@ def processReplayBrm(replayItemID, source, dataMode):
         bitrate = getVariableValue(dbCon, 'bitstreamrequest_bitrate')
         startDate, endDate = getReplayItemDetails(dbCon, replayItemID)
         #Launch
+        startTime = datetime.now()
         try:
             outputCode, outputString = issueBitstreamRequest(dbCon, source_user, source_ip, brm_instance, startDate, endDate, bitrate, brm_delivery_host_protocol, brm_delivery_host_ip, brm_delivery_host_port, brm_delivery_host_mission_mode, source, dataMode)
         except Exception, errorString:
             logger.error(errorString)
             outputCode = -1
             outputString = errorString
+        autobrmMetrics.observeHistogram('autobrm_bitstream_request_seconds', (datetime.now() - startTime).total_seconds(), {'source': source, 'result': 'ok' if outputCode == 0 else 'failed'})
         
         #Parse the Bitstream request exit code
         if outputCode == 0:
@@ -790,15 +1369,18 @@ def processReplayBrm(replayItemID, source, dataMode):
         else:
             #Command abnormal exit code, set as failed
             stateName = 'FAILED'
+            autobrmMetrics.incrementCounter('autobrm_replays_failed_total', labels = {'source': source})
             #Change Job state to next in line
             setReplayItemState(dbCon, replayItemID, stateName, '%s: %s' % (outputCode, outputString[-90:]))
             
-        dbCon.close()                 
+        dbCloseConnection()
+    #Free for the next request
+    releaseBitstreamRequest(replayItemID)
 
 #Specifies the specific DaSS source and data mode against where to place the bitstream request. In this case its a rate adapted AOS archive high rate data request.    
 def processReplayBrmRT(replayItemID):
     logger.info("Starting a Bitstream request to the AOS Archive")
-    source = 'COLVC_RealTime'
+    source = bitstreamRequestSources['processReplayBrmRT']
     dataMode = 'DaSSPlayback'
     #Launch the main bitstream procedure
     processReplayBrm(replayItemID, source, dataMode)
@@ -806,52 +1388,207 @@ def processReplayBrmRT(replayItemID):
 #Specifies the specific DaSS source and data mode against where to place the bitstream request. In this case its a rate adapted LOS archive high rate data request.    
 def processReplayBrmExtPB(replayItemID):
     logger.info("Starting a Bitstream request to the LOS Archive")
-    source = 'COLVC_PDSS_Playback'
+    source = bitstreamRequestSources['processReplayBrmExtPB']
     dataMode = 'DaSSPlayback'
     #Launch the main bitstream procedure
     processReplayBrm(replayItemID, source, dataMode)
 
-#Scans the database for replay items in the queue to be executed and starts processing them.    
+#DaSS source of each replay procedure, the per source concurrency limits apply to it
+bitstreamRequestSources = {'processReplayBrmRT': 'COLVC_RealTime', 'processReplayBrmExtPB': 'COLVC_PDSS_Playback'}
+#Replay items looked at per dispatch
+bitstreamRequestQueueLookahead = 50
+#Running bitstream requests per replay item ID: thread, DaSS source, bitrate, replay window, CADU counter parameter of the source and no data cycle count. Shared with the stuck request scan.
+bitstreamRequests = {}
+bitstreamRequestsLock = threading.Lock()
+
+#Returns the replay items waiting in the queue, in the queue order.
+#By default the replay items are ordered by the time left before their data leaves the Col-CC buffer (see replayScheduler), and the ones which can't make it any more are set as EXPIRED.
+#With the variable replay_scheduler set to fifo, the order and filter are the ones of the next_replay_in_queue view, as defined on the database.
+def getQueuedReplayItems(dbCon, limit):
+    if str(getVariableValue(dbCon, 'replay_scheduler')).lower() == 'fifo':
+        dbCur = dbCon.cursor()
+        queryStatement = 'SELECT replayID, replayStatus, functionName FROM next_replay_in_queue LIMIT ?;'
+        logger.debug('%s (%s,)' % (queryStatement, limit))
+        dbCur.execute(queryStatement, (limit,))
+        queryResult = [[row[0], row[1], str(row[2])] for row in dbCur.fetchall()]
+        dbCur.close()
+        return queryResult
+
+    bufferHours = getVariableValue(dbCon, 'replay_buffer_hours')
+    if not isinstance(bufferHours, int): bufferHours = replayBufferHours
+    prioritySeconds = getVariableValue(dbCon, 'replay_priority_seconds')
+    if not isinstance(prioritySeconds, int): prioritySeconds = replayPrioritySeconds
+    replayItems, expiredItems = replayScheduler.orderReplayItems(queryQueuedReplayItems(dbCon), getDatabaseEpoch(dbCon), bufferHours * 3600, \
+    getReplayRatio(dbCon), getRequestOverheadSeconds(dbCon), prioritySeconds)
+    for replayItem in expiredItems:
+        if expireReplayItem(dbCon, replayItem['replayID'], replayItem['state'], 'Buffer expiry missed by %ss' % int(-replayItem['slackSeconds'])):
+            logger.warning('Replay item %s (%s) given up: its data leaves the Col-CC buffer before it could be replayed' % (replayItem['replayID'], replayItem['state']))
+            autobrmMetrics.incrementCounter('autobrm_replays_expired_total')
+    return [[replayItem['replayID'], replayItem['state'], replayItem['functionName']] for replayItem in replayItems[:limit]]
+
+#Returns the replay items waiting in a state with a procedure, as dictionaries for replayScheduler.
+def queryQueuedReplayItems(dbCon):
+    dbCur = dbCon.cursor()
+    queryStatement = 'SELECT r.id, rs.name, rs.function_name, r.priority, strftime("%s",r.startdate), strftime("%s",r.enddate) FROM replay_status rs \
+    CROSS JOIN replay r ON r.replay_status_id = rs.id WHERE rs.function_name IS NOT NULL;'
+    logger.debug(queryStatement)
+    dbCur.execute(queryStatement)
+    replayItems = []
+    for row in dbCur.fetchall():
+        replayItems.append({'replayID': row[0], 'state': row[1], 'functionName': str(row[2]), 'priority': row[3], \
+        'startEpoch': None if row[4] is None else int(row[4]), 'endEpoch': None if row[5] is None else int(row[5])})
+    dbCur.close()
+    return replayItems
+
+#Returns the current UTC time as seconds since epoch, from the database clock the replay datetimes are compared with.
+def getDatabaseEpoch(dbCon):
+    dbCur = dbCon.cursor()
+    dbCur.execute('SELECT strftime("%s","now");')
+    queryResult = dbCur.fetchall()
+    dbCur.close()
+    return int(queryResult[0][0])
+
+#Sets a replay item as EXPIRED, only if it is still in the given state (see claimReplayItem). Returns True if set.
+def expireReplayItem(dbCon, replayItemID, replayItemState, text):
+    dbCur = dbCon.cursor()
+    autobrmDatabase.beginImmediate(dbCur, 'expiry')
+    try:
+        dbCur.execute('SELECT rs.name FROM replay r JOIN replay_status rs ON rs.id = r.replay_status_id WHERE r.id = ?;', (replayItemID,))
+        queryResult = dbCur.fetchall()
+        isExpired = len(queryResult) > 0 and queryResult[0][0] == replayItemState
+        if isExpired:
+            setReplayItemState(dbCon, replayItemID, 'EXPIRED', text)
+        dbCur.execute('COMMIT;')
+    except Exception:
+        dbCur.execute('ROLLBACK;')
+        dbCur.close()
+        raise
+    dbCur.close()
+    return isExpired
+
+#Claims a replay item for processing by moving it to its next workflow state, only if it is still in the given state. Returns True if claimed.
+#The check and the move are done within one write transaction, so a replay item is never claimed twice.
+def claimReplayItem(dbCon, replayItemID, replayItemState):
+    dbCur = dbCon.cursor()
+    autobrmDatabase.beginImmediate(dbCur, 'claim')
+    try:
+        dbCur.execute('SELECT rs.name FROM replay r JOIN replay_status rs ON rs.id = r.replay_status_id WHERE r.id = ?;', (replayItemID,))
+        queryResult = dbCur.fetchall()
+        isClaimed = len(queryResult) > 0 and queryResult[0][0] == replayItemState
+        if isClaimed:
+            incrementReplayItemState(dbCon, replayItemID)
+        dbCur.execute('COMMIT;')
+    except Exception:
+        dbCur.execute('ROLLBACK;')
+        dbCur.close()
+        raise
+    dbCur.close()
+    return isClaimed
+
+#CADU counter parameter (DaSS_PP namespace) showing the data of a DaSS source coming in, unless set by the variable bitstreamrequest_cadu_parameter_<source>
+defaultCaduCountParameter = 'HRDFE_vc1_caduCount_PP'
+
+#Returns the CADU counter parameter of a DaSS source: variable bitstreamrequest_cadu_parameter_<source>, defaultCaduCountParameter if not set.
+def getCaduCountParameter(dbCon, source):
+    parameterName = getVariableValue(dbCon, 'bitstreamrequest_cadu_parameter_%s' % source.lower())
+    return str(parameterName) if parameterName else defaultCaduCountParameter
+
+#Returns the number of bitstream requests allowed at once against a DaSS source: variable bitstreamrequest_concurrency_<source>, 1 if not set.
+def getBitstreamRequestLimit(dbCon, source):
+    requestLimit = getVariableValue(dbCon, 'bitstreamrequest_concurrency_%s' % source.lower())
+    return requestLimit if isinstance(requestLimit, int) else 1
+
+#Returns the running bitstream requests, forgetting the finished ones.
+def getRunningBitstreamRequests():
+    with bitstreamRequestsLock:
+        for replayItemID in [replayItemID for (replayItemID, request) in bitstreamRequests.items() if not request['thread'].isAlive()]:
+            del bitstreamRequests[replayItemID]
+        return dict(bitstreamRequests)
+
+#Forgets a finished bitstream request and dispatches the next ones right away. Called by the request thread as it ends.
+def releaseBitstreamRequest(replayItemID):
+    with bitstreamRequestsLock:
+        bitstreamRequests.pop(replayItemID, None)
+    triggerTask('dispatch')
+
+#Scans the database for replay items in the queue to be executed and starts processing them.
+#Several requests run at once, within the per DaSS source limits and the bitrate budget (variable bitstreamrequest_bitrate_budget, by default bitstreamrequest_bitrate: one request at a time).
 def issueReplayFromReplayList():
-    global threadCommandLineBitstreamRequest
-    
     #Make database connection
     dbCon = dbConnectToDatabase()
     if dbCon:
-        #Get new ReplayItem in line to be process
-        replayItemID, replayItemState, replayItemFunctionName = getNextReplayItem(dbCon)
+        runningRequests = getRunningBitstreamRequests()
+        bitrate = getVariableValue(dbCon, 'bitstreamrequest_bitrate')
+        if not isinstance(bitrate, int): bitrate = 0
+        bitrateBudget = getVariableValue(dbCon, 'bitstreamrequest_bitrate_budget')
+        if not isinstance(bitrateBudget, int): bitrateBudget = bitrate
+        usedBitrate = sum([request['bitrate'] for request in runningRequests.values()])
+        sourceRequestCount = {}
+        for request in runningRequests.values():
+            sourceRequestCount[request['source']] = sourceRequestCount.get(request['source'], 0) + 1
 
-        #Is no request is on-going; Is no request is taking too long ? Process request
-        if (replayItemID is not None) and (not threadCommandLineBitstreamRequest.isAlive()):
+        #Walk the queue in order: a replay item waiting for a busy source doesn't hold back the others
+        for replayItemID, replayItemState, replayItemFunctionName in getQueuedReplayItems(dbCon, bitstreamRequestQueueLookahead):
+            if usedBitrate + bitrate > bitrateBudget:
+                break
+            if replayItemID in runningRequests or replayItemFunctionName not in globals():
+                continue
+            source = bitstreamRequestSources.get(replayItemFunctionName, replayItemFunctionName)
+            if sourceRequestCount.get(source, 0) >= getBitstreamRequestLimit(dbCon, source):
+                continue
             #Increment State
-            incrementReplayItemState(dbCon, replayItemID)
-            
-            #Base on its state, act acordingly
-            if replayItemFunctionName in globals():
-                #Create new thread!
-                threadCommandLineBitstreamRequest = threading.Thread(target = globals()[replayItemFunctionName], name='BitstreamClient', args=[replayItemID])
-                #Call the function name defined on the table replay_status: processReplayBrmRT() or processReplayBrmExtPB() for instance
-                threadCommandLineBitstreamRequest.start()
-        
-        dbCon.close()
+            if not claimReplayItem(dbCon, replayItemID, replayItemState):
+                continue
 
-#Read and return parameter current value from Yamcs
+            startDate, endDate = getReplayItemDetails(dbCon, replayItemID)
+            #Call the function name defined on the table replay_status: processReplayBrmRT() or processReplayBrmExtPB() for instance
+            requestThread = threading.Thread(target = globals()[replayItemFunctionName], name='BitstreamClient-%s' % replayItemID, args=[replayItemID])
+            with bitstreamRequestsLock:
+                bitstreamRequests[replayItemID] = {'thread': requestThread, 'source': source, 'bitrate': bitrate, 'startDate': startDate, 'endDate': endDate, \
+                'sourceUser': getVariableValue(dbCon, 'bitstreamrequest_source_user'), 'sourceIP': getVariableValue(dbCon, 'bitstreamrequest_source_ip'), \
+                'caduParameter': getCaduCountParameter(dbCon, source), 'ocurrences': 0}
+            requestThread.start()
+            autobrmMetrics.incrementCounter('autobrm_replays_dispatched_total', labels = {'source': source})
+            usedBitrate += bitrate
+            sourceRequestCount[source] = sourceRequestCount.get(source, 0) + 1
+
+        dbReleaseConnection(dbCon)
+
+#Subscription to the Yamcs parameters, None while polling
+parameterSubscription = None
+
+#Starts the Yamcs WebSocket subscription to the CADU counters of the DaSS sources: the stuck request scan then reads the last pushed values instead of polling.
+def startParameterSubscription():
+    global parameterSubscription
+    dbCon = dbConnectToDatabase()
+    parameterNames = sorted(set([getCaduCountParameter(dbCon, source) for source in bitstreamRequestSources.values()]))
+    dbReleaseConnection(dbCon)
+    parameterSubscription = yamcsSubscription.ParameterSubscription(yamcsServer, yamcsPort, yamcsInstance, [['DaSS_PP', parameterName] for parameterName in parameterNames], \
+    yamcsUsername, yamcsPassword, getYamcsClient().getParameterValues, logger)
+    parameterSubscription.start()
+
+#Returns parameter current value: the last value pushed by the subscription if connected, read from Yamcs otherwise
 def getYamcsParameterValue(parameterName):
+    if parameterSubscription is not None and parameterSubscription.isConnected:
+        parameterValue = parameterSubscription.getValue(parameterName)
+        if parameterValue is not None:
+            return parameterValue
+    return readYamcsParameterValue(parameterName)
+
+#Returns the Yamcs REST client (keep-alive connections, timeouts and retries, see yamcsClient)
+def getYamcsClient():
+    return yamcsClient.getYamcsClient(yamcsServer, yamcsPort, yamcsInstance, yamcsUsername, yamcsPassword)
+
+#Read and return parameter current value from Yamcs
+def readYamcsParameterValue(parameterName):
     logger.debug('Get parameter value from Yamcs')
-    #Local/PDC
-    server = 'yamcs-pdc-em.fsl'; username = '********'; password = '********'
-    request = urllib2.Request("http://%s:8090/api/processors/fsl-em-dev/realtime/parameters/DaSS_PP/%s" % (server, parameterName))
-    base64string = base64.b64encode('%s:%s' % (username, password))
-    request.add_header("Authorization", "Basic %s" % base64string)
-    result = urllib2.urlopen(request).read()
-    resultJson = json.loads(result)
+    resultJson = getYamcsClient().getParameterValue('DaSS_PP', parameterName)
     
     logger.debug(resultJson)
     return resultJson
     
-#Check if we receiving high rate data on the VC0 (Archive request)    
-def isHRDbeingReceived(globalCaduCounter):
-    parameterName = 'HRDFE_vc1_caduCount_PP'
+#Check if we receiving high rate data on the VC0 (Archive request), by default. The counter state is the one of the given CADU counter parameter.
+def isHRDbeingReceived(globalCaduCounter, parameterName = defaultCaduCountParameter):
     currentCaduCounter = getYamcsParameterValue(parameterName)
    
     #Is the VC0 Cadu counter increasing?   
@@ -872,51 +1609,80 @@ def isHRDbeingReceived(globalCaduCounter):
 
     return isReceivingData
 
-#Check if the bitstream client request process stuck? If it's taking more time than expected to process it might be stuck.
+#Check if the bitstream client requests are stuck? If one is taking more time than expected to process it might be stuck.
+#Every request counts its own no data cycles from its start, reset only when the CADU counter of its own DaSS source moves (see getCaduCountParameter), and only the stuck ones are terminated.
 def scanForStuckBitstreamClientRequest():
-    global threadCommandLineBitstreamRequest
     global globalCaduCounter
     maxOcurrences = 72 #72 times 10 seconds makes for 12 minutes of no data while having an active BitsteamClient request
     
-    #Initiate the 'global' Cadu counter variable
-    if not 'count' in globalCaduCounter:
-        logger.debug('Set globalCaduCounter variable')
-        globalCaduCounter['count'] = 0; globalCaduCounter['lastTimestamp'] = ''; globalCaduCounter['ocurrences'] = 0
-        
-    #Check if HRD is coming in. If not we might have a problem of stuck BitstreamClient requests
-    if threadCommandLineBitstreamRequest.isAlive() and not isHRDbeingReceived(globalCaduCounter) and globalCaduCounter['ocurrences'] > maxOcurrences:
-        logger.info('BitstreamClient request is stuck -> Terminate')
-        #Do we have a problem? -> Terminate BitstreamClient requests
-        terminateBitstreamClient()
-        #Reset counters
-        logger.debug('Re-setting globalCaduCounter variable')
-        globalCaduCounter['count'] = 0; globalCaduCounter['lastTimestamp'] = ''; globalCaduCounter['ocurrences'] = 0
-    else:
-        logger.debug('Scanning for stuck BitsteamClient requests: No stuck request found')
+    runningRequests = getRunningBitstreamRequests()
+    if len(runningRequests) == 0:
+        logger.debug('Scanning for stuck BitsteamClient requests: No request running')
+        return
+
+    #Check if HRD is coming in on each source counter, once per scan. If not we might have a problem of stuck BitstreamClient requests
+    isReceivingData = {}
+    for parameterName in set([request['caduParameter'] for request in runningRequests.values()]):
+        #Initiate the 'global' Cadu counter variable of the parameter
+        if parameterName not in globalCaduCounter:
+            logger.debug('Set globalCaduCounter variable of %s' % parameterName)
+            globalCaduCounter[parameterName] = {'count': 0, 'lastTimestamp': '', 'ocurrences': 0}
+        isReceivingData[parameterName] = isHRDbeingReceived(globalCaduCounter[parameterName], parameterName)
+    for replayItemID, request in runningRequests.items():
+        with bitstreamRequestsLock:
+            request['ocurrences'] = 0 if isReceivingData[request['caduParameter']] else request['ocurrences'] + 1
+            isStuck = request['ocurrences'] > maxOcurrences
+            if isStuck:
+                request['ocurrences'] = 0
+        if isStuck:
+            logger.info('BitstreamClient request of replay item %s is stuck (no data on %s) -> Terminate' % (replayItemID, request['caduParameter']))
+            #Do we have a problem? -> Terminate this BitstreamClient request, its thread sets the replay item as failed
+            terminateBitstreamRequest(request)
+        else:
+            logger.debug('Scanning for stuck BitsteamClient requests: Replay item %s not stuck' % replayItemID)
+
+#Terminates the Bitstream Client request of one replay item, found by its start and stop times on the remote host. The [-] keeps pkill from matching its own shell.
+def terminateBitstreamRequest(request):
+    processPattern = '[-]startTime %s +-stopTime %s' % (request['startDate'], request['endDate'])
+    for signalNumber in [15, 9]:
+        commandOutputCode, commandOutputString = remoteCommand.getSshRunner(request['sourceUser'], request['sourceIP']).run('pkill -%s -f "%s"' % (signalNumber, processPattern))
+        logger.info('terminateBitstreamRequest, ssh exit code: %s' % commandOutputCode)
+        logger.info('terminateBitstreamRequest, kill (sig %s) output: %s' % (signalNumber, commandOutputString))
     
 #Terminates any running (or stuck) Bitstream Client request
 def terminateBitstreamClient():
         #Kill all stuck Bitstream Client
         logger.info('Terminating Bitstream Client requests (if any)')
-        commandOutputCode, commandOutputString = commands.getstatusoutput('ssh -q hrdp@sdmkernel \'pkill -15 -f "bitstreamClient.jar"\'')
+        commandOutputCode, commandOutputString = remoteCommand.getSshRunner('hrdp', 'sdmkernel').run('pkill -15 -f "bitstreamClient.jar"')
         logger.info('terminateBitstreamClient, ssh exit code: %s' % commandOutputCode)
         logger.info('terminateBitstreamClient, kill (sig 15) output: %s' % commandOutputString)
-        commandOutputCode, commandOutputString = commands.getstatusoutput('ssh -q hrdp@sdmkernel \'pkill -9 -f "bitstreamClient.jar"\'')
+        commandOutputCode, commandOutputString = remoteCommand.getSshRunner('hrdp', 'sdmkernel').run('pkill -9 -f "bitstreamClient.jar"')
         logger.info('terminateBitstreamClient, ssh exit code: %s' % commandOutputCode)
         logger.info('terminateBitstreamClient, kill (sig 9) output: %s' % commandOutputString)
 
 #Tries to terminate the threads
 def exitCleanUp():
     try:
+        if scheduler is not None:
+            logger.info('Stopping the scheduler tasks')
+            scheduler.stop()
+        for subscription in [parameterSubscription, autoLosSensingReplayFiller.parameterSubscription]:
+            if subscription is not None:
+                subscription.stop()
+        for client in [getYamcsClient(), autoLosSensingReplayFiller.getYamcsClient()]:
+            logger.info('Yamcs %s latencies: %s' % (client.server, client.getLatencySummary()))
+        yamcsClient.closeYamcsClients()
+        if metricsServer is not None:
+            metricsServer.stop()
         if threadScanForVmuHrdGaps.isAlive():
             logger.info('threadScanForVmuHrdGaps is alive')
             threadScanForVmuHrdGaps.join(1)
         if threadScanForVmuNumberOfFiles.isAlive():
             logger.info('threadScanForVmuNumberOfFiles is alive')
             threadScanForVmuNumberOfFiles.join(1)
-        if threadCommandLineBitstreamRequest.isAlive():
-            logger.info('threadCommandLineBitstreamRequest is alive')
-            threadCommandLineBitstreamRequest.join(1)
+        for replayItemID, request in getRunningBitstreamRequests().items():
+            logger.info('BitstreamClient thread of replay item %s is alive' % replayItemID)
+            request['thread'].join(1)
         if threadScanForStuckBitstreamClientRequest.isAlive():
             logger.info('threadScanForStuckBitstreamClientRequest is alive')
             threadScanForStuckBitstreamClientRequest.join(1)
@@ -928,6 +1694,8 @@ def exitCleanUp():
         #Kill all stuck Bitstream Client
         sleep (2)
         terminateBitstreamClient()
+        #Stop the persistent SSH sessions
+        remoteCommand.closeSshRunners()
     except Exception, errorString:
         logger.error(errorString)
 
@@ -954,46 +1722,164 @@ def pidfileOperation(pidfile, pidnumber):
     except Exception, errorString:
         logger.error(errorString)
    
-#Main procedure. Iterates in an infinite loop launching the archive gap and count scan procedure, the gap item to replay item merge procedure, and the command line bitstream request execution procedure.
-def main():
+#Starts the archive gap and count scan, if no scan is running and it is time to scan again.
+def startArchiveScan():
     global threadScanForVmuHrdGaps
     global threadScanForVmuNumberOfFiles
+
+    #Scan the Archive for gaps and do the packet file count per VMU phase, record and source
+    if not (threadScanForVmuHrdGaps.isAlive() or threadScanForVmuNumberOfFiles.isAlive()) and isTime2Scan():
+        if getScanMode() == 'combined':
+            #Single Meex read for both
+            threadScanForVmuHrdGaps = threading.Thread(target = autobrmTrace.tracedStage('scanArchive', scanArchive), name='scanArchive')
+            threadScanForVmuHrdGaps.start()
+        else:
+            threadScanForVmuHrdGaps = threading.Thread(target = autobrmTrace.tracedStage('scanForVmuHrdGaps', scanForVmuHrdGaps), name='scanForVmuHrdGaps')
+            threadScanForVmuNumberOfFiles = threading.Thread(target = autobrmTrace.tracedStage('scanForVmuNumberOfFiles', scanForVmuNumberOfFiles), name='scanForVmuNumberOfFiles')
+            #Start scan in new threads
+            threadScanForVmuHrdGaps.start()
+            threadScanForVmuNumberOfFiles.start()
+
+#Reads the trace settings from the variable table: slow span threshold (trace_slow_ms), and trace_profile set to on
+#to get a cProfile dump of the next run of every stage, after which it is set back to off (SIGUSR1 does the same).
+def updateTraceSettings():
+    dbCon = dbConnectToDatabase()
+    slowMilliseconds = getVariableValue(dbCon, 'trace_slow_ms')
+    if not isinstance(slowMilliseconds, int): slowMilliseconds = traceSlowMilliseconds
+    autobrmTrace.setSlowThreshold(slowMilliseconds / 1000.0)
+    if str(getVariableValue(dbCon, 'trace_profile')).lower() == 'on':
+        setVariableValue(dbCon, 'trace_profile', 'off')
+        requestProfile()
+    dbReleaseConnection(dbCon)
+
+#Asks for a cProfile dump of the next run of every stage, written to the folder of the trace log.
+def requestProfile():
+    autobrmTrace.requestProfile()
+    logger.info('Profiling the next run of every stage')
+
+#Executes as soon as a SIGUSR1 signal is catched.
+def profileHandler(signal, frame):
+    autobrmTrace.requestProfile()
+
+#Main procedure. Iterates in an infinite loop launching the archive gap and count scan procedure, the gap item to replay item merge procedure, and the command line bitstream request execution procedure.
+#Used when the variable scheduler_mode is set to polling, see startScheduler otherwise.
+def main():
     global threadScanForStuckBitstreamClientRequest
     global threadAutoLosSensingReplayFiller
     
     try:
+        updateTraceSettings()
         #Create a Replay list from a Gap list
-        insertHrdGapItem2ReplayList()
+        with autobrmTrace.span('merge'):
+            insertHrdGapItem2ReplayList()
         #Launch Bitstream replays from the replay list
-        issueReplayFromReplayList()
+        with autobrmTrace.span('dispatch'):
+            issueReplayFromReplayList()
         
         #Scan the Archive for gaps and do the packet file count per VMU phase, record and source
-        if not (threadScanForVmuHrdGaps.isAlive() or threadScanForVmuNumberOfFiles.isAlive()) and isTime2Scan():
-            threadScanForVmuHrdGaps = threading.Thread(target = scanForVmuHrdGaps, name='scanForVmuHrdGaps')
-            threadScanForVmuNumberOfFiles = threading.Thread(target = scanForVmuNumberOfFiles, name='scanForVmuNumberOfFiles')
-            #Start scan in new threads
-            threadScanForVmuHrdGaps.start()
-            threadScanForVmuNumberOfFiles.start()
+        with autobrmTrace.span('scan'):
+            startArchiveScan()
             
         #Scan for stuck BitstreamClient requests    
-        threadScanForStuckBitstreamClientRequest = threading.Thread(target = scanForStuckBitstreamClientRequest, name='scanForStuckBitstreamClientRequest')
+        threadScanForStuckBitstreamClientRequest = threading.Thread(target = autobrmTrace.tracedStage('watchdog', scanForStuckBitstreamClientRequest), name='scanForStuckBitstreamClientRequest')
         threadScanForStuckBitstreamClientRequest.start()
         
         #Scan for relevant LOS and add to replay request queue
         if not threadAutoLosSensingReplayFiller.isAlive():
-            threadAutoLosSensingReplayFiller = threading.Thread(target = autoLosSensingReplayFiller.main, name='autoLosSensingReplayFiller', args=("task",))
+            threadAutoLosSensingReplayFiller = threading.Thread(target = autobrmTrace.tracedStage('los', autoLosSensingReplayFiller.main), name='autoLosSensingReplayFiller', args=("task",))
             threadAutoLosSensingReplayFiller.start()
         
     except Exception, errorString:
         logger.error(errorString)
+
+#Event driven scheduler, None while polling with main
+scheduler = None
+
+#Starts the event driven scheduler: every procedure gets its own long-lived task, run every 10 seconds or as soon as it is triggered.
+#A scan completing triggers the merge, a merge adding replay items and a bitstream request completing trigger the dispatch.
+#Every task run is a trace root (see autobrmTrace), the trace task keeps the trace settings up to date.
+def startScheduler():
+    global scheduler
+    losState = autoLosSensingReplayFiller.newLosState()
+
+    scheduler = autobrmScheduler.Scheduler(logger)
+    scheduler.addTask('merge', autobrmTrace.tracedStage('merge', insertHrdGapItem2ReplayList), 10)
+    scheduler.addTask('dispatch', autobrmTrace.tracedStage('dispatch', issueReplayFromReplayList), 10)
+    scheduler.addTask('scan', autobrmTrace.tracedStage('scan', startArchiveScan), 10)
+    #The watchdog counts 10 seconds cycles without data, it keeps its period
+    scheduler.addTask('watchdog', autobrmTrace.tracedStage('watchdog', scanForStuckBitstreamClientRequest), 10, isTriggerable = False)
+    scheduler.addTask('los', autobrmTrace.tracedStage('los', lambda: autoLosSensingReplayFiller.checkLos(losState)), 10)
+    scheduler.addTask('trace', updateTraceSettings, 10, isTriggerable = False)
+
+    #Yamcs parameters pushed over WebSocket, unless the variable yamcs_subscription is off: a recorder mode update runs the LOS sensing at once
+    dbCon = dbConnectToDatabase()
+    isSubscriptionOff = str(getVariableValue(dbCon, 'yamcs_subscription')).lower() == 'off'
+    dbReleaseConnection(dbCon)
+    if not isSubscriptionOff:
+        startParameterSubscription()
+        autoLosSensingReplayFiller.startParameterSubscription(logger).addListener(lambda parameterName, parameterValue: triggerTask('los'))
+    scheduler.start()
+
+#Metrics HTTP endpoint, None if not enabled
+metricsServer = None
+
+#Updates the metrics read at exposition time: queue depths from the database, running requests and Yamcs latencies.
+def collectMetrics():
+    dbCon = dbConnectToDatabase()
+    try:
+        dbCur = dbCon.cursor()
+        dbCur.execute('SELECT COUNT(*) FROM hrd_packet_gap WHERE is_checked = 0;')
+        autobrmMetrics.setGauge('autobrm_unchecked_gaps', dbCur.fetchall()[0][0])
+        dbCur.execute('SELECT rs.name, COUNT(r.id) FROM replay_status rs LEFT JOIN replay r ON r.replay_status_id = rs.id GROUP BY rs.id, rs.name;')
+        autobrmMetrics.setGaugeValues('autobrm_replay_items', [[{'state': row[0]}, row[1]] for row in dbCur.fetchall()])
+        dbCur.close()
+    finally:
+        dbReleaseConnection(dbCon)
+    sourceRequestCount = {}
+    for request in getRunningBitstreamRequests().values():
+        sourceRequestCount[request['source']] = sourceRequestCount.get(request['source'], 0) + 1
+    autobrmMetrics.setGaugeValues('autobrm_bitstream_requests_running', [[{'source': source}, count] for (source, count) in sourceRequestCount.items()])
+    for client in [getYamcsClient(), autoLosSensingReplayFiller.getYamcsClient()]:
+        for callName, snapshot in client.getLatencyHistograms().items():
+            labels = {'server': client.server, 'call': callName}
+            autobrmMetrics.setHistogram('autobrm_yamcs_request_seconds', [bucketCount for (bound, bucketCount) in snapshot['buckets'][:-1]], snapshot['count'], snapshot['sum'], labels)
+            autobrmMetrics.setCounter('autobrm_yamcs_request_errors_total', snapshot['errors'], labels)
+
+#Exposes the metrics: Prometheus text on http://127.0.0.1:<metrics_port>/metrics if the variable metrics_port is set, and/or written every
+#metricsFileInterval seconds to the file of the variable metrics_file (node exporter textfile collector).
+def startMetrics():
+    global metricsServer
+    dbCon = dbConnectToDatabase()
+    metricsPort = getVariableValue(dbCon, 'metrics_port')
+    metricsFile = getVariableValue(dbCon, 'metrics_file')
+    dbReleaseConnection(dbCon)
+    autobrmMetrics.addCollector(collectMetrics)
+    if isinstance(metricsPort, int) and metricsPort > 0:
+        try:
+            metricsServer = autobrmMetrics.MetricsServer(metricsPort, logger)
+            metricsServer.start()
+            logger.info('Metrics on http://127.0.0.1:%s/metrics' % metricsPort)
+        except Exception, errorString:
+            logger.error('Metrics endpoint on port %s: %s' % (metricsPort, errorString))
+    if metricsFile:
+        autobrmScheduler.PeriodicTask('metrics', lambda: autobrmMetrics.writeMetricsFile(metricsFile, logger), metricsFileInterval, logger, isTriggerable = False).start()
+        logger.info('Metrics written to %s every %s seconds' % (metricsFile, metricsFileInterval))
+
+#Runs a scheduler task as soon as possible. Nothing to do when polling, the next main loop runs it.
+def triggerTask(name):
+    if scheduler is not None:
+        scheduler.trigger(name)
       
 #main
 if __name__=='__main__':
     #Set up logging
     logfile = '/var/log/autobrm.log'
+    tracefile = '/var/log/autobrm_trace.log'
 
     #Set up exit handler
     signal.signal(signal.SIGTERM, exitHandler)
+    #Set up on demand profiling
+    signal.signal(signal.SIGUSR1, profileHandler)
     
     #Local/PDC
     logging.basicConfig(level=logging.INFO)
@@ -1004,6 +1890,12 @@ if __name__=='__main__':
     formatter = logging.Formatter('%(asctime)s %(threadName)s %(levelname)s %(message)s')
     filehandler.setFormatter(formatter)
     logger.addHandler(filehandler)
+
+    #Slow stages and SQL statements, see autobrmTrace
+    tracehandler = logging.FileHandler(tracefile)
+    tracehandler.setFormatter(formatter)
+    autobrmTrace.traceLogger.addHandler(tracehandler)
+    autobrmTrace.profileDirectory = os.path.dirname(tracefile)
     
     #Populate PID file
     pidfile = '/var/run/autobrm.pid'
@@ -1018,8 +1910,6 @@ if __name__=='__main__':
         threadScanForVmuHrdGaps = threading.Thread()
     if 'threadScanForVmuNumberOfFiles' not in locals():
         threadScanForVmuNumberOfFiles = threading.Thread()
-    if 'threadCommandLineBitstreamRequest' not in locals():
-        threadCommandLineBitstreamRequest = threading.Thread()
     if 'threadScanForStuckBitstreamClientRequest' not in locals():
         threadScanForStuckBitstreamClientRequest = threading.Thread() 
     if 'threadAutoLosSensingReplayFiller' not in locals():
@@ -1030,10 +1920,23 @@ if __name__=='__main__':
     #Launches the main procedure loop  
     logger.info('##############################################################')
     logger.info('OK: Beginning of script')
+    #Bring the database schema up to date
+    dbCon = dbConnectToDatabase()
+    for version in autobrmSchema.upgradeDatabase(dbCon):
+        logger.info('Database schema upgraded to version %s' % version)
+    schedulerMode = getVariableValue(dbCon, 'scheduler_mode')
+    dbReleaseConnection(dbCon)
+    startMetrics()
     try:
-        while True:
-            main()
-            sleep(10)
+        if schedulerMode == 'polling':
+            cycle = autobrmTrace.tracedStage('cycle', main)
+            while True:
+                cycle()
+                sleep(10)
+        else:
+            startScheduler()
+            while True:
+                sleep(1)
     except (SystemExit, KeyboardInterrupt):
         logger.info('OK: Exit signal received')
         
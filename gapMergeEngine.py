@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+##
+## In-memory merge engine for AutoBRM: matches hrd_packet_gap items against the NEW replay windows.
+##  Source : Unchecked hrd_packet_gap items and NEW replay items, loaded once per merge pass.
+##  Destination : Merge plan (new/updated replay windows, gap links) written back by AutoBRM in one transaction.
+##
+## Follows the Case A-H match concept of the design document, with the same case precedence as the
+## SQL based procedure (D, E, C, F, B, G, then A/H) and the same 'first replay found' rule.
+##
+
+import bisect
+
+_KEEP = object()
+
+#A replay window held in memory during a merge pass. Existing windows keep their database id as sort key, new ones get a key sorting after every existing one, the same order the database would number them.
+class ReplayWindow(object):
+    __slots__ = ('key', 'replayID', 'startdate', 'enddate', 'startEpoch', 'endEpoch', 'isNew', 'isModified')
+
+    def __init__(self, key, replayID, startdate, enddate, startEpoch, endEpoch, isNew = False):
+        self.key = key
+        self.replayID = replayID
+        self.startdate = startdate
+        self.enddate = enddate
+        self.startEpoch = startEpoch
+        self.endEpoch = endEpoch
+        self.isNew = isNew
+        self.isModified = False
+
+#An unchecked hrd_packet_gap item during a merge pass, with its epochs and the padded datetimes the cases write, computed once by SQLite.
+class GapItem(object):
+    __slots__ = ('gapID', 'channel', 'startdate', 'enddate', 'startEpoch', 'endEpoch', 'startdateMinus1', 'enddatePlus1', 'startdateMinus5', 'enddatePlus5')
+
+    def __init__(self, gapID, channel, startdate, enddate, startEpoch, endEpoch, startdateMinus1, enddatePlus1, startdateMinus5, enddatePlus5):
+        self.gapID = gapID
+        self.channel = channel
+        self.startdate = startdate
+        self.enddate = enddate
+        self.startEpoch = startEpoch
+        self.endEpoch = endEpoch
+        self.startdateMinus1 = startdateMinus1
+        self.enddatePlus1 = enddatePlus1
+        self.startdateMinus5 = startdateMinus5
+        self.enddatePlus5 = enddatePlus5
+
+#Bounds of the empty segment tree nodes: no datetime sorts before the empty string or after the last unicode character.
+_LOWEST = u''
+_HIGHEST = u'\uffff'
+
+#Interval index over the replay windows, so a merge pass stays O(n log n).
+#Windows are held in key order in the leaves of a segment tree keeping the lowest/highest start and end datetime (text order, as SQLite compares them) of each subtree: the leftmost leaf matching a case is the window with the lowest key, found by skipping every subtree that can't hold a match.
+#The windows are also kept sorted on their start and end epochs, so the offset cases only look at the windows within the offset.
+class ReplayWindowIndex(object):
+
+    def __init__(self, windows = ()):
+        windows = sorted(windows, key = lambda window: window.key)
+        self.size = 1
+        while self.size < len(windows):
+            self.size *= 2
+        self.slots = []
+        self.slotByKey = {}
+        self.startEpochs = []
+        self.endEpochs = []
+        self.newCount = 0
+        self.count = 0
+        self.build(windows)
+
+    def __len__(self):
+        return self.count
+
+    #Fills the tree with the given windows (in key order) from scratch
+    def build(self, windows):
+        self.slots = [None] * self.size
+        self.slotByKey = {}
+        self.minStart = [_HIGHEST] * (2 * self.size)
+        self.maxStart = [_LOWEST] * (2 * self.size)
+        self.minEnd = [_HIGHEST] * (2 * self.size)
+        self.maxEnd = [_LOWEST] * (2 * self.size)
+        self.used = 0
+        self.count = 0
+        for window in windows:
+            self.slotByKey[window.key] = self.used
+            self.slots[self.used] = window
+            self.setLeaf(self.used, window)
+            self.used += 1
+            self.count += 1
+        for node in xrange(self.size - 1, 0, -1):
+            self.pull(node)
+        self.startEpochs = sorted([(window.startEpoch, window.key, window) for window in windows if window.startEpoch is not None])
+        self.endEpochs = sorted([(window.endEpoch, window.key, window) for window in windows if window.endEpoch is not None])
+
+    #Sets the leaf bounds of a slot. A window with a NULL datetime never matches a comparison, as in SQL.
+    def setLeaf(self, slot, window):
+        node = self.size + slot
+        if window is None or window.startdate is None or window.enddate is None:
+            self.minStart[node] = self.minEnd[node] = _HIGHEST
+            self.maxStart[node] = self.maxEnd[node] = _LOWEST
+        else:
+            self.minStart[node] = self.maxStart[node] = window.startdate
+            self.minEnd[node] = self.maxEnd[node] = window.enddate
+
+    def pull(self, node):
+        left = 2 * node
+        right = left + 1
+        self.minStart[node] = min(self.minStart[left], self.minStart[right])
+        self.maxStart[node] = max(self.maxStart[left], self.maxStart[right])
+        self.minEnd[node] = min(self.minEnd[left], self.minEnd[right])
+        self.maxEnd[node] = max(self.maxEnd[left], self.maxEnd[right])
+
+    #Updates a slot and its parents
+    def updateSlot(self, slot, window):
+        self.setLeaf(slot, window)
+        node = (self.size + slot) // 2
+        while node > 0:
+            self.pull(node)
+            node //= 2
+
+    #Adds a window to the index. Windows are added in key order (new windows get increasing keys).
+    def add(self, window):
+        if self.used == self.size:
+            #Full: double the tree, dropping the removed windows
+            windows = [slotWindow for slotWindow in self.slots if slotWindow is not None]
+            while self.size < 2 * (len(windows) + 1):
+                self.size *= 2
+            self.build(windows)
+        self.slotByKey[window.key] = self.used
+        self.slots[self.used] = window
+        self.updateSlot(self.used, window)
+        self.used += 1
+        self.count += 1
+        self.addEpochs(window)
+
+    #Removes a window from the index
+    def remove(self, window):
+        slot = self.slotByKey.pop(window.key)
+        self.slots[slot] = None
+        self.updateSlot(slot, None)
+        self.count -= 1
+        self.removeEpochs(window, start = True, end = True)
+
+    def addEpochs(self, window, start = True, end = True):
+        if start and window.startEpoch is not None:
+            bisect.insort(self.startEpochs, (window.startEpoch, window.key, window))
+        if end and window.endEpoch is not None:
+            bisect.insort(self.endEpochs, (window.endEpoch, window.key, window))
+
+    def removeEpochs(self, window, start = True, end = True):
+        if start and window.startEpoch is not None:
+            del self.startEpochs[bisect.bisect_left(self.startEpochs, (window.startEpoch, window.key))]
+        if end and window.endEpoch is not None:
+            del self.endEpochs[bisect.bisect_left(self.endEpochs, (window.endEpoch, window.key))]
+
+    #Creates a new window (Case A/H) and returns it
+    def createWindow(self, startdate, enddate, startEpoch, endEpoch):
+        self.newCount += 1
+        window = ReplayWindow((1, self.newCount), None, startdate, enddate, startEpoch, endEpoch, isNew = True)
+        self.add(window)
+        return window
+
+    #Moves the window bounds. Bounds not given are kept.
+    def updateWindow(self, window, startdate = _KEEP, startEpoch = None, enddate = _KEEP, endEpoch = None):
+        isStartMoved = startdate is not _KEEP
+        isEndMoved = enddate is not _KEEP
+        self.removeEpochs(window, start = isStartMoved, end = isEndMoved)
+        if isStartMoved:
+            window.startdate = startdate
+            window.startEpoch = startEpoch
+        if isEndMoved:
+            window.enddate = enddate
+            window.endEpoch = endEpoch
+        self.addEpochs(window, start = isStartMoved, end = isEndMoved)
+        self.updateSlot(self.slotByKey[window.key], window)
+        window.isModified = True
+
+    #Returns the window with the lowest key whose datetimes match. mayMatch(minStart, maxStart, minEnd, maxEnd) tells whether a subtree with these bounds can hold a match, and is exact on a single window.
+    def firstMatch(self, mayMatch):
+        return self.firstMatchBelow(1, mayMatch)
+
+    def firstMatchBelow(self, node, mayMatch):
+        if not mayMatch(self.minStart[node], self.maxStart[node], self.minEnd[node], self.maxEnd[node]):
+            return None
+        if node >= self.size:
+            return self.slots[node - self.size]
+        return self.firstMatchBelow(2 * node, mayMatch) or self.firstMatchBelow(2 * node + 1, mayMatch)
+
+    #Returns the window with the lowest key among the ones whose epoch in the given sorted epoch list is within the offset of the given epoch
+    def firstWithinOffset(self, epochs, epoch, toleranceMinutes):
+        if epoch is None or toleranceMinutes is None:
+            return None
+        margin = (int(toleranceMinutes) + 1) * 60
+        position = bisect.bisect_left(epochs, (int(epoch) - margin,))
+        last = bisect.bisect_left(epochs, (int(epoch) + margin + 1,))
+        found = None
+        while position < last:
+            windowEpoch, key, window = epochs[position]
+            if isWithinOffset(windowEpoch, epoch, toleranceMinutes) and (found is None or key < found.key):
+                found = window
+            position += 1
+        return found
+
+#Same test as the SQL 'ABS((strftime("%s",a)-strftime("%s",b))/60)' delta, using integer division as SQLite does.
+def isWithinOffset(epochA, epochB, toleranceMinutes):
+    if epochA is None or epochB is None or toleranceMinutes is None:
+        return False
+    return abs(int(epochA) - int(epochB)) // 60 <= toleranceMinutes
+
+def _offsetEpoch(epoch, seconds):
+    return None if epoch is None else int(epoch) + seconds
+
+#Matches one gap item against the index and applies the case. Returns the case letter and the window the gap is linked to.
+#The gap item holds the gap datetimes and their precomputed padded variants (see GapItem).
+def mergeGapItem(index, gapItem, toleranceMinutes, newWindowsAreMergeable = True):
+    gapStart = gapItem.startdate
+    gapEnd = gapItem.enddate
+    #NULL datetimes never match a comparison in SQL
+    isComparable = gapStart is not None and gapEnd is not None
+
+    #Case D - GapList startdate <= ReplayList startdate & GapList enddate >= ReplayList enddate
+    window = index.firstMatch(lambda minStart, maxStart, minEnd, maxEnd: maxStart >= gapStart and minEnd <= gapEnd) if isComparable else None
+    if window is not None:
+        index.updateWindow(window, startdate = gapItem.startdateMinus1, startEpoch = _offsetEpoch(gapItem.startEpoch, -1), enddate = gapItem.enddatePlus1, endEpoch = _offsetEpoch(gapItem.endEpoch, 1))
+        return 'D', window
+    #Case E - GapList startdate >= ReplayList startdate & GapList enddate <= ReplayList enddate
+    window = index.firstMatch(lambda minStart, maxStart, minEnd, maxEnd: minStart <= gapStart and maxEnd >= gapEnd) if isComparable else None
+    if window is not None:
+        return 'E', window
+    #Case C - GapList startdate > ReplayList startdate & GapList startdate <= ReplayList enddate
+    window = index.firstMatch(lambda minStart, maxStart, minEnd, maxEnd: minStart < gapStart and maxEnd >= gapStart) if gapStart is not None else None
+    if window is not None:
+        index.updateWindow(window, enddate = gapItem.enddatePlus1, endEpoch = _offsetEpoch(gapItem.endEpoch, 1))
+        return 'C', window
+    #Case F - GapList enddate >= ReplayList startdate & GapList enddate <= ReplayList enddate
+    window = index.firstMatch(lambda minStart, maxStart, minEnd, maxEnd: minStart <= gapEnd and maxEnd >= gapEnd) if gapEnd is not None else None
+    if window is not None:
+        index.updateWindow(window, startdate = gapItem.startdateMinus1, startEpoch = _offsetEpoch(gapItem.startEpoch, -1))
+        return 'F', window
+    #Case B - GapList startdate - ReplayList enddate =< offset minutes
+    window = index.firstWithinOffset(index.endEpochs, gapItem.startEpoch, toleranceMinutes)
+    if window is not None:
+        index.updateWindow(window, enddate = gapItem.enddatePlus1, endEpoch = _offsetEpoch(gapItem.endEpoch, 1))
+        return 'B', window
+    #Case G - GapList enddate - ReplayList startdate =< offset minutes
+    window = index.firstWithinOffset(index.startEpochs, gapItem.endEpoch, toleranceMinutes)
+    if window is not None:
+        index.updateWindow(window, startdate = gapItem.startdateMinus1, startEpoch = _offsetEpoch(gapItem.startEpoch, -1))
+        return 'G', window
+    #Case A, H, and other - New replay window padded by 5 seconds on each side
+    window = index.createWindow(gapItem.startdateMinus5, gapItem.enddatePlus5, _offsetEpoch(gapItem.startEpoch, -5), _offsetEpoch(gapItem.endEpoch, 5))
+    if not newWindowsAreMergeable:
+        #The initial replay state is not NEW: the window can't be matched by the following gaps.
+        index.remove(window)
+    return 'A', window
+
+#Merges all gap items into the given replay windows. Gap items are processed in the given order, each one seeing the result of the previous ones.
+#Returns the merge plan: the list of (window, gapID) links, the touched windows in creation/first touch order and the number of gaps per case.
+def mergeGapItems(gapItems, windows, toleranceMinutes, newWindowsAreMergeable = True):
+    index = ReplayWindowIndex(windows)
+    links = []
+    touchedWindows = []
+    touchedKeys = set()
+    caseCount = dict((case, 0) for case in 'ABCDEFG')
+
+    for gapItem in gapItems:
+        case, window = mergeGapItem(index, gapItem, toleranceMinutes, newWindowsAreMergeable)
+        caseCount[case] += 1
+        links.append((window, gapItem.gapID))
+        if window.key not in touchedKeys:
+            touchedKeys.add(window.key)
+            touchedWindows.append(window)
+
+    return {'links': links, 'windows': touchedWindows, 'cases': caseCount}
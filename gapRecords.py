@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+##
+## Compact gap records for AutoBRM scans.
+##  Source : sqchk.awk output lines and sqchk records of a Meex listing.
+##  Destination : hrd_packet_gap and vmu_packet_gap rows written by ingestGapItems.
+##
+## One slotted object per gap instead of a list holding an HRD and a VMU dictionary: a multi-day rescan keeps a day of
+## gap items in memory (parallel scans), and a dictionary per part costs about 4.5 times the memory of the object (autobrmBenchmark.py, stages gap_items and gap_items_legacy).
+## Sequence counts are integers parsed once. Datetimes stay the text Meex prints, the form the database stores and
+## compares. Repeated short strings (channel, source, record name) are interned, every item of a channel shares them.
+##
+
+import bisect
+
+#HRD part fields (hrd_packet_gap), then VMU part fields (vmu_packet_gap and vmu_record)
+gapItemFields = ('itemType', 'channel', 'startdate', 'enddate', 'lastSequenceCount', 'nextSequenceCount', 'difference', \
+'source', 'vmuStartdate', 'vmuEnddate', 'vmuLastSequenceCount', 'vmuNextSequenceCount', 'vmuDifference', 'phaseName', 'recordName')
+
+#A gap found by the scan: 'G' regular gap with its HRD and VMU parts, or 'B' corrupt packet run (HRD part and source only).
+#Fields not known (corrupt run, unreadable line) are None.
+class GapItem(object):
+    __slots__ = gapItemFields
+
+    def __init__(self, itemType, channel = None, startdate = None, enddate = None, lastSequenceCount = None, nextSequenceCount = None, difference = None, \
+    source = None, vmuStartdate = None, vmuEnddate = None, vmuLastSequenceCount = None, vmuNextSequenceCount = None, vmuDifference = None, phaseName = None, recordName = None):
+        self.itemType = itemType
+        self.channel = internText(channel)
+        self.startdate = startdate
+        self.enddate = enddate
+        self.lastSequenceCount = lastSequenceCount
+        self.nextSequenceCount = nextSequenceCount
+        self.difference = difference
+        self.source = internText(source)
+        self.vmuStartdate = vmuStartdate
+        self.vmuEnddate = vmuEnddate
+        self.vmuLastSequenceCount = vmuLastSequenceCount
+        self.vmuNextSequenceCount = vmuNextSequenceCount
+        self.vmuDifference = vmuDifference
+        self.phaseName = internText(phaseName)
+        self.recordName = internText(recordName)
+
+    #Field values in gapItemFields order
+    def toList(self):
+        return [getattr(self, field) for field in gapItemFields]
+
+    def __repr__(self):
+        return 'GapItem(%s)' % ', '.join([repr(value) for value in self.toList()])
+
+def internText(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+#Unchecked hrd_packet_gap rows (id, chanel, last_sequence_count, next_sequence_count, last_timestamp, next_timestamp) of an ingestion, to find the one containing a new gap.
+#Rows are sorted by last sequence count per channel: a containing row starts at or after the gap last sequence count and, ending at or before the gap next
+#sequence count, starts before it too, so only the rows in between are looked at. Rows without a next sequence count or with one lower than the last can't
+#be bounded this way and are checked one by one. Rows without a last sequence count or timestamp never contain a gap (NULL comparison).
+class HrdGapIndex(object):
+
+    def __init__(self, rows = ()):
+        self.entries = {}
+        self.unbounded = {}
+        self.rows = {}
+        #One sort per channel instead of an insertion per row
+        for row in rows:
+            self.add(row, isSorted = False)
+        for entries in self.entries.values():
+            entries.sort()
+
+    def add(self, row, isSorted = True):
+        rowID, channel, lastSequenceCount, nextSequenceCount, startdate, enddate = row
+        if lastSequenceCount is None or startdate is None:
+            return
+        self.rows[rowID] = row
+        if nextSequenceCount is None or nextSequenceCount < lastSequenceCount:
+            self.unbounded.setdefault(channel, []).append(row)
+        elif isSorted:
+            bisect.insort(self.entries.setdefault(channel, []), (lastSequenceCount, rowID, row))
+        else:
+            self.entries.setdefault(channel, []).append((lastSequenceCount, rowID, row))
+
+    #Drops a row, checked since it was read
+    def remove(self, rowID):
+        row = self.rows.pop(rowID, None)
+        if row is None:
+            return
+        entries = self.entries.get(row[1], [])
+        position = bisect.bisect_left(entries, (row[2], rowID))
+        if position < len(entries) and entries[position][1] == rowID:
+            del entries[position]
+        elif row in self.unbounded.get(row[1], []):
+            self.unbounded[row[1]].remove(row)
+
+    #Returns the lowest id of the rows of the channel containing the gap, None if there is none
+    def findContaining(self, channel, lastSequenceCount, nextSequenceCount, startdate, enddate):
+        foundID = None
+        entries = self.entries.get(channel, [])
+        position = bisect.bisect_left(entries, (lastSequenceCount,))
+        while position < len(entries) and entries[position][0] <= nextSequenceCount:
+            row = entries[position][2]
+            if (foundID is None or row[0] < foundID) and isContaining(row, lastSequenceCount, nextSequenceCount, startdate, enddate):
+                foundID = row[0]
+            position += 1
+        for row in self.unbounded.get(channel, []):
+            if (foundID is None or row[0] < foundID) and isContaining(row, lastSequenceCount, nextSequenceCount, startdate, enddate):
+                foundID = row[0]
+        return foundID
+
+def isContaining(row, lastSequenceCount, nextSequenceCount, startdate, enddate):
+    return row[2] >= lastSequenceCount and row[3] <= nextSequenceCount and row[4] >= startdate and row[5] <= enddate
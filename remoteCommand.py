@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+##
+## Remote command execution for AutoBRM over persistent multiplexed SSH sessions.
+##  Source : Commands to run on the bitstream request host (usually SDMKernel): bitstream requests, pkill.
+##  Destination : Exit status and output, as returned by commands.getstatusoutput.
+##
+## Every command runs through the OpenSSH control master of its user and host (ControlMaster/ControlPersist), so only
+## the first one pays the TCP and key exchange handshake. The master is health checked and restarted when needed.
+## The command runner is replaceable (commandRunner argument), to test against a stub instead of a remote host.
+##
+
+import time
+import pipes
+import commands
+import threading
+
+#Control socket of the session masters, one per user, host and port
+controlPath = '/tmp/autobrm-ssh-%r@%h:%p'
+#Seconds the master stays up without any command
+controlPersistSeconds = 600
+connectTimeoutSeconds = 10
+#Seconds between two master health checks
+healthCheckInterval = 60
+#Exit code of ssh itself failing (connection, authentication), not of the remote command
+sshErrorExitCode = 255
+
+#Runs commands on one user@host through a persistent multiplexed SSH session.
+class SshRunner(object):
+
+    def __init__(self, user, host, commandRunner = commands.getstatusoutput):
+        self.user = user
+        self.host = host
+        self.commandRunner = commandRunner
+        self.lock = threading.Lock()
+        self.checkTime = 0
+        self.isHealthy = False
+
+    #Returns the ssh command line. Only the master start creates a master: a command run while the master is down uses its own connection, instead of becoming a background master holding the command output pipe.
+    def getSshCommand(self, options = '', controlMaster = 'no'):
+        return 'ssh -q -o BatchMode=yes -o ConnectTimeout=%s -o ServerAliveInterval=30 -o ControlMaster=%s -o ControlPath=%s -o ControlPersist=%s %s %s@%s' % \
+        (connectTimeoutSeconds, controlMaster, pipes.quote(controlPath), controlPersistSeconds, options, self.user, self.host)
+
+    #Returns True if the session master is up
+    def checkMaster(self):
+        commandOutputCode, commandOutputString = self.commandRunner(self.getSshCommand('-O check'))
+        return commandOutputCode == 0
+
+    #Makes sure the session master is up, starting it (or replacing a stale one) if not. Checked every healthCheckInterval seconds at most.
+    def ensureMaster(self):
+        with self.lock:
+            if self.isHealthy and time.time() - self.checkTime < healthCheckInterval:
+                return True
+            self.checkTime = time.time()
+            self.isHealthy = self.checkMaster()
+            if not self.isHealthy:
+                #Remove a stale control socket, then start a master in the background
+                self.commandRunner(self.getSshCommand('-O exit'))
+                commandOutputCode, commandOutputString = self.commandRunner('%s < /dev/null > /dev/null 2>&1' % self.getSshCommand('-f -N', controlMaster = 'yes'))
+                self.isHealthy = commandOutputCode == 0 and self.checkMaster()
+            return self.isHealthy
+
+    #Runs a command on the remote host. Returns [status, output] as commands.getstatusoutput does: the exit code is status >> 8.
+    #Without a master the command still runs, on its own connection.
+    def run(self, remoteCommand):
+        self.ensureMaster()
+        commandOutputCode, commandOutputString = self.commandRunner('%s %s' % (self.getSshCommand(), pipes.quote(remoteCommand)))
+        if commandOutputCode >> 8 == sshErrorExitCode:
+            #The session may be broken: check it again on the next command. The command itself is not retried, it may have run.
+            with self.lock:
+                self.isHealthy = False
+        return [commandOutputCode, commandOutputString]
+
+    #Stops the session master
+    def close(self):
+        with self.lock:
+            self.commandRunner(self.getSshCommand('-O exit'))
+            self.isHealthy = False
+
+sshRunners = {}
+sshRunnersLock = threading.Lock()
+
+#Returns the runner of a user and host, shared by every caller in the process.
+def getSshRunner(user, host, commandRunner = commands.getstatusoutput):
+    with sshRunnersLock:
+        if (user, host) not in sshRunners:
+            sshRunners[(user, host)] = SshRunner(user, host, commandRunner)
+        return sshRunners[(user, host)]
+
+#Stops every session master. Called at exit.
+def closeSshRunners():
+    with sshRunnersLock:
+        for runner in sshRunners.values():
+            runner.close()
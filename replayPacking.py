@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+##
+## Replay packing optimizer for AutoBRM: packs the NEW replay windows into the cheapest set of bitstream requests.
+##  Source : NEW replay items (after the gap merge pass), as gapMergeEngine.ReplayWindow objects.
+##  Destination : Packing plan (kept windows with their new extent, windows merged into them) written back by AutoBRM.
+##
+## Cost model, in seconds of BRM link time:
+##  request cost = overheadSeconds (bitstreamClient start, DaSS replay setup) + replayed seconds * replayRatio
+## where replayRatio is the recorded bitrate over the bitstream request bitrate. Merging two windows saves one overhead
+## and costs the seconds between them, replayed again for nothing. Both terms being linear, every boundary between two
+## neighbour windows is decided on its own: the windows are merged whenever the gap costs less than the overhead, and
+## this greedy pass gives the lowest total cost.
+##
+
+#Packing of the windows sorted by start: [kept window, start epoch, end epoch, [merged windows]] per request
+def packReplayWindows(windows, overheadSeconds, replayRatio):
+    windows = sorted([window for window in windows if window.startEpoch is not None and window.endEpoch is not None], key = lambda window: (window.startEpoch, window.key))
+    groups = []
+    for window in windows:
+        if len(groups) > 0:
+            group = groups[-1]
+            gapSeconds = window.startEpoch - group[2]
+            if gapSeconds * replayRatio < overheadSeconds:
+                group[3].append(window)
+                group[2] = max(group[2], window.endEpoch)
+                continue
+        groups.append([window, window.startEpoch, window.endEpoch, []])
+    return groups
+
+#Returns the cost of replaying the windows as they are, one request each
+def getReplayCost(windows, overheadSeconds, replayRatio):
+    return sum([overheadSeconds + max(window.endEpoch - window.startEpoch, 0) * replayRatio for window in windows])
+
+#Packs the windows and returns the plan: {'windows': [[kept window, [merged windows]], ...] for the requests changing, 'costBefore', 'costAfter'}.
+#The window kept is the oldest replay item of the request (lowest key), extended to the request start and end datetimes.
+def planReplayPacking(windows, overheadSeconds, replayRatio):
+    windows = [window for window in windows if window.startEpoch is not None and window.endEpoch is not None]
+    plan = {'windows': [], 'costBefore': getReplayCost(windows, overheadSeconds, replayRatio), 'costAfter': 0}
+    for firstWindow, startEpoch, endEpoch, mergedWindows in packReplayWindows(windows, overheadSeconds, replayRatio):
+        plan['costAfter'] += overheadSeconds + max(endEpoch - startEpoch, 0) * replayRatio
+        if len(mergedWindows) == 0:
+            continue
+        groupWindows = [firstWindow] + mergedWindows
+        keptWindow = min(groupWindows, key = lambda window: window.key)
+        #Datetimes are taken from the windows as they are stored, so they keep the database format
+        startWindow = min(groupWindows, key = lambda window: window.startEpoch)
+        endWindow = max(groupWindows, key = lambda window: window.endEpoch)
+        keptWindow.startdate, keptWindow.startEpoch = startWindow.startdate, startWindow.startEpoch
+        keptWindow.enddate, keptWindow.endEpoch = endWindow.enddate, endWindow.endEpoch
+        keptWindow.isModified = True
+        plan['windows'].append([keptWindow, [window for window in groupWindows if window is not keptWindow]])
+    return plan
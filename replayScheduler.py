@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+##
+## Deadline aware replay ordering for AutoBRM: the replay items whose data leaves the Col-CC AOS/LOS buffer first go first.
+##  Source : Replay items waiting in a state with a procedure (NEW, RT_DONE), with their window, priority and DaSS source.
+##  Destination : Order in which the dispatch walks them, and the replay items which can't be replayed any more.
+##
+## The Col-CC buffer keeps bufferSeconds (72 hours) of data: a replay window can be replayed until its start datetime
+## plus bufferSeconds. The estimated transfer time of a replay is the request overhead plus the window length times
+## the replay ratio (recorded bitrate over bitstream request bitrate), so its slack is
+##  slack = start + bufferSeconds - now - transfer time
+## A replay item with a negative slack can't finish before its data expires: it is given up instead of holding a BRM slot.
+## The others are ordered by slack, each priority point counting as prioritySeconds of slack less, then by id.
+## Source availability is left to the dispatch: it walks this order and skips the items of a busy source.
+##
+
+#Returns [replay items in dispatch order, expired replay items]. Each replay item is a dictionary with the keys replayID,
+#priority, startEpoch and endEpoch at least; the estimated 'transferSeconds' and 'slackSeconds' are added to it.
+#Replay items without a readable window can't be placed, they are kept in front in id order as the view would give them.
+def orderReplayItems(replayItems, now, bufferSeconds, replayRatio, overheadSeconds, prioritySeconds):
+    unplaced = []
+    placed = []
+    expired = []
+    for replayItem in replayItems:
+        if replayItem['startEpoch'] is None or replayItem['endEpoch'] is None:
+            unplaced.append(replayItem)
+            continue
+        replayItem['transferSeconds'] = overheadSeconds + max(replayItem['endEpoch'] - replayItem['startEpoch'], 0) * replayRatio
+        replayItem['slackSeconds'] = replayItem['startEpoch'] + bufferSeconds - now - replayItem['transferSeconds']
+        if replayItem['slackSeconds'] < 0:
+            expired.append(replayItem)
+        else:
+            placed.append(replayItem)
+    unplaced.sort(key = lambda replayItem: (-(replayItem['priority'] or 0), replayItem['replayID']))
+    placed.sort(key = lambda replayItem: (replayItem['slackSeconds'] - (replayItem['priority'] or 0) * prioritySeconds, replayItem['replayID']))
+    return [unplaced + placed, expired]
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+##
+## VMU/HRD sequence count checker. Python port of sqchk.awk, to be imported by AutoBRM.
+##  Source : Meex 'list -e -k vmu' listing lines.
+##  Destination : Gap ('G') and corrupt packet run ('B') records.
+##
+## Run as a script it prints the same output as sqchk.awk (sqchk.py [listing]), or compares itself
+## with sqchk.awk on a recorded listing (sqchk.py --compare listing [--awk gawk]).
+##
+
+import re
+import sys
+import argparse
+import subprocess
+from collections import namedtuple, OrderedDict
+
+#Same field separator as the awk script: FS="([[:space:]]+\\|+[[:space:]]+)|,|;"
+fieldSeparator = re.compile(r'(?:\s+\|+\s+)|,|;')
+badPacketPattern = re.compile(r'\s+(?:invalid|bad)\s+|invalid')
+keptOriginPattern = re.compile(r'3[3-9]|4[0-7]|51|90')
+awkNumberPattern = re.compile(r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+awkStrnumPattern = re.compile(r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*$')
+#Records the scan pipeline drops with grep -vE "IMG|SCC"
+excludedPattern = re.compile(r'IMG|SCC')
+
+channelNames = ('lrsd', 'vic1', 'vic2')
+
+gapRowFormat = 'G | %4s | %s | %s | %8d | %8d | %8d || %2d | %s | %s | %8d | %8d | %4d | %s'
+badRowFormat = 'B | %4s | %s | %s | %8d | %8d | %8d || %2d'
+
+#A regular gap: missing packets between two received packets. VMU part first, HRD part after the origin, as in the awk output row.
+GapRecord = namedtuple('GapRecord', 'channel vmuStartdate vmuEnddate vmuLastSequenceCount vmuNextSequenceCount vmuDifference '
+    'origin hrdStartdate hrdEnddate hrdLastSequenceCount hrdNextSequenceCount hrdDifference upi')
+#A run of corrupt (invalid/bad) packets of one channel and origin.
+BadRecord = namedtuple('BadRecord', 'channel startdate enddate firstSequenceCount lastSequenceCount difference origin')
+
+#Numeric value of a string the way awk converts it: longest leading number, 0 if none.
+def awkNumber(value):
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        match = awkNumberPattern.match(value)
+        return float(match.group(0)) if match else 0
+
+#Integer printed by awk for %d
+def awkInteger(value):
+    return int(awkNumber(value))
+
+#String value of a number the way awk converts it (integers as such, CONVFMT %.6g otherwise)
+def awkString(value):
+    if value == int(value):
+        return '%d' % value
+    return '%.6g' % value
+
+#awk 'number != field' test: numeric comparison if the field looks like a number, string comparison otherwise
+def awkNotEqual(number, field):
+    if awkStrnumPattern.match(field):
+        return number != awkNumber(field)
+    return awkString(number) != field
+
+#Origins (HRD sources) the gaps are reported for
+def keepOrigin(origin):
+    return keptOriginPattern.search(origin) is not None
+
+#True for records the scan pipeline used to drop with grep -vE "IMG|SCC"
+def isExcludedRecord(record):
+    if isinstance(record, GapRecord):
+        textFields = (record.channel, record.vmuStartdate, record.vmuEnddate, record.hrdStartdate, record.hrdEnddate, record.upi)
+    else:
+        textFields = (record.channel, record.startdate, record.enddate)
+    for textField in textFields:
+        if excludedPattern.search(textField):
+            return True
+    return False
+
+#Returns a record as the awk script prints it
+def formatRecord(record):
+    if isinstance(record, GapRecord):
+        return gapRowFormat % record
+    return badRowFormat % record
+
+#Per channel/origin sequence tracking state of one listing. Feed every listing line to check(), then call finish() for the corrupt runs still open at the end.
+class SequenceChecker(object):
+
+    def __init__(self):
+        #VMU state and counters per channel
+        self.channels = dict((channel, {'total': 0, 'missing': 0, 'bad': 0, 'time': '', 'seq': ''}) for channel in channelNames)
+        #HRD state per channel and origin
+        self.origins = dict((channel, {}) for channel in channelNames)
+        #Open corrupt packet runs per channel and origin
+        self.badRuns = OrderedDict()
+
+    #Checks one listing line. Returns the records it closes (usually none).
+    def check(self, line):
+        line = line.rstrip('\n')
+        return self.checkFields(line, fieldSeparator.split(line))
+
+    #Same as check, for a line already split into fields
+    def checkFields(self, line, fields):
+        if len(fields) < 11:
+            return []
+        records = []
+        channel = fields[6]
+        origin = fields[7]
+
+        if badPacketPattern.search(line):
+            if channel in self.channels:
+                self.channels[channel]['bad'] += 1
+            if not keepOrigin(origin):
+                return records
+            self.addBadPacket(fields, channel, origin)
+
+        for channelName in channelNames:
+            if channelName not in line:
+                continue
+            vmu = self.channels[channelName]
+            vmu['total'] += 1
+            if not keepOrigin(origin):
+                return records
+            hrdStates = self.origins[channelName]
+            if origin in hrdStates:
+                vmu['missing'] += self.checkGap(fields, hrdStates[origin], vmu, records)
+            vmu['time'] = fields[2]
+            vmu['seq'] = fields[3]
+            self.checkBad(fields[13] if len(fields) > 13 else '', channel, origin, records)
+            hrdStates[origin] = {'time': fields[8], 'seq': fields[9], 'upi': fields[10]}
+
+        return records
+
+    #Adds a corrupt packet to the run of its channel and origin, opening the run if none is open.
+    def addBadPacket(self, fields, channel, origin):
+        badRun = self.badRuns.setdefault(channel, OrderedDict()).setdefault(origin, {'count': 0})
+        badRun['count'] += 1
+        if 'seq' not in badRun:
+            badRun['seq'] = fields[3]
+            badRun['time'] = fields[2]
+            badRun['first'] = fields[3]
+            badRun['dtstart'] = fields[2]
+        else:
+            badRun['last'] = fields[3]
+            badRun['dtend'] = fields[2]
+
+    #HRD sequence count jump since the previous packet of the origin: appends a gap record, returns the number of missing packets.
+    def checkGap(self, fields, hrd, vmu, records):
+        delta = awkNumber(fields[9]) - awkNumber(hrd['seq'])
+        if delta > 1 and awkNotEqual(delta, fields[9]):
+            vmuDifference = (awkNumber(fields[3]) - awkNumber(vmu['seq'])) - 1
+            upi = hrd['upi']
+            if '*' in upi:
+                upi = '?'
+            records.append(GapRecord(fields[6], vmu['time'], fields[2], awkInteger(vmu['seq']), awkInteger(fields[3]), int(vmuDifference),
+                awkInteger(fields[7]), hrd['time'], fields[8], awkInteger(hrd['seq']), awkInteger(fields[9]), int(delta - 1), upi))
+        else:
+            delta = 1
+        return delta - 1
+
+    #Closes the open corrupt run of the channel and origin, unless the packet is corrupt itself.
+    def checkBad(self, bad, channel, origin, records):
+        if bad == 'invalid' or bad == 'bad':
+            return
+        if channel in self.badRuns and origin in self.badRuns[channel]:
+            badRun = self.badRuns[channel][origin]
+            dtstart = badRun['dtstart']
+            dtend = badRun.get('dtend', '')
+            first = badRun['first']
+            last = badRun.get('last', '')
+
+            delta = awkNumber(last) - awkNumber(first)
+            if delta <= 0:
+                last = first
+                dtend = dtstart
+                delta = 1
+            records.append(BadRecord(channel, dtstart, dtend, awkInteger(first), awkInteger(last), int(delta), awkInteger(origin)))
+            del self.badRuns[channel][origin]
+
+    #Returns the records of the corrupt runs still open at the end of the listing.
+    def finish(self):
+        records = []
+        for channel in self.badRuns.keys():
+            if channel not in channelNames:
+                continue
+            for origin in self.badRuns[channel].keys():
+                self.checkBad('', channel, origin, records)
+        return records
+
+    #Returns the summary printed by the awk script at the end of the listing
+    def summary(self):
+        lrsd, vic1, vic2 = [self.channels[channel] for channel in channelNames]
+        return '\n%d VMU packets\n' % (lrsd['total'] + vic1['total'] + vic2['total']) + \
+            'missing %d LRSD packets (total: %d, bad: %d) \n' % (lrsd['missing'], lrsd['total'], lrsd['bad']) + \
+            'missing %d VIC1 packets (total: %d, bad: %d)\n' % (vic1['missing'], vic1['total'], vic1['bad']) + \
+            'missing %d VIC2 packets (total: %d, bad: %d)\n' % (vic2['missing'], vic2['total'], vic2['bad']) + \
+            '\n\n'
+
+#Packets per HRD origin and user VMU record (UPI) of a listing, the figures 'meex count -k hrd' gives for the same folder.
+class PacketCounter(object):
+
+    def __init__(self):
+        self.counts = OrderedDict()
+
+    #Counts the packet of a listing line split into fields. SCC and IMG records are left out as the count scan pipeline does.
+    def count(self, fields):
+        if len(fields) < 11:
+            return
+        upi = fields[10].strip()
+        if excludedPattern.search(upi):
+            return
+        key = (fields[7].strip(), upi)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+#Yields the gap and corrupt run records of Meex listing lines as checkLines does, while counting every packet of the listing with the given counter. One read of the listing serves both.
+def checkAndCountLines(lines, checker, counter, keepExcluded = False):
+    for line in lines:
+        line = line.rstrip('\n')
+        fields = fieldSeparator.split(line)
+        counter.count(fields)
+        for record in checker.checkFields(line, fields):
+            if keepExcluded or not isExcludedRecord(record):
+                yield record
+    for record in checker.finish():
+        if keepExcluded or not isExcludedRecord(record):
+            yield record
+
+#Yields the gap and corrupt run records of Meex listing lines, including the runs still open at the end. Records the scan pipeline filtered out with grep are skipped, unless keepExcluded is set.
+def checkLines(lines, checker = None, keepExcluded = False):
+    if checker is None:
+        checker = SequenceChecker()
+    for line in lines:
+        for record in checker.check(line):
+            if keepExcluded or not isExcludedRecord(record):
+                yield record
+    for record in checker.finish():
+        if keepExcluded or not isExcludedRecord(record):
+            yield record
+
+#Prints the awk script output for a listing
+def printAwkOutput(lines, output):
+    checker = SequenceChecker()
+    for record in checkLines(lines, checker, keepExcluded = True):
+        output.write(formatRecord(record) + '\n')
+    output.write(checker.summary())
+
+#Splits awk script output into gap rows (in order), corrupt run rows (in any order, the awk end of listing loop has no defined order) and the summary.
+def splitAwkOutput(text):
+    gapRows = []
+    badRows = []
+    summary = []
+    for line in text.split('\n'):
+        if line.startswith('G |'):
+            gapRows.append(line)
+        elif line.startswith('B |'):
+            badRows.append(line)
+        elif line.strip():
+            summary.append(line)
+    return [gapRows, sorted(badRows), summary]
+
+#Runs sqchk.awk and this module on a recorded listing and reports the differences. Returns the number of differing output parts.
+def compareWithAwk(listingFile, awkCommand, awkScript):
+    awkProcess = subprocess.Popen([awkCommand, '-f', awkScript, listingFile], stdout=subprocess.PIPE)
+    awkOutput = awkProcess.communicate()[0]
+    if awkProcess.returncode != 0:
+        sys.stderr.write('%s exited with status %s\n' % (awkCommand, awkProcess.returncode))
+        return 1
+
+    class Output(object):
+        def __init__(self):
+            self.parts = []
+        def write(self, text):
+            self.parts.append(text)
+    pythonOutput = Output()
+    with open(listingFile) as listing:
+        printAwkOutput(listing, pythonOutput)
+
+    differences = 0
+    for partName, awkPart, pythonPart in zip(('gap rows', 'corrupt run rows', 'summary'), splitAwkOutput(awkOutput), splitAwkOutput(''.join(pythonOutput.parts))):
+        if awkPart == pythonPart:
+            sys.stdout.write('OK %s: %s lines\n' % (partName, len(awkPart)))
+            continue
+        differences += 1
+        sys.stdout.write('DIFFERENT %s: %s lines from awk, %s from python\n' % (partName, len(awkPart), len(pythonPart)))
+        for awkLine, pythonLine in zip(awkPart, pythonPart):
+            if awkLine != pythonLine:
+                sys.stdout.write('  awk:    %s\n  python: %s\n' % (awkLine, pythonLine))
+                break
+    return differences
+
+#main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VMU/HRD sequence count checker (sqchk.awk port)')
+    parser.add_argument('listing', nargs='?', help='Meex "list -e -k vmu" output, standard input if not given')
+    parser.add_argument('--compare', action='store_true', help='compare the output with sqchk.awk on the listing file')
+    parser.add_argument('--awk', default='gawk', help='awk command used by --compare (gawk is needed by sqchk.awk)')
+    parser.add_argument('--awk-script', default='/opt/autobrm/bin/sqchk.awk', help='sqchk.awk location used by --compare')
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        if not arguments.listing:
+            parser.error('--compare needs a listing file')
+        sys.exit(1 if compareWithAwk(arguments.listing, arguments.awk, arguments.awk_script) else 0)
+
+    if arguments.listing:
+        with open(arguments.listing) as listing:
+            printAwkOutput(listing, sys.stdout)
+    else:
+        printAwkOutput(sys.stdin, sys.stdout)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+##
+## Vectorized VMU/HRD sequence count checker: the sqchk checker working on blocks of listing lines with NumPy arrays.
+##  Source : Meex 'list -e -k vmu' listing lines.
+##  Destination : The gap ('G') and corrupt packet run ('B') records sqchk gives for the same lines, in the same order.
+##
+## The lines are read blockLines at a time. The regular lines of a block (one channel name, kept origin, integer
+## sequence counts) are loaded as columns: channel, channel/origin group, VMU and HRD sequence counts, corrupt flags.
+## The previous packet of each line in its channel and in its channel/origin group is found by a stable sort, and the HRD
+## sequence jumps by one array comparison. The corrupt runs are walked only at their events: the corrupt packets and the
+## first packet closing each run. The block leaves its last packets and open runs in the sqchk.SequenceChecker state, so
+## the next block, the few irregular lines checked one by one by sqchk, finish() and summary() carry on exactly as in sqchk.
+##
+## Needs NumPy: AutoBRM uses it when the variable scan_gap_detector is set to vectorized, and sqchk without NumPy.
+## Run as a script it prints the sqchk.awk output (sqchkVectorized.py [listing]), or compares itself with sqchk
+## on a recorded listing (sqchkVectorized.py --compare listing).
+##
+
+import sys
+import argparse
+import numpy
+import sqchk
+
+#Listing lines checked at once
+blockLines = 100000
+#Sequence counts beyond this size are left to sqchk, their differences would not fit the int64 arrays
+maxSequenceCount = 2 ** 60
+
+channelIndexes = dict([(channelName, index) for (index, channelName) in enumerate(sqchk.channelNames)])
+#Channel names a line of each channel must not hold to be checked on its own
+otherChannelNames = dict([(channelName, tuple([otherName for otherName in sqchk.channelNames if otherName != channelName])) for channelName in sqchk.channelNames])
+
+#Splits a listing line as sqchk.fieldSeparator does. Lines whose separators are all ' | ' are split with string methods,
+#lines with other separators or empty fields go through the regular expression.
+def splitFields(line):
+    if ',' in line or ';' in line or '|' not in line or line.count('|') != line.count(' | '):
+        return sqchk.fieldSeparator.split(line)
+    pieces = line.split(' | ')
+    fields = map(str.strip, pieces)
+    if '' in fields[1:-1]:
+        return sqchk.fieldSeparator.split(line)
+    #The regular expression keeps the whitespace at both ends of the line
+    fields[0] = pieces[0].rstrip()
+    fields[-1] = pieces[-1].lstrip()
+    return fields
+
+#Fields of the lines of a block, split again for the few lines whose fields are needed. Keeping the lines rather than
+#their fields spares a list per line, and the garbage collector passes over them.
+class LineFields(object):
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.fields = {}
+
+    def __getitem__(self, index):
+        if index not in self.fields:
+            self.fields[index] = splitFields(self.lines[index])
+        return self.fields[index]
+
+#Returns the index of the previous line with the same key, -1 for the first line of each key.
+def getPreviousIndexes(keys):
+    order = numpy.argsort(keys, kind = 'mergesort')
+    isSameKey = keys[order[1:]] == keys[order[:-1]]
+    previousIndexes = numpy.full(len(keys), -1, dtype = numpy.int64)
+    previousIndexes[order[1:][isSameKey]] = order[:-1][isSameKey]
+    return previousIndexes
+
+#Returns the index of the last line of each key
+def getLastIndexes(keys):
+    reversedIndexes = numpy.unique(keys[::-1], return_index = True)[1]
+    return len(keys) - 1 - reversedIndexes
+
+#Returns the line indexes of the first closing line at or after each corrupt line of its group, and of the first closing
+#line of each group (the run left open by the previous block, if any, ends there).
+def getBadRunEvents(groups, badFlags, closeFlags):
+    lineCount = len(groups)
+    order = numpy.argsort(groups, kind = 'mergesort')
+    sortedGroups = groups[order]
+    groupStarts = numpy.flatnonzero(numpy.concatenate(([True], sortedGroups[1:] != sortedGroups[:-1])))
+    groupEnds = numpy.append(groupStarts[1:], lineCount)
+    groupEndOfPositions = numpy.repeat(groupEnds, groupEnds - groupStarts)
+    #Next closing position (in group order) at or after each position, beyond the group end if none
+    closePositions = numpy.where(closeFlags[order], numpy.arange(lineCount), lineCount)
+    nextClosePositions = numpy.minimum.accumulate(closePositions[::-1])[::-1]
+    startPositions = numpy.concatenate((numpy.flatnonzero(badFlags[order]), groupStarts))
+    eventPositions = nextClosePositions[startPositions]
+    return order[eventPositions[eventPositions < groupEndOfPositions[startPositions]]]
+
+#sqchk.SequenceChecker checking blocks of lines at once. Use checkBlock (or the module checkLines) instead of check.
+class SequenceChecker(sqchk.SequenceChecker):
+
+    def __init__(self):
+        sqchk.SequenceChecker.__init__(self)
+        #Origin field -> [kept by keepOrigin, integer value or None], a listing has a handful of origins
+        self.originValues = {}
+
+    def getOriginValue(self, origin):
+        if origin not in self.originValues:
+            try:
+                originValue = int(origin)
+            except ValueError:
+                originValue = None
+            self.originValues[origin] = [sqchk.keepOrigin(origin), originValue]
+        return self.originValues[origin]
+
+    #Checks a block of listing lines, counting their packets with the counter if any. Returns the records the lines close, as check() would.
+    def checkBlock(self, lines, counter = None):
+        records = []
+        #Regular lines: (line, channel index, channel/origin group, VMU sequence count, HRD sequence count, corrupt, closes the corrupt run)
+        rows = []
+        groupIndexes = {}
+        for line in lines:
+            line = line.rstrip('\n')
+            fields = splitFields(line)
+            if counter is not None:
+                counter.count(fields)
+            if len(fields) < 11:
+                continue
+            channel = fields[6]
+            origin = fields[7]
+            isBad = 'invalid' in line or ('bad' in line and sqchk.badPacketPattern.search(line) is not None)
+            if channel in otherChannelNames:
+                isRegular = True
+                for channelName in otherChannelNames[channel]:
+                    if channelName in line:
+                        isRegular = False
+                if isRegular:
+                    originValue = self.originValues.get(origin) or self.getOriginValue(origin)
+                    if not originValue[0]:
+                        #Counted, not checked: a corrupt packet as bad only, the others in the total
+                        self.channels[channel]['bad' if isBad else 'total'] += 1
+                        continue
+                    try:
+                        vmuSequenceCount = int(fields[3])
+                        hrdSequenceCount = int(fields[9])
+                        isRegular = originValue[1] is not None and abs(vmuSequenceCount) < maxSequenceCount and abs(hrdSequenceCount) < maxSequenceCount
+                    except ValueError:
+                        isRegular = False
+                if isRegular:
+                    rows.append((line, channelIndexes[channel], groupIndexes.setdefault((channel, origin), len(groupIndexes)), vmuSequenceCount,
+                        hrdSequenceCount, isBad, len(fields) <= 13 or (fields[13] != 'invalid' and fields[13] != 'bad')))
+                    continue
+            elif not isBad:
+                isChecked = False
+                for channelName in sqchk.channelNames:
+                    if channelName in line:
+                        isChecked = True
+                if not isChecked:
+                    #Not a packet of a checked channel
+                    continue
+            #Irregular line (several channel names, odd channel, origin or sequence count fields): checked by sqchk after the lines before it
+            records.extend(self.checkRows(rows))
+            rows = []
+            records.extend(self.checkFields(line, fields))
+        records.extend(self.checkRows(rows))
+        return records
+
+    #Checks the regular lines of a block and moves the checker state past them. Returns the records in line order.
+    def checkRows(self, rows):
+        lineCount = len(rows)
+        if lineCount == 0:
+            return []
+        lineRows, channels, groups, vmuSequenceCounts, hrdSequenceCounts, badFlags, closeFlags = zip(*rows)
+        fieldRows = LineFields(lineRows)
+        channels = numpy.array(channels, dtype = numpy.int8)
+        groups = numpy.array(groups, dtype = numpy.int64)
+        vmuSequenceCounts = numpy.array(vmuSequenceCounts, dtype = numpy.int64)
+        hrdSequenceCounts = numpy.array(hrdSequenceCounts, dtype = numpy.int64)
+        badFlags = numpy.array(badFlags, dtype = bool)
+        closeFlags = numpy.array(closeFlags, dtype = bool)
+        previousVmuIndexes = getPreviousIndexes(channels)
+        previousHrdIndexes = getPreviousIndexes(groups)
+        #(line index, 0 for a gap or 1 for a corrupt run, record)
+        indexedRecords = []
+
+        #HRD sequence jumps: same test as sqchk.checkGap, each candidate line is then checked by checkGap itself
+        hasPrevious = previousHrdIndexes >= 0
+        deltas = hrdSequenceCounts - hrdSequenceCounts[previousHrdIndexes]
+        gapIndexes = numpy.flatnonzero(hasPrevious & (deltas > 1) & (deltas != hrdSequenceCounts))
+        #First line of each group: the previous packet is the one left by the previous blocks, if any
+        firstIndexes = numpy.flatnonzero(~hasPrevious)
+        for index in sorted(gapIndexes.tolist() + firstIndexes.tolist()):
+            fields = fieldRows[index]
+            channelState = self.channels[fields[6]]
+            previousHrdIndex = previousHrdIndexes[index]
+            if previousHrdIndex >= 0:
+                previousFields = fieldRows[previousHrdIndex]
+                hrd = {'time': previousFields[8], 'seq': previousFields[9], 'upi': previousFields[10]}
+            elif fields[7] in self.origins[fields[6]]:
+                hrd = self.origins[fields[6]][fields[7]]
+            else:
+                continue
+            previousVmuIndex = previousVmuIndexes[index]
+            if previousVmuIndex >= 0:
+                vmu = {'time': fieldRows[previousVmuIndex][2], 'seq': fieldRows[previousVmuIndex][3]}
+            else:
+                vmu = channelState
+            gapRecords = []
+            channelState['missing'] += self.checkGap(fields, hrd, vmu, gapRecords)
+            for record in gapRecords:
+                indexedRecords.append((index, 0, record))
+
+        #Corrupt runs, replayed in line order at their events as checkFields does
+        eventIndexes = set(getBadRunEvents(groups, badFlags, closeFlags).tolist())
+        eventIndexes.update(numpy.flatnonzero(badFlags).tolist())
+        for index in sorted(eventIndexes):
+            fields = fieldRows[index]
+            if badFlags[index]:
+                self.channels[fields[6]]['bad'] += 1
+                self.addBadPacket(fields, fields[6], fields[7])
+            if closeFlags[index]:
+                badRecords = []
+                self.checkBad('', fields[6], fields[7], badRecords)
+                for record in badRecords:
+                    indexedRecords.append((index, 1, record))
+
+        #State after the block: packet counts, and last packet of each channel and group
+        for channelIndex, packetCount in enumerate(numpy.bincount(channels, minlength = len(sqchk.channelNames)).tolist()):
+            self.channels[sqchk.channelNames[channelIndex]]['total'] += packetCount
+        for index in getLastIndexes(channels).tolist():
+            fields = fieldRows[index]
+            self.channels[fields[6]]['time'] = fields[2]
+            self.channels[fields[6]]['seq'] = fields[3]
+        for index in getLastIndexes(groups).tolist():
+            fields = fieldRows[index]
+            self.origins[fields[6]][fields[7]] = {'time': fields[8], 'seq': fields[9], 'upi': fields[10]}
+
+        indexedRecords.sort(key = lambda indexedRecord: indexedRecord[:2])
+        return [record for (index, recordType, record) in indexedRecords]
+
+#Yields the lines in lists of blockLines
+def iterLineBlocks(lines):
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= blockLines:
+            yield block
+            block = []
+    if block:
+        yield block
+
+#Same as sqchk.checkAndCountLines, a block of lines at a time
+def checkAndCountLines(lines, checker, counter, keepExcluded = False):
+    for block in iterLineBlocks(lines):
+        for record in checker.checkBlock(block, counter):
+            if keepExcluded or not sqchk.isExcludedRecord(record):
+                yield record
+    for record in checker.finish():
+        if keepExcluded or not sqchk.isExcludedRecord(record):
+            yield record
+
+#Same as sqchk.checkLines, a block of lines at a time
+def checkLines(lines, checker = None, keepExcluded = False):
+    if checker is None:
+        checker = SequenceChecker()
+    return checkAndCountLines(lines, checker, None, keepExcluded)
+
+#Prints the awk script output for a listing
+def printAwkOutput(lines, output):
+    checker = SequenceChecker()
+    for record in checkLines(lines, checker, keepExcluded = True):
+        output.write(sqchk.formatRecord(record) + '\n')
+    output.write(checker.summary())
+
+#Checks a recorded listing with sqchk and with this module and reports the differences. Returns the number of differing output parts.
+def compareWithSqchk(listingFile):
+    outputs = []
+    for checkModule in [sqchk, sys.modules[__name__]]:
+        checker = checkModule.SequenceChecker()
+        with open(listingFile) as listing:
+            records = [sqchk.formatRecord(record) for record in checkModule.checkLines(listing, checker, keepExcluded = True)]
+        outputs.append([records, checker.summary()])
+    differences = 0
+    for partName, sqchkPart, vectorizedPart in zip(('records', 'summary'), outputs[0], outputs[1]):
+        if sqchkPart == vectorizedPart:
+            sys.stdout.write('OK %s\n' % partName)
+            continue
+        differences += 1
+        sys.stdout.write('DIFFERENT %s\n' % partName)
+        if partName == 'records':
+            for sqchkLine, vectorizedLine in zip(sqchkPart + [''], vectorizedPart + ['']):
+                if sqchkLine != vectorizedLine:
+                    sys.stdout.write('  sqchk:      %s\n  vectorized: %s\n' % (sqchkLine, vectorizedLine))
+                    break
+    return differences
+
+#main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized VMU/HRD sequence count checker (sqchk.awk port)')
+    parser.add_argument('listing', nargs='?', help='Meex "list -e -k vmu" output, standard input if not given')
+    parser.add_argument('--compare', action='store_true', help='compare the output with sqchk on the listing file')
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        if not arguments.listing:
+            parser.error('--compare needs a listing file')
+        sys.exit(1 if compareWithSqchk(arguments.listing) else 0)
+
+    if arguments.listing:
+        with open(arguments.listing) as listing:
+            printAwkOutput(listing, sys.stdout)
+    else:
+        printAwkOutput(sys.stdin, sys.stdout)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+##
+## Tests of the AutoBRM schema migrations on new databases and on databases made before the migrations existed.
+##  python -m unittest discover -s tests
+##
+
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import autobrmSchema
+
+class UpgradeDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbCon = sqlite3.connect(':memory:', isolation_level = None)
+
+    def tearDown(self):
+        self.dbCon.close()
+
+    #Version 1 only, as a database made by hand before the migrations existed
+    def createBaseSchema(self):
+        dbCur = self.dbCon.cursor()
+        for statement in autobrmSchema.baseSchemaStatements:
+            if callable(statement):
+                statement(dbCur)
+            else:
+                dbCur.execute(statement)
+        dbCur.close()
+
+    def getColumnNames(self, tableName):
+        return [row[1] for row in self.dbCon.execute('PRAGMA table_info(%s);' % tableName).fetchall()]
+
+    def testNewDatabase(self):
+        self.assertEqual(autobrmSchema.upgradeDatabase(self.dbCon), range(1, len(autobrmSchema.migrations) + 1))
+        self.assertEqual(autobrmSchema.getSchemaVersion(self.dbCon), len(autobrmSchema.migrations))
+        self.assertEqual(autobrmSchema.upgradeDatabase(self.dbCon), [])
+        self.assertEqual(autobrmSchema.checkQueryPlans(self.dbCon), [])
+
+    #A database made by hand (user_version 0) whose replay table has the current status column already, with a replay in the NEW state
+    def testHandMadeDatabase(self):
+        self.createBaseSchema()
+        self.dbCon.execute('ALTER TABLE replay ADD COLUMN replay_status_id INTEGER;')
+        self.dbCon.execute('INSERT INTO replay (id, startdate, enddate) VALUES (1, "2023-01-01 00:00:00", "2023-01-01 00:01:00");')
+        self.dbCon.execute('INSERT INTO replay_job (replay_id, replay_status_id) VALUES (1, 1);')
+        self.assertEqual(autobrmSchema.upgradeDatabase(self.dbCon), range(1, len(autobrmSchema.migrations) + 1))
+        self.assertEqual(self.getColumnNames('replay').count('replay_status_id'), 1)
+        self.assertEqual(self.dbCon.execute('SELECT replayID, replayStatus FROM next_replay_in_queue;').fetchall(), [(1, u'NEW')])
+
+    #Migration 4 on a replay table without the column: added, and set from the latest job
+    def testReplayStatusColumnAdded(self):
+        self.createBaseSchema()
+        self.dbCon.execute('INSERT INTO replay (id) VALUES (1);')
+        self.dbCon.execute('INSERT INTO replay_job (replay_id, replay_status_id) VALUES (1, 1);')
+        self.dbCon.execute('INSERT INTO replay_job (replay_id, replay_status_id) VALUES (1, 3);')
+        autobrmSchema.upgradeDatabase(self.dbCon)
+        self.assertEqual(self.dbCon.execute('SELECT replay_status_id FROM replay WHERE id = 1;').fetchall(), [(3,)])
+
+    #The views of the site keep their definition (dispatch order and filter), the current status has its own view
+    def testExistingViewsKept(self):
+        self.dbCon.execute('CREATE TABLE replay_status (id INTEGER PRIMARY KEY, name TEXT, workflow INTEGER, function_name TEXT);')
+        self.dbCon.execute('CREATE TABLE replay (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, startdate DATETIME, enddate DATETIME, priority INTEGER DEFAULT 0);')
+        self.dbCon.execute('CREATE TABLE replay_job (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, text TEXT, replay_id INTEGER, replay_status_id INTEGER);')
+        self.dbCon.execute('CREATE VIEW latest_replay_status AS SELECT rj.replay_id AS replayID, rs.name AS replayStatus, rs.function_name AS functionName FROM replay_job rj \
+        JOIN replay_status rs ON rs.id = rj.replay_status_id WHERE rj.id IN (SELECT MAX(id) FROM replay_job GROUP BY replay_id);')
+        self.dbCon.execute('CREATE VIEW next_replay_in_queue AS SELECT replayID, replayStatus, functionName FROM latest_replay_status WHERE functionName LIKE "process%" ORDER BY replayID DESC;')
+        viewStatements = self.dbCon.execute('SELECT name, sql FROM sqlite_master WHERE type = "view" ORDER BY name;').fetchall()
+        self.dbCon.execute('INSERT INTO replay_status (id, name, workflow, function_name) VALUES (1, "NEW", 10, "processReplayBrmRT");')
+        self.dbCon.execute('INSERT INTO replay (id) VALUES (1);')
+        self.dbCon.execute('INSERT INTO replay (id) VALUES (2);')
+        self.dbCon.execute('INSERT INTO replay_job (replay_id, replay_status_id) VALUES (1, 1);')
+        self.dbCon.execute('INSERT INTO replay_job (replay_id, replay_status_id) VALUES (2, 1);')
+        autobrmSchema.upgradeDatabase(self.dbCon)
+        self.assertEqual(self.dbCon.execute('SELECT name, sql FROM sqlite_master WHERE type = "view" AND name != "current_replay_status" ORDER BY name;').fetchall(), viewStatements)
+        self.assertEqual(self.dbCon.execute('SELECT replayID FROM next_replay_in_queue;').fetchall(), [(2,), (1,)])
+        self.assertEqual(self.dbCon.execute('SELECT replayID, replayStatus, functionName FROM current_replay_status ORDER BY replayID;').fetchall(), \
+        [(1, u'NEW', u'processReplayBrmRT'), (2, u'NEW', u'processReplayBrmRT')])
+
+    #The workflow of an existing replay_status table is kept, the final states come after it
+    def testExistingWorkflowKept(self):
+        self.dbCon.execute('CREATE TABLE replay_status (id INTEGER PRIMARY KEY, name TEXT, workflow INTEGER, function_name TEXT, description TEXT);')
+        self.dbCon.execute('INSERT INTO replay_status (id, name, workflow, function_name) VALUES (7, "NEW", 1, "processReplayBrmRT");')
+        self.dbCon.execute('INSERT INTO replay_status (id, name, workflow, function_name) VALUES (8, "DONE", 2, NULL);')
+        autobrmSchema.upgradeDatabase(self.dbCon)
+        self.assertEqual(self.dbCon.execute('SELECT id, name, workflow FROM replay_status ORDER BY workflow;').fetchall(), \
+        [(7, u'NEW', 1), (8, u'DONE', 2), (9, u'MERGED', 12), (10, u'EXPIRED', 22)])
+
+    #An existing table without a column AutoBRM queries fails the base migration, nothing is applied
+    def testMissingColumn(self):
+        self.dbCon.execute('CREATE TABLE replay (id INTEGER PRIMARY KEY AUTOINCREMENT, startdate DATETIME, enddate DATETIME);')
+        self.assertRaises(sqlite3.OperationalError, autobrmSchema.upgradeDatabase, self.dbCon)
+        self.assertEqual(autobrmSchema.getSchemaVersion(self.dbCon), 0)
+        self.assertEqual(self.dbCon.execute('SELECT name FROM sqlite_master WHERE type = "table" ORDER BY name;').fetchall(), [(u'replay',), (u'sqlite_sequence',)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+##
+## Tests of the gap ingestion of the scan (ingestGapItems) on recorded Meex listings, with another connection writing while Meex runs.
+##  python -m unittest discover -s tests
+##
+
+import os
+import sys
+import imp
+import shutil
+import logging
+import sqlite3
+import tempfile
+import unittest
+
+testDirectory = os.path.dirname(os.path.abspath(__file__))
+packageDirectory = os.path.dirname(testDirectory)
+sys.path.insert(0, packageDirectory)
+import autobrmSchema
+import autobrmDatabase
+#AutoBRM and the LOS filler are installed under their names without version
+imp.load_source('autoLosSensingReplayFiller', os.path.join(packageDirectory, 'autoLosSensingReplayFiller_v1.2.py'))
+autobrm = imp.load_source('autobrm', os.path.join(packageDirectory, 'autobrm_v1.5.2.py'))
+autobrm.logger = logging.getLogger('testGapIngest')
+autobrm.logger.addHandler(logging.NullHandler())
+autobrm.logger.propagate = False
+
+dataDirectory = os.path.join(testDirectory, 'data')
+
+def readListing(name):
+    with open(os.path.join(dataDirectory, name + '.txt')) as listing:
+        return listing.readlines()
+
+class GapIngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databaseFile = os.path.join(self.directory, 'autobrm.db')
+        self.dbCon = autobrmDatabase.openConnection(self.databaseFile)
+        autobrmSchema.upgradeDatabase(self.dbCon)
+        self.gapRowBatchSize = autobrm.gapRowBatchSize
+
+    def tearDown(self):
+        autobrm.gapRowBatchSize = self.gapRowBatchSize
+        self.dbCon.close()
+        shutil.rmtree(self.directory)
+
+    #Fake Meex: the listing lines, with a call halfway through, while Meex would still be running
+    def iterMeexListing(self, listingLines, onPause):
+        for lineNumber, line in enumerate(listingLines):
+            if lineNumber == len(listingLines) / 2:
+                onPause()
+            yield line
+
+    def ingestListing(self, name, onPause = lambda: None):
+        listingLines = readListing(name)
+        return autobrm.ingestGapItems(self.dbCon, autobrm.iterSequenceCheckItems(self.iterMeexListing(listingLines, onPause), name), name)
+
+    def getGapRows(self):
+        hrdRows = self.dbCon.execute('SELECT id, chanel, last_sequence_count, last_timestamp, next_sequence_count, next_timestamp FROM hrd_packet_gap ORDER BY id;').fetchall()
+        vmuRows = self.dbCon.execute('SELECT last_sequence_count, last_timestamp, next_sequence_count, next_timestamp, vmu_record_id, hrd_packet_gap_id FROM vmu_packet_gap ORDER BY id;').fetchall()
+        return [hrdRows, vmuRows]
+
+    #Another writer (merge, dispatch, LOS filler) gets the write lock while the listing is read
+    def testWriteWhileMeexRuns(self):
+        otherCon = sqlite3.connect(self.databaseFile, timeout = 0.5, isolation_level = None)
+        def writeOtherConnection():
+            otherCur = otherCon.cursor()
+            autobrmDatabase.beginImmediate(otherCur, 'test')
+            otherCur.execute('INSERT INTO vmu_record (timestamp, phase, recordname, source) VALUES (datetime("now"), "other", "writer", null);')
+            otherCur.execute('COMMIT;')
+        try:
+            rowCount = self.ingestListing('gapsListing', writeOtherConnection)
+        finally:
+            otherCon.close()
+        self.assertTrue(rowCount > 0)
+        hrdRows, vmuRows = self.getGapRows()
+        self.assertEqual(len(hrdRows) + len(vmuRows), rowCount)
+        self.assertEqual(self.dbCon.execute('SELECT COUNT(*) FROM vmu_record WHERE phase = "other";').fetchall(), [(1,)])
+
+    #A Meex failure halfway writes nothing of the day
+    def testMeexFailureWritesNothing(self):
+        def failMeex():
+            raise OSError('meex list exited with 1')
+        self.assertRaises(OSError, self.ingestListing, 'gapsListing', failMeex)
+        self.assertEqual(self.getGapRows(), [[], []])
+
+    #Batches of a few items give the rows of a single batch, gaps containing later ones included
+    def testSmallBatches(self):
+        self.ingestListing('gapsListing')
+        self.ingestListing('mixedListing')
+        singleBatchRows = self.getGapRows()
+        self.dbCon.execute('DELETE FROM vmu_packet_gap;')
+        self.dbCon.execute('DELETE FROM hrd_packet_gap;')
+        autobrm.gapRowBatchSize = 2
+        self.ingestListing('gapsListing')
+        self.ingestListing('mixedListing')
+        hrdRows, vmuRows = self.getGapRows()
+        idOffset = hrdRows[0][0] - singleBatchRows[0][0][0]
+        self.assertEqual([(row[0] - idOffset,) + row[1:] for row in hrdRows], singleBatchRows[0])
+        self.assertEqual([row[:5] + (row[5] - idOffset if row[5] is not None else None,) for row in vmuRows], singleBatchRows[1])
+
+    #Gap items of the lrsd channel with the same HRD and VMU sequence counts, one per [last, next] pair
+    def getGapItems(self, sequenceCounts):
+        return [autobrm.gapRecords.GapItem('G', 'lrsd', '2023-01-01 00:00:%02d.000' % last, '2023-01-01 00:00:%02d.000' % next, last, next, next - last, '33', \
+        '2023-01-01 00:00:%02d.000' % last, '2023-01-01 00:00:%02d.000' % next, last, next, next - last, None, 'UPI_LRSD_33') for (last, next) in sequenceCounts]
+
+    #Ingests gap items one per batch, running a statement on another connection after the first batch
+    def ingestOnePerBatch(self, gapItems, otherStatement):
+        ingestGapItemBatch = autobrm.ingestGapItemBatch
+        def ingestBatch(dbCon, batchItems, ingestState):
+            rowCounts = ingestGapItemBatch(dbCon, batchItems, ingestState)
+            if batchItems[0] is gapItems[0]:
+                otherCon = sqlite3.connect(self.databaseFile, isolation_level = None)
+                otherCon.execute(otherStatement)
+                otherCon.close()
+            return rowCounts
+        autobrm.gapRowBatchSize = 1
+        autobrm.ingestGapItemBatch = ingestBatch
+        try:
+            autobrm.ingestGapItems(self.dbCon, gapItems)
+        finally:
+            autobrm.ingestGapItemBatch = ingestGapItemBatch
+
+    #A gap checked by the merge between two batches is not reused for the new gaps spanning it, the unchecked one is
+    def testGapCheckedBetweenBatches(self):
+        self.ingestOnePerBatch(self.getGapItems([(14, 16), (12, 18), (10, 20)]), 'UPDATE hrd_packet_gap SET is_checked = 1;')
+        hrdRows, vmuRows = self.getGapRows()
+        self.assertEqual([row[2] for row in hrdRows], [14, 12])
+        self.assertEqual([(row[0], row[5]) for row in vmuRows], [(14, hrdRows[0][0]), (12, hrdRows[1][0]), (10, hrdRows[1][0])])
+
+    #A gap added by another scan between two batches is reused
+    def testGapAddedBetweenBatches(self):
+        self.ingestOnePerBatch(self.getGapItems([(30, 32), (10, 20)]), 'INSERT INTO hrd_packet_gap (timestamp, last_sequence_count, last_timestamp, next_sequence_count, next_timestamp, is_checked, chanel) \
+        VALUES (datetime("now"), 12, "2023-01-01 00:00:12.000", 18, "2023-01-01 00:00:18.000", 0, "lrsd");')
+        hrdRows, vmuRows = self.getGapRows()
+        self.assertEqual([row[2] for row in hrdRows], [30, 12])
+        self.assertEqual([(row[0], row[5]) for row in vmuRows], [(30, hrdRows[0][0]), (10, hrdRows[1][0])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+##
+## Tests of the SSH session master lifecycle of remoteCommand.SshRunner, with a fake command runner standing for ssh.
+##  python -m unittest discover -s tests
+##
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import remoteCommand
+
+#Stands for commands.getstatusoutput running ssh: keeps the session master state and answers the control commands (-O check/exit, -f -N) and the remote commands.
+class FakeSsh(object):
+
+    def __init__(self):
+        self.isMasterUp = False
+        self.isMasterStartFailing = False
+        self.commandResults = []
+        self.calls = []
+
+    #Kind of each call, in order: check, exit, start or command
+    def getCallKinds(self):
+        return [kind for (kind, commandLine) in self.calls]
+
+    def __call__(self, commandLine):
+        if ' -O check ' in commandLine:
+            self.calls.append(['check', commandLine])
+            return [0 if self.isMasterUp else remoteCommand.sshErrorExitCode << 8, '']
+        if ' -O exit ' in commandLine:
+            self.calls.append(['exit', commandLine])
+            wasMasterUp = self.isMasterUp
+            self.isMasterUp = False
+            return [0 if wasMasterUp else remoteCommand.sshErrorExitCode << 8, '']
+        if ' -f -N ' in commandLine:
+            self.calls.append(['start', commandLine])
+            if self.isMasterStartFailing:
+                return [remoteCommand.sshErrorExitCode << 8, '']
+            self.isMasterUp = True
+            return [0, '']
+        self.calls.append(['command', commandLine])
+        return self.commandResults.pop(0) if self.commandResults else [0, 'done']
+
+class SshRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ssh = FakeSsh()
+        self.runner = remoteCommand.SshRunner('hrdp', 'sdmkernel', self.ssh)
+
+    #Lets the health check interval go by
+    def expireHealthCheck(self):
+        self.runner.checkTime -= remoteCommand.healthCheckInterval + 1
+
+    def testFirstCommandStartsMaster(self):
+        self.assertEqual(self.runner.run('pkill -15 -f "bitstreamClient.jar"'), [0, 'done'])
+        self.assertEqual(self.ssh.getCallKinds(), ['check', 'exit', 'start', 'check', 'command'])
+        startCommand = self.ssh.calls[2][1]
+        self.assertTrue('-o ControlMaster=yes' in startCommand and startCommand.endswith('< /dev/null > /dev/null 2>&1'))
+        command = self.ssh.calls[4][1]
+        self.assertTrue('-o ControlMaster=no' in command)
+        self.assertTrue(command.endswith('hrdp@sdmkernel \'pkill -15 -f "bitstreamClient.jar"\''))
+
+    def testHealthyMasterCheckedEveryInterval(self):
+        self.runner.run('true')
+        del self.ssh.calls[:]
+        self.runner.run('true')
+        self.assertEqual(self.ssh.getCallKinds(), ['command'])
+        self.expireHealthCheck()
+        self.runner.run('true')
+        self.assertEqual(self.ssh.getCallKinds(), ['command', 'check', 'command'])
+
+    #The master went away (ControlPersist expiry, host reboot): the failed check restarts it before the command
+    def testFailedCheckReconnects(self):
+        self.runner.run('true')
+        self.ssh.isMasterUp = False
+        self.expireHealthCheck()
+        del self.ssh.calls[:]
+        self.assertEqual(self.runner.run('true'), [0, 'done'])
+        self.assertEqual(self.ssh.getCallKinds(), ['check', 'exit', 'start', 'check', 'command'])
+        self.assertTrue(self.runner.isHealthy)
+
+    #A command timing out on the ssh side (ConnectTimeout, ServerAliveInterval) exits with 255: not retried, the master is checked again on the next command without waiting for the interval
+    def testCommandTimeout(self):
+        self.runner.run('true')
+        self.ssh.commandResults = [[remoteCommand.sshErrorExitCode << 8, 'Timeout, server sdmkernel not responding.']]
+        del self.ssh.calls[:]
+        self.assertEqual(self.runner.run('bitstreamClient'), [remoteCommand.sshErrorExitCode << 8, 'Timeout, server sdmkernel not responding.'])
+        self.assertEqual(self.ssh.getCallKinds(), ['command'])
+        self.assertFalse(self.runner.isHealthy)
+        self.ssh.isMasterUp = False
+        del self.ssh.calls[:]
+        self.assertEqual(self.runner.run('true'), [0, 'done'])
+        self.assertEqual(self.ssh.getCallKinds(), ['check', 'exit', 'start', 'check', 'command'])
+
+    #A remote command failing on its own leaves the master alone
+    def testRemoteCommandFailure(self):
+        self.runner.run('true')
+        self.ssh.commandResults = [[1 << 8, 'no process found']]
+        self.assertEqual(self.runner.run('pkill -9 -f "-startTime x"'), [1 << 8, 'no process found'])
+        self.assertTrue(self.runner.isHealthy)
+
+    #Without a master the command still runs, on its own connection, and the next command tries to start the master again
+    def testMasterStartFailure(self):
+        self.ssh.isMasterStartFailing = True
+        self.assertEqual(self.runner.run('true'), [0, 'done'])
+        self.assertEqual(self.ssh.getCallKinds(), ['check', 'exit', 'start', 'command'])
+        self.assertFalse(self.runner.isHealthy)
+        self.ssh.isMasterStartFailing = False
+        del self.ssh.calls[:]
+        self.runner.run('true')
+        self.assertEqual(self.ssh.getCallKinds(), ['check', 'exit', 'start', 'check', 'command'])
+        self.assertTrue(self.runner.isHealthy)
+
+    def testClose(self):
+        self.runner.run('true')
+        self.runner.close()
+        self.assertFalse(self.ssh.isMasterUp)
+        self.assertFalse(self.runner.isHealthy)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+##
+## Tests of the sqchk.awk ports (sqchk, sqchkVectorized) against recorded Meex listings and the sqchk.awk output captured for them.
+##  Fixtures : tests/data/<name>.txt listing, tests/data/<name>.awk.out sqchk.awk output (gawk -f sqchk.awk <name>.txt).
+##  python -m unittest discover -s tests
+##
+
+import os
+import sys
+import StringIO
+import unittest
+import subprocess
+from distutils.spawn import find_executable
+
+testDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDirectory))
+import sqchk
+try:
+    import sqchkVectorized
+except ImportError:
+    sqchkVectorized = None
+
+dataDirectory = os.path.join(testDirectory, 'data')
+awkScript = os.path.join(os.path.dirname(testDirectory), 'sqchk.awk')
+#gaps, corrupt runs closed and open at the end, 'bad' status forms | IMG/SCC records, origins not checked, non numeric counts, short lines
+listingNames = ['gapsListing', 'badRunsListing', 'mixedListing']
+
+def readListing(name):
+    with open(os.path.join(dataDirectory, name + '.txt')) as listing:
+        return listing.readlines()
+
+def readAwkOutput(name):
+    with open(os.path.join(dataDirectory, name + '.awk.out')) as awkOutput:
+        return awkOutput.read()
+
+#Output rows the scan pipeline keeps after sqchk.awk: grep -vE "IMG|SCC"
+def grepRows(rows):
+    return [row for row in rows if not sqchk.excludedPattern.search(row)]
+
+class SequenceCheckTestMixin(object):
+    checkModule = None
+
+    def printAwkOutput(self, name):
+        output = StringIO.StringIO()
+        self.checkModule.printAwkOutput(readListing(name), output)
+        return output.getvalue()
+
+    def testAwkOutput(self):
+        for name in listingNames:
+            self.assertEqual(sqchk.splitAwkOutput(self.printAwkOutput(name)), sqchk.splitAwkOutput(readAwkOutput(name)), name)
+
+    #Records of checkLines: the awk output rows the scan pipeline keeps, gaps in listing order
+    def testCheckLines(self):
+        for name in listingNames:
+            gapRows, badRows, summary = sqchk.splitAwkOutput(readAwkOutput(name))
+            rows = [sqchk.formatRecord(record) for record in self.checkModule.checkLines(readListing(name))]
+            self.assertEqual([row for row in rows if row.startswith('G |')], grepRows(gapRows), name)
+            self.assertEqual(sorted([row for row in rows if row.startswith('B |')]), grepRows(badRows), name)
+
+    def testExcludedRecordsKept(self):
+        rows = [sqchk.formatRecord(record) for record in self.checkModule.checkLines(readListing('mixedListing'), keepExcluded = True)]
+        self.assertEqual(len([row for row in rows if 'SCC_LRSD_A' in row or 'IMG_VIC1_A' in row]), 2)
+
+class SqchkTest(SequenceCheckTestMixin, unittest.TestCase):
+    checkModule = sqchk
+
+@unittest.skipIf(sqchkVectorized is None, 'NumPy not installed')
+class SqchkVectorizedTest(SequenceCheckTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.checkModule = sqchkVectorized
+        self.blockLines = sqchkVectorized.blockLines
+
+    def tearDown(self):
+        sqchkVectorized.blockLines = self.blockLines
+
+    #Blocks ending within corrupt runs and between a packet and its gap
+    def testSmallBlocks(self):
+        for blockLines in [1, 2, 3, 7]:
+            sqchkVectorized.blockLines = blockLines
+            for name in listingNames:
+                self.assertEqual(sqchk.splitAwkOutput(self.printAwkOutput(name)), sqchk.splitAwkOutput(readAwkOutput(name)), '%s in blocks of %s' % (name, blockLines))
+
+    #Records (excluded ones included, field types too: the scan writes them to the database) and summary of sqchk, in blocks of a few lines
+    def testSameAsSqchk(self):
+        sqchkVectorized.blockLines = 7
+        for name in listingNames:
+            outputs = []
+            for checkModule in [sqchk, sqchkVectorized]:
+                checker = checkModule.SequenceChecker()
+                records = list(checkModule.checkLines(readListing(name), checker, keepExcluded = True))
+                outputs.append([records, [[type(value) for value in record] for record in records], checker.summary()])
+            self.assertEqual(outputs[1], outputs[0], name)
+
+#The recorded outputs are the ones of sqchk.awk itself, where gawk is installed
+@unittest.skipIf(find_executable('gawk') is None, 'gawk not installed')
+class AwkScriptTest(unittest.TestCase):
+
+    def testRecordedOutput(self):
+        for name in listingNames:
+            awkOutput = subprocess.check_output(['gawk', '-f', awkScript, os.path.join(dataDirectory, name + '.txt')])
+            self.assertEqual(sqchk.splitAwkOutput(awkOutput), sqchk.splitAwkOutput(readAwkOutput(name)), name)
+
+if __name__ == '__main__':
+    unittest.main()
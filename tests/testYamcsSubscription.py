@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+##
+## Tests of the Yamcs WebSocket parameter subscription against an in-process fake Yamcs WebSocket server.
+##  python -m unittest discover -s tests
+##
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import yamcsSubscription
+
+#Fake Yamcs server: WebSocket handshake, parameter subscription, parameter data push and ping/pong, one client at a time.
+class FakeYamcsServer(threading.Thread):
+
+    def __init__(self, values, answerPings = True):
+        threading.Thread.__init__(self, name = 'fakeYamcsServer')
+        self.daemon = True
+        self.values = values
+        self.answerPings = answerPings
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.connection = None
+        self.connectionCount = 0
+        self.handshakeHeaders = []
+        self.requests = []
+        self.pingCount = 0
+        self.isStopped = False
+
+    def run(self):
+        while not self.isStopped:
+            try:
+                self.connection, address = self.listener.accept()
+            except socket.error:
+                return
+            self.connectionCount += 1
+            try:
+                self.serve(self.connection)
+            except (socket.error, EOFError):
+                pass
+            finally:
+                self.connection.close()
+
+    def stop(self):
+        self.isStopped = True
+        self.disconnect()
+        self.listener.close()
+
+    #Drops the current client connection without a close frame
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def readExactly(self, connection, length):
+        data = ''
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    #Returns [opcode, payload] of the next client frame, unmasked
+    def readFrame(self, connection):
+        firstByte, secondByte = [ord(character) for character in self.readExactly(connection, 2)]
+        length = secondByte & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.readExactly(connection, 2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.readExactly(connection, 8))[0]
+        mask = self.readExactly(connection, 4) if secondByte & 0x80 else '\0\0\0\0'
+        payload = self.readExactly(connection, length)
+        return [firstByte & 0x0f, ''.join([chr(ord(character) ^ ord(mask[index % 4])) for (index, character) in enumerate(payload)])]
+
+    #Sends an unmasked server frame
+    def sendFrame(self, connection, opcode, payload):
+        header = chr(0x80 | opcode)
+        if len(payload) < 126:
+            header += chr(len(payload))
+        else:
+            header += chr(126) + struct.pack('!H', len(payload))
+        connection.sendall(header + payload)
+
+    def serve(self, connection):
+        request = ''
+        while '\r\n\r\n' not in request:
+            chunk = connection.recv(4096)
+            if not chunk:
+                return
+            request += chunk
+        headers = dict([(line.split(':', 1)[0].strip().lower(), line.split(':', 1)[1].strip()) for line in request.split('\r\n')[1:] if ':' in line])
+        self.handshakeHeaders.append(headers)
+        accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'] + yamcsSubscription.webSocketGuid).digest())
+        connection.sendall('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n' % accept)
+        while not self.isStopped:
+            opcode, payload = self.readFrame(connection)
+            if opcode == 0x8:
+                return
+            elif opcode == 0x9:
+                self.pingCount += 1
+                if self.answerPings:
+                    self.sendFrame(connection, 0xA, payload)
+            elif opcode == 0x1:
+                message = json.loads(payload)
+                self.requests.append(message)
+                if message[3].get('parameter') == 'subscribe':
+                    parameters = [{'id': {'name': parameterID['name']}, 'engValue': self.values[parameterID['name']]} for parameterID in message[3]['data']['id']]
+                    self.sendFrame(connection, 0x1, json.dumps([1, 4, message[2], {'dt': 'PARAMETER', 'data': {'parameter': parameters}}]))
+
+class ParameterSubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.subscription = None
+        self.polls = []
+        self.updates = []
+
+    def tearDown(self):
+        if self.subscription is not None:
+            self.subscription.stop()
+            self.subscription.join(5)
+        if self.server is not None:
+            self.server.stop()
+
+    def startSubscription(self, values, answerPings = True, pollInterval = 10):
+        self.server = FakeYamcsServer(values, answerPings)
+        self.server.start()
+        logger = logging.getLogger('testYamcsSubscription')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.subscription = yamcsSubscription.ParameterSubscription('127.0.0.1', self.server.port, 'simulator', [['/YSS', name] for name in sorted(values)], \
+        'user', 'secret', self.poll, logger, pollInterval = pollInterval)
+        self.subscription.addListener(lambda name, value: self.updates.append([name, value['engValue']]))
+        self.subscription.start()
+
+    def poll(self, parameterIDs):
+        self.polls.append(parameterIDs)
+        return dict([(name, {'engValue': 'polled'}) for (namespace, name) in parameterIDs])
+
+    def waitFor(self, condition, timeout = 5):
+        endTime = time.time() + timeout
+        while time.time() < endTime:
+            if condition():
+                return True
+            time.sleep(0.05)
+        return condition()
+
+    def testSubscribeAndPush(self):
+        self.startSubscription({'AOS': 'TRUE', 'KU_LINK': 'UP'})
+        self.assertTrue(self.waitFor(lambda: self.subscription.getValue('KU_LINK') is not None))
+        self.assertTrue(self.subscription.isConnected)
+        self.assertEqual(self.server.handshakeHeaders[0]['authorization'], 'Basic %s' % base64.b64encode('user:secret'))
+        self.assertEqual(self.server.handshakeHeaders[0]['sec-websocket-version'], '13')
+        subscribe = self.server.requests[0]
+        self.assertEqual(subscribe[:2], [1, 1])
+        self.assertEqual(subscribe[3]['parameter'], 'subscribe')
+        self.assertEqual(subscribe[3]['data']['id'], [{'namespace': '/YSS', 'name': 'AOS'}, {'namespace': '/YSS', 'name': 'KU_LINK'}])
+        self.assertEqual(self.subscription.getValue('AOS')['engValue'], 'TRUE')
+        self.assertEqual(sorted(self.updates), [['AOS', 'TRUE'], ['KU_LINK', 'UP']])
+        self.assertEqual(self.polls, [])
+
+    #A quiet link answering the pings stays connected: pings start after 2 poll intervals, the link is dropped after 6 without any answer
+    def testPongKeepsQuietLinkAlive(self):
+        self.startSubscription({'AOS': 'TRUE'}, pollInterval = 0.3)
+        self.assertTrue(self.waitFor(lambda: self.subscription.getValue('AOS') is not None))
+        time.sleep(4)
+        self.assertTrue(self.server.pingCount > 0)
+        self.assertTrue(self.subscription.isConnected)
+        self.assertEqual(self.server.connectionCount, 1)
+        self.assertEqual(self.polls, [])
+
+    def testUnansweredPingsDropLink(self):
+        self.startSubscription({'AOS': 'TRUE'}, answerPings = False, pollInterval = 0.3)
+        self.assertTrue(self.waitFor(lambda: self.server.pingCount > 0))
+        self.assertTrue(self.waitFor(lambda: len(self.polls) > 0))
+
+    #Polls while disconnected, then reconnects and subscribes again
+    def testDisconnectFallsBackToPolling(self):
+        self.startSubscription({'AOS': 'TRUE'}, pollInterval = 0.2)
+        self.assertTrue(self.waitFor(lambda: self.subscription.getValue('AOS') is not None))
+        self.server.disconnect()
+        self.assertTrue(self.waitFor(lambda: len(self.polls) > 0))
+        self.assertEqual(self.polls[0], [['/YSS', 'AOS']])
+        self.assertTrue(['AOS', 'polled'] in self.updates)
+        self.assertTrue(self.waitFor(lambda: self.server.connectionCount == 2 and len(self.server.requests) == 2))
+        self.assertTrue(self.waitFor(lambda: self.subscription.isConnected))
+        self.assertEqual(self.subscription.getValue('AOS')['engValue'], 'TRUE')
+
+if __name__ == '__main__':
+    unittest.main()
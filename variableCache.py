@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+##
+## Shared cache of the AutoBRM database variable table, used by autobrm and autoLosSensingReplayFiller.
+##  Source : AutoBRM database variable table.
+##  Destination : Configuration values, without a database query per lookup.
+##
+## The table is loaded with one query. It is reloaded when its change counter (variable_change table) moves,
+## checked every few seconds, and in any case after a time to live.
+##
+
+import threading
+import sqlite3
+import time
+import autobrmDatabase
+
+#Seconds after which the whole table is reloaded, changed or not
+defaultTimeToLive = 60
+#Seconds between two checks of the change counter
+defaultCheckInterval = 2
+
+#Thread safe cache of one database variable table.
+class VariableCache(object):
+
+    def __init__(self, databaseFile, timeToLive = defaultTimeToLive, checkInterval = defaultCheckInterval):
+        self.databaseFile = databaseFile
+        self.timeToLive = timeToLive
+        self.checkInterval = checkInterval
+        self.lock = threading.Lock()
+        self.dbCon = None
+        self.values = None
+        self.loadTime = 0
+        self.checkTime = 0
+        self.changeCounter = None
+
+    #Returns the cache own connection, shared by the threads under the lock
+    def getConnection(self):
+        if self.dbCon is None:
+            self.dbCon = autobrmDatabase.openConnection(self.databaseFile, checkSameThread = False)
+        return self.dbCon
+
+    #Returns the variable table change counter, bumped by triggers on every edit (including edits made by hand or by the web site). See the autobrmSchema migrations.
+    def readChangeCounter(self):
+        try:
+            queryResult = self.getConnection().execute('SELECT counter FROM variable_change WHERE id = 1;').fetchall()
+        except sqlite3.OperationalError:
+            #Schema not upgraded yet, only the time to live applies
+            return None
+        return queryResult[0][0] if len(queryResult) > 0 else None
+
+    #Loads the whole variable table. Names are matched ignoring case, the first entry wins as with the former 'name like' queries.
+    def reload(self):
+        dbCon = self.getConnection()
+        self.changeCounter = self.readChangeCounter()
+        values = {}
+        for name, value in dbCon.execute('SELECT name, value FROM variable ORDER BY id;').fetchall():
+            if name is None or name.lower() in values:
+                continue
+            varValue = str(value)
+            if str.isdigit(varValue): varValue = int(varValue)
+            values[name.lower()] = varValue
+        self.values = values
+        self.loadTime = self.checkTime = time.time()
+
+    #Returns a variable value from its name, None if it doesn't exist. Digit only values are returned as integers.
+    def getValue(self, varName):
+        with self.lock:
+            try:
+                now = time.time()
+                if self.values is None or now - self.loadTime >= self.timeToLive:
+                    self.reload()
+                elif now - self.checkTime >= self.checkInterval:
+                    self.checkTime = now
+                    if self.readChangeCounter() != self.changeCounter:
+                        self.reload()
+            except sqlite3.Error:
+                #Start over with a new connection next time, keep serving the last known values meanwhile
+                self.close()
+                if self.values is None:
+                    raise
+            return self.values.get(varName.lower())
+
+    #Forces a reload on the next lookup
+    def invalidate(self):
+        with self.lock:
+            self.values = None
+
+    def close(self):
+        if self.dbCon is not None:
+            try:
+                self.dbCon.close()
+            except sqlite3.Error:
+                pass
+            self.dbCon = None
+
+variableCaches = {}
+variableCachesLock = threading.Lock()
+
+#Returns the variable cache of a database file, shared by every user of the same file in the process.
+def getVariableCache(databaseFile):
+    with variableCachesLock:
+        if databaseFile not in variableCaches:
+            variableCaches[databaseFile] = VariableCache(databaseFile)
+        return variableCaches[databaseFile]
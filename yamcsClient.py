@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+##
+## Yamcs REST client for AutoBRM and autoLosSensingReplayFiller.
+##  Source : Yamcs server REST API (http://server:port/api), realtime processor parameters.
+##  Destination : Yamcs ParameterValue JSON objects (engValue, generationTimeUTC, acquisitionTimeUTC, ...).
+##
+## Requests go over persistent HTTP/1.1 keep-alive connections, kept in a small pool per server, with a timeout on every
+## socket operation. A failed request (connection error, timeout, server error) is retried on a new connection with a
+## doubling delay. Several parameters are read in one round trip with the batch get (mget) resource.
+## The latency of every call is counted in a histogram per call name (see getLatencyHistograms).
+##
+
+import time
+import json
+import socket
+import base64
+import httplib
+import threading
+
+#Seconds allowed for the connection and for each socket read or write
+requestTimeoutSeconds = 5
+#Retries after the first attempt, and delay before the first retry (doubled on each one)
+requestRetries = 2
+retryDelaySeconds = 0.5
+#Idle connections kept per server
+connectionPoolSize = 4
+#Upper bounds (seconds) of the latency histogram buckets, the last bucket counts everything slower
+latencyBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+#Raised when a request fails for good: Yamcs error response, or every attempt failed.
+class YamcsError(Exception):
+    pass
+
+#Latency histogram of one call name: cumulative counts of calls faster than each bucket bound, count and sum as Prometheus does.
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.bucketCounts = [0] * (len(latencyBuckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errorCount = 0
+
+    def observe(self, seconds, isError = False):
+        for index, bound in enumerate(latencyBuckets):
+            if seconds <= bound:
+                self.bucketCounts[index] += 1
+                break
+        else:
+            self.bucketCounts[-1] += 1
+        self.count += 1
+        self.sum += seconds
+        if isError:
+            self.errorCount += 1
+
+    #Returns {'buckets': [[bound, cumulative count], ...], 'count', 'sum', 'errors'}, the last bound being '+Inf'
+    def getSnapshot(self):
+        cumulativeCount = 0
+        buckets = []
+        for bound, bucketCount in zip(latencyBuckets + ['+Inf'], self.bucketCounts):
+            cumulativeCount += bucketCount
+            buckets.append([bound, cumulativeCount])
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum, 'errors': self.errorCount}
+
+#REST client of one Yamcs instance. Thread safe: each request takes its own connection from the pool.
+class YamcsClient(object):
+
+    def __init__(self, server, port, instance, username, password, processor = 'realtime'):
+        self.server = server
+        self.port = port
+        self.instance = instance
+        self.processor = processor
+        self.headers = {'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (username, password)), \
+        'Accept': 'application/json', 'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        self.lock = threading.Lock()
+        self.idleConnections = []
+        self.histograms = {}
+
+    def getConnection(self):
+        with self.lock:
+            if self.idleConnections:
+                return self.idleConnections.pop()
+        return httplib.HTTPConnection(self.server, self.port, timeout = requestTimeoutSeconds)
+
+    #Puts a connection back in the pool, or closes it if the pool is full
+    def releaseConnection(self, connection):
+        with self.lock:
+            if len(self.idleConnections) < connectionPoolSize:
+                self.idleConnections.append(connection)
+                return
+        connection.close()
+
+    def observeLatency(self, callName, seconds, isError):
+        with self.lock:
+            if callName not in self.histograms:
+                self.histograms[callName] = LatencyHistogram()
+            self.histograms[callName].observe(seconds, isError)
+
+    #Sends one request and returns the decoded JSON response. Connection failures, timeouts and 5xx responses are retried.
+    def request(self, callName, method, path, body = None):
+        startTime = time.time()
+        retryDelay = retryDelaySeconds
+        attempt = 0
+        try:
+            while True:
+                connection = self.getConnection()
+                try:
+                    connection.request(method, path, body, self.headers)
+                    response = connection.getresponse()
+                    #The response must be read entirely for the connection to be reused
+                    responseBody = response.read()
+                except (socket.error, httplib.HTTPException), errorString:
+                    #Includes timeouts and keep-alive connections closed by the server
+                    connection.close()
+                    failure = YamcsError('%s %s: %s' % (method, path, errorString or errorString.__class__.__name__))
+                else:
+                    if response.will_close:
+                        connection.close()
+                    else:
+                        self.releaseConnection(connection)
+                    if response.status < 300:
+                        try:
+                            result = json.loads(responseBody)
+                        except ValueError:
+                            raise YamcsError('%s %s: unreadable response %s' % (method, path, responseBody[:200]))
+                        self.observeLatency(callName, time.time() - startTime, False)
+                        return result
+                    failure = YamcsError('%s %s: %s %s %s' % (method, path, response.status, response.reason, responseBody[:200]))
+                    if response.status < 500:
+                        #Request error (unknown parameter, authentication), retrying won't help
+                        raise failure
+                if attempt >= requestRetries:
+                    raise failure
+                attempt += 1
+                time.sleep(retryDelay)
+                retryDelay *= 2
+        except YamcsError:
+            self.observeLatency(callName, time.time() - startTime, True)
+            raise
+
+    #Returns the current value (ParameterValue) of one parameter
+    def getParameterValue(self, namespace, name):
+        return self.request('getParameterValue', 'GET', '/api/processors/%s/%s/parameters/%s/%s' % (self.instance, self.processor, namespace, name))
+
+    #Returns the current values of several parameters ([[namespace, name], ...]) in one round trip, as a {name: ParameterValue} dictionary.
+    #Parameters without a value yet are missing from the dictionary.
+    def getParameterValues(self, parameterIDs):
+        body = json.dumps({'id': [{'namespace': namespace, 'name': name} for (namespace, name) in parameterIDs], 'fromCache': True})
+        result = self.request('getParameterValues', 'POST', '/api/processors/%s/%s/parameters/mget' % (self.instance, self.processor), body)
+        return dict([(value['id']['name'], value) for value in result.get('value', [])])
+
+    #Returns {call name: histogram snapshot} (see LatencyHistogram.getSnapshot)
+    def getLatencyHistograms(self):
+        with self.lock:
+            return dict([(callName, histogram.getSnapshot()) for (callName, histogram) in self.histograms.items()])
+
+    #Returns a one line summary of the latencies, for the logs
+    def getLatencySummary(self):
+        summary = []
+        for callName, snapshot in sorted(self.getLatencyHistograms().items()):
+            if snapshot['count'] > 0:
+                summary.append('%s: %s calls, %s errors, mean %.3f s' % (callName, snapshot['count'], snapshot['errors'], snapshot['sum'] / snapshot['count']))
+        return '; '.join(summary)
+
+    #Closes the idle connections
+    def close(self):
+        with self.lock:
+            connections, self.idleConnections = self.idleConnections, []
+        for connection in connections:
+            connection.close()
+
+yamcsClients = {}
+yamcsClientsLock = threading.Lock()
+
+#Returns the client of a Yamcs server and instance, shared by every caller in the process.
+def getYamcsClient(server, port, instance, username, password):
+    with yamcsClientsLock:
+        if (server, port, instance) not in yamcsClients:
+            yamcsClients[(server, port, instance)] = YamcsClient(server, port, instance, username, password)
+        return yamcsClients[(server, port, instance)]
+
+#Closes the connections of every client. Called at exit.
+def closeYamcsClients():
+    with yamcsClientsLock:
+        for client in yamcsClients.values():
+            client.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+##
+## Yamcs parameter subscription over the Yamcs WebSocket API, with REST polling fallback.
+##  Source : Yamcs server WebSocket (ws://server:port/_websocket/instance), parameter subscription.
+##  Destination : Latest value of each subscribed parameter, and listeners called on every update.
+##
+## Values are the Yamcs ParameterValue JSON objects (engValue, generationTimeUTC, acquisitionTimeUTC, ...), the same
+## objects the REST parameter resource returns. While the WebSocket is down, the parameters are polled with the given
+## poll function (all of them in one call, see yamcsClient.YamcsClient.getParameterValues) and the connection is retried
+## with an increasing delay.
+##
+
+import os
+import json
+import time
+import socket
+import base64
+import struct
+import hashlib
+import threading
+
+webSocketGuid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+#Raised on any WebSocket protocol or connection failure.
+class WebSocketError(Exception):
+    pass
+
+#Minimal RFC 6455 WebSocket client: text messages, ping/pong and close.
+class WebSocket(object):
+
+    def __init__(self, host, port, path, headers = None, timeout = 10):
+        self.buffer = ''
+        #Time of the last pong received, 0 if none
+        self.lastPongTime = 0
+        self.sock = socket.create_connection((host, port), timeout)
+        try:
+            self.handshake(host, port, path, headers or {})
+        except Exception:
+            self.sock.close()
+            raise
+
+    def handshake(self, host, port, path, headers):
+        key = base64.b64encode(os.urandom(16))
+        request = ['GET %s HTTP/1.1' % path, 'Host: %s:%s' % (host, port), 'Upgrade: websocket', 'Connection: Upgrade', \
+        'Sec-WebSocket-Key: %s' % key, 'Sec-WebSocket-Version: 13'] + ['%s: %s' % (name, value) for (name, value) in headers.items()]
+        self.sock.sendall('\r\n'.join(request) + '\r\n\r\n')
+        while '\r\n\r\n' not in self.buffer:
+            self.readSocket()
+        response, self.buffer = self.buffer.split('\r\n\r\n', 1)
+        responseLines = response.split('\r\n')
+        if len(responseLines[0].split()) < 2 or responseLines[0].split()[1] != '101':
+            raise WebSocketError('WebSocket handshake refused: %s' % responseLines[0])
+        responseHeaders = dict([(line.split(':', 1)[0].strip().lower(), line.split(':', 1)[1].strip()) for line in responseLines[1:] if ':' in line])
+        if responseHeaders.get('sec-websocket-accept') != base64.b64encode(hashlib.sha1(key + webSocketGuid).digest()):
+            raise WebSocketError('WebSocket handshake failed: wrong accept key')
+
+    def readSocket(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise WebSocketError('WebSocket connection closed by the server')
+        self.buffer += data
+
+    #Sends one frame. Client frames are always masked.
+    def sendFrame(self, opcode, payload):
+        header = chr(0x80 | opcode)
+        if len(payload) < 126:
+            header += chr(0x80 | len(payload))
+        elif len(payload) < 65536:
+            header += chr(0x80 | 126) + struct.pack('!H', len(payload))
+        else:
+            header += chr(0x80 | 127) + struct.pack('!Q', len(payload))
+        mask = os.urandom(4)
+        maskedPayload = ''.join([chr(ord(character) ^ ord(mask[position % 4])) for (position, character) in enumerate(payload)])
+        self.sock.sendall(header + mask + maskedPayload)
+
+    def send(self, message):
+        self.sendFrame(0x1, message)
+
+    def ping(self):
+        self.sendFrame(0x9, '')
+
+    #Returns [opcode, fin, payload] of the next complete frame in the buffer, None if it isn't complete yet
+    def parseFrame(self):
+        if len(self.buffer) < 2:
+            return None
+        firstByte, secondByte = ord(self.buffer[0]), ord(self.buffer[1])
+        length = secondByte & 0x7f
+        position = 2
+        if length == 126:
+            if len(self.buffer) < 4: return None
+            length = struct.unpack('!H', self.buffer[2:4])[0]
+            position = 4
+        elif length == 127:
+            if len(self.buffer) < 10: return None
+            length = struct.unpack('!Q', self.buffer[2:10])[0]
+            position = 10
+        mask = None
+        if secondByte & 0x80:
+            mask = self.buffer[position:position + 4]
+            position += 4
+        if len(self.buffer) < position + length:
+            return None
+        payload = self.buffer[position:position + length]
+        self.buffer = self.buffer[position + length:]
+        if mask is not None:
+            payload = ''.join([chr(ord(character) ^ ord(mask[index % 4])) for (index, character) in enumerate(payload)])
+        return [firstByte & 0x0f, bool(firstByte & 0x80), payload]
+
+    #Returns the next text message, or None if none came within the socket timeout. Answers pings, notes the pong time (lastPongTime), raises WebSocketError on close.
+    def receive(self):
+        fragments = []
+        while True:
+            frame = self.parseFrame()
+            if frame is None:
+                try:
+                    self.readSocket()
+                except socket.timeout:
+                    if len(fragments) == 0 and len(self.buffer) == 0:
+                        return None
+                    continue
+                continue
+            opcode, fin, payload = frame
+            if opcode == 0x8:
+                raise WebSocketError('WebSocket closed by the server')
+            elif opcode == 0x9:
+                self.sendFrame(0xA, payload)
+            elif opcode == 0xA:
+                self.lastPongTime = time.time()
+            elif opcode in (0x0, 0x1, 0x2):
+                fragments.append(payload)
+                if fin:
+                    return ''.join(fragments)
+
+    def close(self):
+        try:
+            self.sendFrame(0x8, '')
+        except Exception:
+            pass
+        self.sock.close()
+
+#Parameter subscription of one Yamcs instance, kept up on its own thread.
+class ParameterSubscription(threading.Thread):
+
+    def __init__(self, server, port, instance, parameterIDs, username, password, pollFunction, logger, pollInterval = 10):
+        threading.Thread.__init__(self, name = 'yamcsSubscription-%s' % instance)
+        self.daemon = True
+        self.server = server
+        self.port = port
+        self.instance = instance
+        #[namespace, name] of each parameter, as in the REST resource path
+        self.parameterIDs = parameterIDs
+        self.headers = {'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (username, password))}
+        self.pollFunction = pollFunction
+        self.logger = logger
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.values = {}
+        self.listeners = []
+        self.isConnected = False
+        self.wasConnected = False
+        self.isStopped = False
+        self.requestSequence = 0
+
+    #Registers a function called as listener(parameterName, value) on every update
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    #Returns the latest value of a parameter (ParameterValue dictionary), None if none was received yet
+    def getValue(self, parameterName):
+        with self.lock:
+            return self.values.get(parameterName)
+
+    def updateValue(self, parameterName, value):
+        with self.lock:
+            self.values[parameterName] = value
+        for listener in self.listeners:
+            try:
+                listener(parameterName, value)
+            except Exception, errorString:
+                self.logger.error('Yamcs parameter listener: %s' % errorString)
+
+    def stop(self):
+        self.isStopped = True
+
+    #Sends a Yamcs WebSocket request: [protocol version, message type (1: request), sequence, {resource: {operation, data}}]
+    def sendRequest(self, webSocket, resource, operation, data):
+        self.requestSequence += 1
+        webSocket.send(json.dumps([1, 1, self.requestSequence, {resource: operation, 'data': data}]))
+
+    #Handles one Yamcs WebSocket message: parameter data (message type 4) updates the values, exceptions (type 3) are logged
+    def handleMessage(self, message):
+        try:
+            content = json.loads(message)
+        except ValueError:
+            self.logger.error('Yamcs WebSocket: unreadable message %s' % message[:200])
+            return
+        if len(content) >= 4 and content[1] == 4 and content[3].get('dt') == 'PARAMETER':
+            for value in content[3].get('data', {}).get('parameter', []):
+                self.updateValue(value.get('id', {}).get('name'), value)
+        elif len(content) >= 4 and content[1] == 3:
+            self.logger.error('Yamcs WebSocket exception: %s' % content[3])
+
+    #Connects, subscribes and reads the updates until the connection is lost
+    def listen(self):
+        webSocket = WebSocket(self.server, self.port, '/_websocket/%s' % self.instance, self.headers, timeout = 10)
+        try:
+            webSocket.sock.settimeout(1)
+            self.sendRequest(webSocket, 'parameter', 'subscribe', {'id': [{'namespace': namespace, 'name': name} for (namespace, name) in self.parameterIDs], \
+            'sendFromCache': True, 'abortOnInvalid': False, 'updateOnExpiration': True})
+            self.isConnected = self.wasConnected = True
+            self.logger.info('Yamcs WebSocket subscription to %s on %s: connected' % (', '.join([name for (namespace, name) in self.parameterIDs]), self.server))
+            lastMessageTime = time.time()
+            while not self.isStopped:
+                message = webSocket.receive()
+                #A pong proves the link alive as well as a message
+                lastMessageTime = max(lastMessageTime, webSocket.lastPongTime)
+                if message is not None:
+                    lastMessageTime = time.time()
+                    self.handleMessage(message)
+                elif time.time() - lastMessageTime > 2 * self.pollInterval:
+                    #Quiet link: the ping answer proves it alive, nothing at all means it is dead
+                    if time.time() - lastMessageTime > 6 * self.pollInterval:
+                        raise WebSocketError('no message for %s seconds' % int(time.time() - lastMessageTime))
+                    webSocket.ping()
+        finally:
+            self.isConnected = False
+            webSocket.close()
+
+    #Reads every parameter once with the poll function: pollFunction([[namespace, name], ...]) returns {name: value}
+    def poll(self):
+        try:
+            values = self.pollFunction(self.parameterIDs)
+        except Exception, errorString:
+            self.logger.error('Yamcs poll of %s: %s' % (', '.join([name for (namespace, name) in self.parameterIDs]), errorString))
+            return
+        for name, value in values.items():
+            self.updateValue(name, value)
+
+    def run(self):
+        retryDelay = 1
+        while not self.isStopped:
+            self.wasConnected = False
+            try:
+                self.listen()
+            except Exception, errorString:
+                #Start over with a short delay after a connection which worked
+                if self.wasConnected: retryDelay = 1
+                self.logger.error('Yamcs WebSocket subscription on %s: %s, polling for %s seconds before reconnecting' % (self.server, errorString, retryDelay))
+            #Disconnected: poll until the next connection attempt
+            retryTime = time.time() + retryDelay
+            while not self.isStopped and time.time() < retryTime:
+                self.poll()
+                sleepTime = min(self.pollInterval, max(retryTime - time.time(), 0))
+                time.sleep(sleepTime)
+            retryDelay = min(retryDelay * 2, 300)